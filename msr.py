@@ -12,8 +12,26 @@
 # july 2011 - 1.1 - raw read/write, set loco/hico, set density
 # 
 
+import os
+import json
 import time
 import serial
+import msrcodec
+import msrparser
+
+def instrumented(fnc):
+    # times a public command when metrics are on (see msrmetrics.py)
+    name = fnc.__name__
+    def command(self, *args, **kwargs):
+        m = self.metrics
+        if m is None: return fnc(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return fnc(self, *args, **kwargs)
+        finally:
+            m.observe("msr_command_seconds", (("command", name),), time.time() - started)
+    command.__name__ = name
+    return command
 
 # defining the core object
 class msr(serial.Serial):
@@ -28,85 +46,229 @@ class msr(serial.Serial):
     # for set_bpi
     hibpi=True
     lobpi=False
+    bpi_modes = [{True: "\xA1", False: "\xA0"},  # track 1 : 210bpi, 75bpi
+                 {True: "\xD2", False: "\x4B"},
+                 {True: "\xC1", False: "\xC0"}]
     
     # for pack/unpack
     track1_map  = " !\"#$%&'()*+`,./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_"
     track23_map = "0123456789:;<=>?"
-    parity_map  = [1,0,0,1,0,1,1,0,0,1,1,0,1,0,0,1,0,1,1,0,1,0,0,1,1,0,0,1,0,1,1,0, \
-                   0,1,1,0,1,0,0,1,1,0,0,1,0,1,1,0,1,0,0,1,0,1,1,0,0,1,1,0,1,0,0,1]
-                  # 1 = count of 1 in index is even, 0 = odd
-    rev6bit_map = [0,32,16,48,8,40,24,56,4,36,20,52,12,44,28,60,2,34,18,50,10,42,26,58,6,38,22,54,14,46,30,62, \
-                   1,33,17,49,9,41,25,57,5,37,21,53,13,45,29,61,3,35,19,51,11,43,27,59,7,39,23,55,15,47,31,63]
-                  # give the reverse bitmap (6 bits) of a the index
+    parity_map  = msrcodec.parity_map   # 1 = count of 1 in index is even, 0 = odd
+    rev6bit_map = msrcodec.rev6bit_map  # give the reverse bitmap (6 bits) of a the index
+    
+    # response timing, in seconds, replaced by the profile of the device if it has one
+    baud = 9600
+    settle_time = 0.1       # time the device needs after a command without result
+    byte_timeout = 0.5      # max gap between two bytes of the same response
+    response_timeout = 10   # wait for the response of a command without swipe
+    swipe_timeout = 10      # wait for the swipe of a read, write or erase
+    swipe_commands = "rmwnc"
+    
+    # timing profiles of each device, measured by msrcalibrate.py (None to disable)
+    profile_file = os.path.join(os.path.expanduser("~"), ".msrtool", "profiles.json")
+    profile_keys = ("baud", "settle_time", "byte_timeout", "response_timeout", "swipe_timeout")
+    profile = {}
+    
+    # True to send the commands of configure and erase_and_write back to back,
+    # without waiting for each response. Off by default : only the simulator
+    # is known to queue them, it wasn't checked on a reader yet
+    pipelining = False
+    
+    # for write_and_verify : rewrites of the failed tracks before giving up
+    verify_retries = 2
+    
+    # device configuration, kept across runs for each device path (None to disable)
+    state_file = os.path.join(os.path.expanduser("~"), ".msrtool", "state.json")
+    
+    # msrmetrics.registry collecting timings and counters, None when off
+    metrics = None
+    
+    # msrcapture.recorder logging the serial traffic, None when off
+    capture = None
+    
+    # msrquality.monitor collecting the swipe quality, None when off
+    quality = None
     
     def __init__(self, dev_path):
         if dev_path.find("/") == -1: dev_path = "/dev/" + dev_path
-        serial.Serial.__init__(self,dev_path,9600,8,serial.PARITY_NONE,timeout=0)
+        self.profile = msr.load_profile(dev_path)
+        for key in msr.profile_keys:
+            if key in self.profile: setattr(self, key, self.profile[key])
+        serial.Serial.__init__(self,dev_path,self.baud,8,serial.PARITY_NONE,timeout=0)
+        self.__ready_at = 0
+        self.config = self.__load_config()
         self.reset()
     
+    # configuration cache : coercivity (hico/loco), bpc and bpi of each track
+    # as last set on the device, None when unknown. Setting a value the device
+    # already has is skipped.
+    
+    @staticmethod
+    def load_profiles():
+        # device -> timing profile, from profile_file
+        if msr.profile_file is None or not os.path.exists(msr.profile_file): return {}
+        try:
+            with open(msr.profile_file) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    
+    @staticmethod
+    def load_profile(dev_path):
+        # profile of the device, by the path given (e.g. /dev/serial/by-id/...)
+        # or its real path, {} if it has none
+        profiles = msr.load_profiles()
+        return profiles.get(dev_path) or profiles.get(os.path.realpath(dev_path)) or {}
+    
+    @staticmethod
+    def command_timeout(dev, command):
+        # wait for the response of command on dev (a msr or async_msr) :
+        # swipe_timeout for a swipe, response_timeout for the others. The
+        # response_timeout of a profile holds for the commands it was measured
+        # on (its "measured" key, "dxy" by default), the others keep the default
+        if command[0] in msr.swipe_commands: return dev.swipe_timeout
+        if "response_timeout" in dev.profile and command[0] not in dev.profile.get("measured", "dxy"):
+            return msr.response_timeout
+        return dev.response_timeout
+    
+    @staticmethod
+    def __load_states():
+        if msr.state_file is None or not os.path.exists(msr.state_file): return {}
+        try:
+            with open(msr.state_file) as f:
+                return json.load(f)
+        except ValueError:
+            return {} # corrupted file, everything is unknown
+    
+    def __load_config(self):
+        config = {"coercivity": None, "bpc": [None, None, None], "bpi": [None, None, None]}
+        config.update(msr.__load_states().get(os.path.realpath(self.port), {}))
+        return config
+    
+    def __save_config(self):
+        if self.state_file is None: return
+        states = msr.__load_states()
+        states[os.path.realpath(self.port)] = self.config
+        directory = os.path.dirname(msr.state_file)
+        if not os.path.isdir(directory): os.makedirs(directory)
+        tmp = msr.state_file + ".%d" % os.getpid()
+        with open(tmp, "w") as f:
+            json.dump(states, f)
+        os.rename(tmp, msr.state_file)
+    
+    def invalidate(self):
+        # forget the cached configuration, next set_* commands will all be sent
+        self.config = {"coercivity": None, "bpc": [None, None, None], "bpi": [None, None, None]}
+        self.__save_config()
+    
+    def resync(self):
+        # forget the cached configuration, and read back what can be read from
+        # the device : the coercivity, with get_coercivity (d)
+        self.invalidate()
+        self.config["coercivity"] = self.get_coercivity()
+        self.__save_config()
+    
+    def __wait_ready(self):
+        # wait for the end of the settle time of the previous command, if any
+        delay = self.__ready_at - time.time()
+        if delay > 0: time.sleep(delay)
+    
     def __execute_noresult(self, command):
+        self.__wait_ready()
         self.write(msr.escape_code+command)
-        time.sleep(0.1)
+        self.flush()
+        if self.capture is not None: self.capture.written(msr.escape_code+command)
+        # the settle time is only waited for if another command follows too soon
+        self.__ready_at = time.time() + self.settle_time
+    
+    def __execute_waitresult(self, command, timeout=None):
+        return self.__execute_pipeline([command], timeout)[0]
     
-    def __execute_waitresult(self, command, timeout=10):
+    def __execute_pipeline(self, commands, timeout=None):
+        # sends the commands back to back, then gets their responses in order
+        # returns (status, result, response) of each command, up to the first
+        # failed one : the device is reset so it drops the commands after it
+        # timeout : wait for each response, swipe_timeout or response_timeout by default
+        if not self.pipelining and len(commands) > 1:
+            results = []
+            for command in commands:
+                results.extend(self.__execute_pipeline([command], timeout))
+                if results[-1][0] != "0": break
+            return results
+        m = self.metrics
+        
         # execute
+        self.__wait_ready()
+        if m is not None: started = time.time()
         self.flushInput()
-        self.write(msr.escape_code+command)
-        time.sleep(0.1)
+        data = "".join(msr.escape_code+command for command in commands)
+        self.write(data)
+        if self.capture is not None: self.capture.written(data)
+        if m is not None: written = time.time()
         
-        # get result
-        self.timeout=timeout
-        result = self.read()
-        time.sleep(0.5)
-        if result == "": raise Exception("operation timed out")
-        self.timeout=0
-        result += self.read(1000)
+        results = []
+        pending = ""
+        try:
+            for n, command in enumerate(commands):
+                wait = timeout
+                if wait is None: wait = msr.command_timeout(self, command)
+                response, pending, first = self.__receive(command, wait, pending)
+                if m is not None:
+                    done = time.time()
+                    c = command[0]
+                    if n == 0: m.observe("msr_phase_seconds", (("command", c), ("phase", "write")), written - started)
+                    m.observe("msr_phase_seconds", (("command", c), ("phase", "swipe")), first - written)
+                    m.observe("msr_phase_seconds", (("command", c), ("phase", "drain")), done - first)
+                    m.count("msr_status_total", (("command", c), ("status", response.status)))
+                    written = done # the next response is waited for from here
+                # status, result, response (datablock decoded by response.tracks())
+                results.append((response.status, response.result, response))
+                if response.status != "0" and n < len(commands)-1:
+                    self.__execute_noresult("a")
+                    break
+        except Exception:
+            if len(results) < len(commands)-1: self.__execute_noresult("a")
+            raise
+        return results
+    
+    def __receive(self, command, timeout, pending):
+        # gets the response to command, pending : data received after the previous response
+        # returns (response, data received after it, time of its first byte)
+        m = self.metrics
         
-        # parse result : status, result, data
-        pos = result.rindex(msr.escape_code)
-        return result[pos+1], result[pos+2:], result[0:pos]
+        # get result : wait up to timeout for the first byte (e.g. a card swipe),
+        # then up to byte_timeout between bytes until the whole response is there
+        response = msrparser.response(command)
+        first = time.time()
+        if pending: response.feed(pending)
+        deadline = time.time() + timeout
+        while not response.complete:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if response.empty():
+                    if m is not None: m.count("msr_status_total", (("command", command[0]), ("status", "timeout")))
+                    raise Exception("operation timed out")
+                break # incomplete response, parse what we got
+            self.timeout = remaining
+            chunk = self.read(max(1, self.inWaiting()))
+            if chunk != "":
+                if self.capture is not None: self.capture.received(chunk)
+                if response.empty(): first = time.time()
+                response.feed(chunk)
+                deadline = time.time() + self.byte_timeout
+        self.timeout = 0
+        response.close()
+        pending = str(response.buf[response.end:]) if response.end is not None else ""
+        return response, pending, first
 
+    @instrumented
     def reset(self):
         self.__execute_noresult("a")
     
     @staticmethod
     def __decode_isodatablock(data):
-        # header and end
-        if data[0:4] != msr.escape_code+"s"+msr.escape_code+"\x01":
-            raise Exception("bad datablock : don't start with <ESC>s<ESC>[01]", data)
-        if data[-2:] != "?"+msr.end_code:
-            raise Exception("bad datablock : don't end with ?<FS>", data)
-        
-        # first strip
-        strip1_start = 4
-        strip1_end = data.index(msr.escape_code,strip1_start)
-        if strip1_end == strip1_start:
-            strip1_end += 2
-            strip1 = None
-        else:
-            strip1 = data[strip1_start:strip1_end]
-
-        # second strip
-        strip2_start = strip1_end+2
-        if data[strip1_end:strip2_start] != msr.escape_code+"\x02":
-            raise Exception("bad datablock : missing <ESC>[02] at position %d" % strip1_end, data)
-        strip2_end = data.index(msr.escape_code,strip2_start)
-        if strip2_end == strip2_start:
-            strip2_end += 2
-            strip2 = None
-        else:
-            strip2 = data[strip2_start:strip2_end]
-        
-        # third strip
-        strip3_start = strip2_end+2
-        if data[strip2_end:strip3_start] != msr.escape_code+"\x03":
-            raise Exception("bad datablock : missing <ESC>[03] at position %d" % strip2_end, data)
-        if data[strip3_start] == msr.escape_code:
-            strip3 = None
-        else:
-            strip3 = data[strip3_start:-2]
-        
-        return strip1, strip2, strip3
+        # returns the three strips, None for the blank ones
+        return msrparser.decode_isodatablock(data)
     
     @staticmethod
     def __encode_isodatablock(strip1, strip2, strip3):
@@ -115,34 +277,7 @@ class msr(serial.Serial):
     
     @staticmethod
     def __decode_rawdatablock(data):
-        # header
-        if data[0:4] != msr.escape_code+"s"+msr.escape_code+"\x01":
-            raise Exception("bad datablock : don't start with <ESC>s<ESC>[01]", data)
-        
-        # first strip
-        strip1_start = 4
-        strip1_end = strip1_start + 1 + ord(data[strip1_start]) # first byte is length
-        strip1 = data[strip1_start+1:strip1_end]
-
-        # second strip
-        strip2_start = strip1_end+2
-        if data[strip1_end:strip2_start] != msr.escape_code+"\x02":
-            raise Exception("bad datablock : missing <ESC>[02] at position %d" % strip1_end, data)
-        strip2_end = strip2_start + 1 + ord(data[strip2_start])
-        strip2 = data[strip2_start+1:strip2_end]
-        
-        # third strip
-        strip3_start = strip2_end+2
-        if data[strip2_end:strip3_start] != msr.escape_code+"\x03":
-            raise Exception("bad datablock : missing <ESC>[03] at position %d" % strip2_end, data)
-        strip3_end = strip3_start + 1 + ord(data[strip3_start])
-        strip3 = data[strip3_start+1:strip3_end]
-
-        # trailer
-        if data[strip3_end:] != "?"+msr.end_code:
-            raise Exception("bad datablock : missing ?<FS> at position %d", strip3_end, data)
-                
-        return strip1, strip2, strip3
+        return msrparser.decode_rawdatablock(data)
 
     @staticmethod
     def __encode_rawdatablock(strip1, strip2, strip3):
@@ -164,33 +299,13 @@ class msr(serial.Serial):
         # mapping : string used to convert a character to a code
         # bcount_code : number of bits of character code (without the parity bit)
         # bcount_output : number of bits per output characters
-        raw = ""
-        lrc = 0       # parity odd
-        rem_bits = 0  # remaining bits from previous loop
-        rem_count = 0 # count of remaining bits
-        for c in data:
-            i = mapping.find(c)                      # convert char to code
-            if i==-1: i = 0                          # fail to first code if char is not allowed
-            lrc ^= i
-            i |= msr.parity_map[i] << bcount_code    # add parity bit in front of the code
-            rem_bits |= i << rem_count               # concate current code in front of remaining bits
-            rem_count += bcount_code+1
-            if rem_count >= bcount_output:
-                raw += chr(rem_bits & ((1<<bcount_output)-1)) # write the bcount_output bits on the rigth
-                rem_bits >>= bcount_output
-                rem_count -= bcount_output
-        # add one loop for LRC
-        lrc |= msr.parity_map[i] << bcount_code
-        rem_bits |= lrc << rem_count
-        rem_count += bcount_code+1
-        if rem_count >= bcount_output:
-            raw += chr(rem_bits & ((1<<bcount_output)-1))
-            rem_bits >>= bcount_output
-            rem_count -= bcount_output
-        # add remaining bits, filling with 0
-        if rem_count > 0:
-            raw += chr(rem_bits)
-        return raw
+        m = msr.metrics
+        if m is None: return msrcodec.pack_raw(data, mapping, bcount_code, bcount_output)
+        started = time.time()
+        try:
+            return msrcodec.pack_raw(data, mapping, bcount_code, bcount_output)
+        finally:
+            m.observe("msr_codec_seconds", (("function", "pack_raw"),), time.time() - started)
     
     @staticmethod
     def unpack_raw(raw, mapping, bcount_code, bcount_output):
@@ -199,63 +314,148 @@ class msr(serial.Serial):
         # bcount_code : number of bits of character code (without the parity bit)
         # bcount_output : number of bits per output characters
         # returns : data without trailing nulls, total length including trailing nulls, parity errors, lrc error
-        data = ""
-        parity_errors = ""
-        rem_bits = 0  # remaining bits from previous loop
-        rem_count = 0 # count of remaining bits
-        lrc = 0       # parity odd
-        last_non_null = -1
-        for c in raw:
-            rem_count += bcount_output               # append next bits on the right
-            rem_bits = (rem_bits << bcount_output) | (ord(c) & ((1<<bcount_output)-1))
-            while rem_count >= bcount_code+1:
-                # get the bcount_code+parity bits on the left
-                rem_count -= bcount_code+1
-                i = rem_bits >> rem_count
-                rem_bits &= ((1<<rem_count)-1)
-                
-                # reverse bits (assume bcount_code<=6)
-                p = i & 0x1 # parity code
-                i = msr.rev6bit_map[i>>1] >> (6-bcount_code)
-                data += mapping[i]
-                if i != 0: last_non_null = len(data)-1
-                
-                # check parity
-                lrc ^= i
-                if msr.parity_map[i] == p:
-                    parity_errors += " "
-                else:
-                    parity_errors += "^"
-                
-        # check LRC (kept at the end of decoded data)
-        lrc_error = (lrc != 0)
-        
-        return data[0:last_non_null+1], len(data), parity_errors[0:last_non_null+1], lrc_error
+        m = msr.metrics
+        if m is None: return msrcodec.unpack_raw(raw, mapping, bcount_code, bcount_output)
+        started = time.time()
+        try:
+            return msrcodec.unpack_raw(raw, mapping, bcount_code, bcount_output)
+        finally:
+            m.observe("msr_codec_seconds", (("function", "unpack_raw"),), time.time() - started)
+    
+    @staticmethod
+    def unpack_raw_many(raws, mapping, bcount_code, bcount_output):
+        # same as unpack_raw for a list of raw tracks, decoded in one call
+        return msrcodec.unpack_many(raws, mapping, bcount_code, bcount_output)
         
-    def read_tracks(self):
-        status, _, data = self.__execute_waitresult("r")
+    def __decode(self, response):
+        m = self.metrics
+        if m is None: return response.tracks()
+        started = time.time()
+        try:
+            return response.tracks()
+        finally:
+            m.observe("msr_phase_seconds", (("command", response.command), ("phase", "decode")), time.time() - started)
+    
+    def __read(self, command):
+        status, _, response = self.__execute_waitresult(command)
+        if self.quality is not None: self.quality.swipe(self.port, status == "0")
         if status != "0":
             raise Exception("read error : %c" % status)
-        return self.__decode_isodatablock(data)
+        return self.__decode(response)
+    
+    @instrumented
+    def read_tracks(self):
+        return self.__read("r")
 
+    @instrumented
     def read_raw_tracks(self):
-        status, _, data = self.__execute_waitresult("m")
-        if status != "0":
-            raise Exception("read error : %c" % status)
-        return self.__decode_rawdatablock(data)
+        return self.__read("m")
 
-    def write_tracks(self, t1="", t2="", t3=""):
-        data = self.__encode_isodatablock(t1,t2,t3)
-        status, _, _ = self.__execute_waitresult("w"+data)
+    @staticmethod
+    def prepare_tracks(t1="", t2="", t3=""):
+        # encoded write command, so it can be built ahead of write_prepared
+        return "w"+msr.__encode_isodatablock(t1,t2,t3)
+
+    @staticmethod
+    def prepare_raw_tracks(t1, t2, t3):
+        return "n"+msr.__encode_rawdatablock(t1,t2,t3)
+
+    @instrumented
+    def write_prepared(self, command):
+        # command : returned by prepare_tracks or prepare_raw_tracks
+        self.__write_prepared(command)
+
+    def __write_prepared(self, command):
+        status, _, _ = self.__execute_waitresult(command)
+        if self.quality is not None: self.quality.swipe(self.port, status == "0")
         if status != "0":
             raise Exception("write error : %c" % status)
 
+    def __encode(self, prepare, *tracks):
+        m = self.metrics
+        if m is None: return prepare(*tracks)
+        started = time.time()
+        command = prepare(*tracks)
+        m.observe("msr_phase_seconds", (("command", command[0]), ("phase", "encode")), time.time() - started)
+        return command
+
+    @instrumented
+    def write_tracks(self, t1="", t2="", t3=""):
+        self.__write_prepared(self.__encode(msr.prepare_tracks, t1,t2,t3))
+
+    @instrumented
     def write_raw_tracks(self, t1, t2, t3):
-        data = self.__encode_rawdatablock(t1,t2,t3)
-        status, _, _ = self.__execute_waitresult("n"+data)
-        if status != "0":
-            raise Exception("write error : %c" % status)
+        self.__write_prepared(self.__encode(msr.prepare_raw_tracks, t1,t2,t3))
+
+    def __write_verify(self, tracks, prepare, read, check, retries, prompt):
+        # writes the given tracks ("" to leave one alone), reads them back, and
+        # rewrites the ones check(n, read) rejects, up to retries times
+        # returns the number of swipes, the exception raised on a failure has
+        # them in its swipes attribute
+        if retries is None: retries = msr.verify_retries
+        pending = [n for n in range(3) if tracks[n] != ""]
+        rewrites = [0, 0, 0]
+        swipes = 0
+        try:
+            for attempt in range(retries+1):
+                if attempt > 0:
+                    for n in pending: rewrites[n] += 1
+                numbers = [n+1 for n in pending]
+                if prompt is not None: prompt("write", numbers)
+                swipes += 1
+                try:
+                    self.__write_prepared(self.__encode(prepare, *[tracks[n] if n in pending else "" for n in range(3)]))
+                except Exception:
+                    if attempt == retries: raise
+                    continue
+                if prompt is not None: prompt("verify", numbers)
+                swipes += 1
+                try:
+                    result = self.__read(read)
+                except Exception:
+                    if attempt == retries: raise
+                    continue # can't tell which tracks are bad : rewrite them all
+                pending = [n for n in pending if not check(n, result[n])]
+                if not pending: return swipes
+            raise Exception("verify error : track %s" % ", ".join(str(n+1) for n in pending))
+        except Exception as e:
+            e.swipes = swipes
+            raise
+        finally:
+            q = self.quality
+            if q is not None:
+                for n in range(3):
+                    if tracks[n] != "": q.written(self.port, n+1, rewrites[n])
 
+    @instrumented
+    def write_and_verify(self, t1="", t2="", t3="", retries=None, prompt=None):
+        # writes the tracks, then reads the card back and rewrites only the
+        # tracks that differ, up to retries times (verify_retries by default)
+        # prompt : called with "write" or "verify" and the track numbers before each swipe
+        # returns the number of swipes
+        tracks = [t1, t2, t3]
+        def check(n, read):
+            return read is not None and read[1:-1] == tracks[n] # without sentinels
+        return self.__write_verify(tracks, msr.prepare_tracks, "r", check, retries, prompt)
+
+    @instrumented
+    def write_raw_and_verify(self, t1, t2, t3, bpc=(8,8,8), retries=None, prompt=None):
+        # same as write_and_verify for raw tracks packed with pack_raw on bpc
+        # bits per character : a track read back is good if unpack_raw gives
+        # the same data, parity errors and LRC as for what was written
+        tracks = [t1, t2, t3]
+        codes = [(msr.track1_map, 6), (msr.track23_map, 4), (msr.track23_map, 4)]
+        def decode(n, raw):
+            mapping, bcount_code = codes[n]
+            return msrcodec.unpack_raw(raw or "", mapping, bcount_code, bpc[n])
+        def check(n, read):
+            result = decode(n, read)
+            if self.quality is not None: self.quality.observe(self.port, n+1, result)
+            expected = decode(n, tracks[n])
+            return (result[0], result[2], result[3]) == (expected[0], expected[2], expected[3])
+        return self.__write_verify(tracks, msr.prepare_raw_tracks, "m", check, retries, prompt)
+
+    @instrumented
     def erase_tracks(self, t1=False, t2=False, t3=False):
         mask = 0
         if t1: mask |= 1
@@ -264,37 +464,87 @@ class msr(serial.Serial):
         status, _, _ = self.__execute_waitresult("c"+chr(mask))
         if status != "0":
             raise Exception("erase error : %c" % status)
+
+    @instrumented
+    def erase_and_write(self, t1="", t2="", t3=""):
+        # recycles a card : writes the tracks given and erases the others ("")
+        # writing a track replaces it, so only the others are erased. With
+        # pipelining, the write is sent with the erase and waits in the device
+        # for the second swipe. Returns the number of swipes (1 if every track is written)
+        return self.__erase_and_write(msr.prepare_tracks, [t1, t2, t3])
+
+    @instrumented
+    def erase_and_write_raw(self, t1="", t2="", t3=""):
+        # same as erase_and_write for raw tracks
+        return self.__erase_and_write(msr.prepare_raw_tracks, [t1, t2, t3])
+
+    def __erase_and_write(self, prepare, tracks):
+        mask = sum(1<<n for n in range(3) if tracks[n] == "")
+        commands = []
+        if mask: commands.append("c"+chr(mask))
+        if mask != 7: commands.append(self.__encode(prepare, *tracks))
+        for command, (status, _, _) in zip(commands, self.__execute_pipeline(commands)):
+            if self.quality is not None: self.quality.swipe(self.port, status == "0")
+            if status != "0":
+                raise Exception("%s error : %c" % ("erase" if command[0] == "c" else "write", status))
+        return len(commands)
     
     #def set_leadingzero(self, track13, track2):
     #    status, result, _ = self.__execute_waitresult("o"+chr(bpc1)+chr(bpc2)+chr(bpc3))
     #    if status != "0":
     #        raise Exception("set_bpc error : %c" % status)
 
+    @instrumented
     def set_bpc(self, bpc1, bpc2, bpc3):
-        status, result, _ = self.__execute_waitresult("o"+chr(bpc1)+chr(bpc2)+chr(bpc3))
-        if status != "0":
-            raise Exception("set_bpc error : %c" % status)
+        self.__configure(bpc=[bpc1, bpc2, bpc3])
 
+    @instrumented
     def set_bpi(self, bpi1=None, bpi2=None, bpi3=None):
-        modes = []
-        if bpi1==True: modes.append("\xA1")    # 210bpi
-        elif bpi1==False: modes.append("\xA0") # 75bpi
-        if bpi2==True: modes.append("\xD2")
-        elif bpi2==False: modes.append("\x4B")
-        if bpi2==True: modes.append("\xC1")
-        elif bpi2==False: modes.append("\xC0")
-        for m in modes:
-            status, result, _ = self.__execute_waitresult("b"+m)
-            if status != "0":
-                raise Exception("set_bpi error : %c for %s" % (status,hex(m)))
+        # msr.hibpi (210bpi) or msr.lobpi (75bpi) for each track, None to leave it alone
+        self.__configure(bpi=[bpi1, bpi2, bpi3])
 
+    @instrumented
     def set_coercivity(self, hico):
-        if hico:
-            status, _, _ = self.__execute_waitresult("x")
-        else:
-            status, _, _ = self.__execute_waitresult("y")
-        if status != "0":
-            raise Exception("set_hico error : %c" % status)
+        self.__configure(coercivity=hico)
+
+    @instrumented
+    def configure(self, coercivity=None, bpc=None, bpi=None):
+        # sets the coercivity, the bpc of the three tracks and the bpi of each
+        # track (None to leave one alone), the commands sent back to back with
+        # pipelining
+        self.__configure(coercivity, bpc, bpi)
+
+    def __configure(self, coercivity=None, bpc=None, bpi=None):
+        steps = [] # (command, config key, track, value, error message), values the device doesn't have yet
+        if coercivity is not None and self.config["coercivity"] != coercivity:
+            steps.append(("x" if coercivity else "y", "coercivity", None, coercivity, "set_hico error : %c"))
+        if bpc is not None and self.config["bpc"] != list(bpc):
+            steps.append(("o"+"".join(chr(b) for b in bpc), "bpc", None, list(bpc), "set_bpc error : %c"))
+        for track, value in enumerate(bpi or []):
+            if value is None or self.config["bpi"][track] == value: continue
+            mode = msr.bpi_modes[track][value]
+            steps.append(("b"+mode, "bpi", track, value, "set_bpi error : %%c for %s" % hex(ord(mode))))
+        if not steps: return
+        def store(key, track, value):
+            if key == "bpi": self.config["bpi"][track] = value
+            elif key == "bpc": self.config["bpc"] = value if value is not None else [None, None, None]
+            else: self.config[key] = value
+        for command, key, track, value, error in steps: store(key, track, None) # unknown until confirmed
+        try:
+            results = self.__execute_pipeline([step[0] for step in steps])
+            for (command, key, track, value, error), (status, _, _) in zip(steps, results):
+                if status != "0": raise Exception(error % status)
+                store(key, track, value)
+        finally:
+            self.__save_config()
+
+    @instrumented
+    def get_coercivity(self):
+        # returns msr.hico or msr.loco
+        status, _, _ = self.__execute_waitresult("d")
+        if status not in "HL":
+            raise Exception("get_hico error : %c" % status)
+        return status == "H"
 
 if __name__ == "__main__":
     # parse arguments
@@ -307,10 +557,19 @@ if __name__ == "__main__":
     group.add_argument ('-C', '--hico', action="store_true", help="select high coercivity mode")
     group.add_argument ('-c', '--loco', action="store_true", help="select low coercivity mode")
     group.add_argument ('-b', '--bpi', help="bit per inch for each track (h or l)")
+    group.add_argument ('-X', '--session', help="run the commands of this script (- for stdin) over one connection, see msrsession.py")
     parser.add_argument('-d', '--device', help="path to serial communication device")
     parser.add_argument('-0', '--raw', action="store_true", help="do not use ISO encoding/decoding")
     parser.add_argument('-t', '--tracks', default="123", help="select tracks (1, 2, 3, 12, 23, 13, 123)")
+    parser.add_argument('-A', '--auto', action="store_true", help="(raw read only) detect the bpc, character code and direction of each track")
     parser.add_argument('-B', '--bpc', help="bit per caracters for each track (5 to 8)")
+    parser.add_argument('-s', '--resync', action="store_true", help="forget the configuration cached for the device, and read its coercivity back from it")
+    parser.add_argument('-D', '--dump', help="(raw read only) append the raw tracks to this dump file, see msrdecode.py")
+    parser.add_argument('-L', '--capture', help="log the serial traffic to this file, see msrcapture.py")
+    parser.add_argument('-M', '--metrics', help="save metrics of the run to this file (Prometheus text, or JSON if it ends with .json)")
+    parser.add_argument('-Q', '--quality', help="add the swipe quality of the run to this file, see msrquality.py")
+    parser.add_argument('-k', '--keep-going', action="store_true", help="(session only) go on after a failed command")
+    parser.add_argument('-S', '--socket', help="msrd socket, used if the daemon serves the device (%s by default)" % "~/.msrtool/msrd.sock")
     parser.add_argument('data', nargs="*", help="(write only) 1, 2 or 3 arguments, matching --tracks")
     args = parser.parse_args();
     
@@ -338,7 +597,7 @@ if __name__ == "__main__":
         bpc2 = ord(args.bpc[1])-48
         bpc3 = ord(args.bpc[2])-48
     elif args.raw:
-        args.bpc = "888" # force setup, as it's kept accross runs
+        args.bpc = "888" # setup, as it's kept accross runs (skipped if already done)
 
     if args.bpi:
         bpi1 = args.bpi[0] != "l"
@@ -346,14 +605,40 @@ if __name__ == "__main__":
         bpi3 = args.bpi[2] != "l"
     
     # main code
+    if args.metrics:
+        import msrmetrics
+        msr.metrics = msrmetrics.registry()
+    if args.quality:
+        import msrquality
+        msr.quality = msrquality.monitor(args.quality)
+    
+    status = 0
     try:
-        dev = msr(args.device)
+        import msrd
+        dev = msrd.connect(args.device, args.socket or msrd.default_socket)
+        if isinstance(dev, msrd.client) and (args.capture or args.metrics or args.quality):
+            # the daemon drives the port, nothing of it would be seen here
+            dev.close()
+            print "--capture, --metrics and --quality need the device, it is served by msrd : stop msrd or leave them out"
+            exit(1)
+        dev.metrics = msr.metrics # the driver class may come from the msr module
+        dev.quality = msr.quality
+        if args.capture:
+            import msrcapture
+            dev.capture = msrcapture.recorder(args.capture)
+        
+        if args.resync:
+            dev.resync()
         
         if args.bpc:
             dev.set_bpc(bpc1,bpc2,bpc3)
         
         if args.read & args.raw:
             s1,s2,s3 = dev.read_raw_tracks()
+            if args.dump:
+                import msrdecode
+                with open(args.dump, "ab") as f:
+                    msrdecode.dump(f, s1, s2, s3)
             def print_result(num, res):
                 s,l,perr,lerr = res
                 line = "%d=%s" % (num, s)
@@ -361,9 +646,27 @@ if __name__ == "__main__":
                 if lerr: line += " (LRC error)"
                 print line
                 if -1 != perr.find("^"): print "  %s <- parity errors" % perr
-            if tracks[0]: print_result(1, msr.unpack_raw(s1, msr.track1_map,  6, bpc1))
-            if tracks[1]: print_result(2, msr.unpack_raw(s2, msr.track23_map, 4, bpc2))
-            if tracks[2]: print_result(3, msr.unpack_raw(s3, msr.track23_map, 4, bpc3))
+            def print_detection(num, raw):
+                d = msrdetect.detect(raw)
+                if d is None:
+                    print "%d=" % num
+                    return
+                line = "%d=%s (%s)" % (num, d.data, d)
+                if d.lrc_error: line += " (LRC error)"
+                print line
+                if -1 != d.perr.find("^"): print "  %s <- parity errors" % d.perr
+            if args.auto:
+                import msrdetect
+                for num, raw in ((1, s1), (2, s2), (3, s3)):
+                    if tracks[num-1]: print_detection(num, raw)
+            else:
+                results = [msr.unpack_raw(s1, msr.track1_map,  6, bpc1) if tracks[0] else None,
+                           msr.unpack_raw(s2, msr.track23_map, 4, bpc2) if tracks[1] else None,
+                           msr.unpack_raw(s3, msr.track23_map, 4, bpc3) if tracks[2] else None]
+                for num, res in enumerate(results, 1):
+                    if res is not None: print_result(num, res)
+                if msr.quality is not None:
+                    msr.quality.observe_tracks(args.device if "/" in args.device else "/dev/" + args.device, results)
         
         elif args.read: # iso mode
             s1,s2,s3 = dev.read_tracks()
@@ -398,5 +701,18 @@ if __name__ == "__main__":
         elif args.bpi:
             dev.set_bpi(bpi1,bpi2,bpi3)
         
+        elif args.session:
+            import sys
+            import msrsession
+            script = sys.stdin if args.session == "-" else open(args.session)
+            failed = msrsession.run(dev, iter(script.readline, ""), sys.stdout, args.keep_going)
+            if failed: status = 1
+        
     except Exception as e:
         print e
+    
+    if args.metrics:
+        msr.metrics.save(args.metrics)
+    if args.quality:
+        msr.quality.save()
+    exit(status)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python2
+#
+# File: msrasync.py
+# Licence: GNU GPL version 3
+#
+# Non-blocking driver for the MSR605, many readers on one event loop
+#
+# Commands return an operation right away instead of blocking until the
+# card is swiped. Operations complete from a select() based loop, can be
+# cancelled at any time (the device is then reset), and can be waited for
+# from generator based coroutines:
+#
+#   def issue(dev):
+#       t1, t2, t3 = yield dev.read_tracks()
+#       yield dev.write_tracks(t1[1:-1], t2[1:-1], "")
+#
+#   l = msrasync.loop()
+#   for path in paths: l.spawn(issue(msrasync.async_msr(path, l)))
+#   l.run()
+#
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import collections
+import serial
+import msrparser
+from msr import msr
+
+# protocol helpers shared with the blocking driver
+encode_isodatablock = msr._msr__encode_isodatablock
+encode_rawdatablock = msr._msr__encode_rawdatablock
+
+class cancelled(Exception):
+    pass
+
+class timeout(Exception):
+    # nothing came from the device in time (e.g. no card swiped)
+    pass
+
+class operation(object):
+    # result of a command that completes later
+    def __init__(self, loop):
+        self.loop = loop
+        self.__done = False
+        self.__result = None
+        self.__error = None
+        self.__callbacks = []
+        self.on_cancel = None # called once if the operation is cancelled while pending
+
+    def done(self):
+        return self.__done
+
+    def cancelled(self):
+        return isinstance(self.__error, cancelled)
+
+    def result(self):
+        if not self.__done: raise Exception("operation not done")
+        if self.__error is not None: raise self.__error
+        return self.__result
+
+    def error(self):
+        return self.__error
+
+    def add_done_callback(self, callback):
+        # callback is called with the operation once done
+        if self.__done:
+            self.loop.call_soon(callback, self)
+        else:
+            self.__callbacks.append(callback)
+
+    def set_result(self, result):
+        self.__finish(result, None)
+
+    def set_error(self, error):
+        self.__finish(None, error)
+
+    def cancel(self):
+        if self.__done: return False
+        on_cancel = self.on_cancel
+        self.__finish(None, cancelled("operation cancelled"))
+        if on_cancel is not None: on_cancel()
+        return True
+
+    def __finish(self, result, error):
+        if self.__done: return
+        self.__done = True
+        self.__result = result
+        self.__error = error
+        for callback in self.__callbacks:
+            self.loop.call_soon(callback, self)
+        self.__callbacks = []
+
+class task(operation):
+    # runs a generator : every operation it yields is waited for, and its
+    # result is sent back (or its error raised) into the generator
+    def __init__(self, loop, gen):
+        operation.__init__(self, loop)
+        self.gen = gen
+        self.waiting = None
+        self.on_cancel = self.__cancel_waiting
+        loop.call_soon(self.__step, None, None)
+
+    def __step(self, value, error):
+        if self.done(): return
+        try:
+            if error is not None:
+                op = self.gen.throw(error)
+            else:
+                op = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception as e:
+            self.set_error(e)
+            return
+        self.waiting = op
+        op.add_done_callback(self.__wakeup)
+
+    def __wakeup(self, op):
+        self.waiting = None
+        if op.error() is not None:
+            self.__step(None, op.error())
+        else:
+            self.__step(op.result(), None)
+
+    def __cancel_waiting(self):
+        if self.waiting is not None: self.waiting.cancel()
+        self.gen.close()
+
+class timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class loop(object):
+    def __init__(self):
+        self.__readers = {}
+        self.__writers = {}
+        self.__timers = []
+        self.__ready = collections.deque()
+        self.__stopped = False
+
+    def add_reader(self, fd, callback):
+        self.__readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.__readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.__writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.__writers.pop(fd, None)
+
+    def call_soon(self, callback, *args):
+        self.__ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        t = timer(time.time() + delay, callback, args)
+        heapq.heappush(self.__timers, t)
+        return t
+
+    def spawn(self, gen):
+        # runs a generator based coroutine, see task
+        return task(self, gen)
+
+    def run_once(self, timeout=None):
+        # runs the callbacks ready now, waiting up to timeout for i/o or timers
+        while self.__timers and not self.__timers[0].active:
+            heapq.heappop(self.__timers)
+        if self.__ready:
+            timeout = 0
+        elif self.__timers:
+            delay = max(0, self.__timers[0].when - time.time())
+            if timeout is None or delay < timeout: timeout = delay
+        if self.__readers or self.__writers:
+            r, w, _ = select.select(list(self.__readers), list(self.__writers), [], timeout)
+            for fd in r:
+                if fd in self.__readers: self.__ready.append((self.__readers[fd], ()))
+            for fd in w:
+                if fd in self.__writers: self.__ready.append((self.__writers[fd], ()))
+        elif timeout:
+            time.sleep(timeout)
+        now = time.time()
+        while self.__timers and self.__timers[0].when <= now:
+            t = heapq.heappop(self.__timers)
+            if t.active: self.__ready.append((t.callback, t.args))
+        for i in range(len(self.__ready)):
+            callback, args = self.__ready.popleft()
+            callback(*args)
+
+    def run(self, *ops):
+        # runs until the given operations are done, or until stop() if none given
+        self.__stopped = False
+        while not self.__stopped:
+            if ops and all(op.done() for op in ops): break
+            self.run_once()
+
+    def run_until_complete(self, op):
+        self.run(op)
+        return op.result()
+
+    def stop(self):
+        self.__stopped = True
+
+class async_msr(object):
+    # same commands as msr.msr, returning operations
+    escape_code = msr.escape_code
+    hico = msr.hico
+    loco = msr.loco
+    baud = msr.baud
+    settle_time = msr.settle_time
+    byte_timeout = msr.byte_timeout
+    response_timeout = msr.response_timeout
+    swipe_timeout = msr.swipe_timeout
+    profile = {}
+
+    def __init__(self, dev_path, loop):
+        if dev_path.find("/") == -1: dev_path = "/dev/" + dev_path
+        self.path = dev_path
+        self.loop = loop
+        # timing profile measured by msrcalibrate.py, as for the blocking driver
+        self.profile = msr.load_profile(dev_path)
+        for key in msr.profile_keys:
+            if key in self.profile: setattr(self, key, self.profile[key])
+        self.port = serial.Serial(dev_path,self.baud,8,serial.PARITY_NONE,timeout=0)
+        self.fd = self.port.fileno()
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.__queue = collections.deque()
+        self.__current = None
+        self.__ready_at = 0
+        self.reset()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        items = list(self.__queue)
+        self.__queue.clear()
+        for op, _, _, _ in items: op.cancel()
+        if self.__current is not None: self.__current[0].cancel()
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.port.close()
+
+    # command queue : one command at a time per device, in submission order
+
+    def __submit(self, command, handler, timeout=None):
+        # handler : None for commands without result, or called with
+        #           (status, result, response) to give the operation result
+        # timeout : swipe_timeout or response_timeout by default
+        op = operation(self.loop)
+        if timeout is None: timeout = msr.command_timeout(self, command)
+        item = (op, command, handler, timeout)
+        op.on_cancel = lambda: self.__cancel(item)
+        self.__queue.append(item)
+        if self.__current is None: self.__next()
+        return op
+
+    def __next(self):
+        if self.__current is not None or not self.__queue: return
+        delay = self.__ready_at - time.time()
+        if delay > 0:
+            # previous command without result is still settling
+            self.loop.call_later(delay, self.__next)
+            return
+        self.__current = item = self.__queue.popleft()
+        op, command, handler, timeout = item
+        self.__response = msrparser.response(command)
+        self.__out = msr.escape_code + command
+        if handler is not None:
+            self.port.flushInput()
+            self.__timer = self.loop.call_later(timeout, self.__timeout)
+        self.loop.add_writer(self.fd, self.__writable)
+
+    def __writable(self):
+        try:
+            n = os.write(self.fd, self.__out)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                # e.g. EIO, the reader was unplugged : select would report the fd forever
+                self.loop.remove_writer(self.fd)
+                op, command, handler, timeout = self.__current
+                if handler is not None: self.__timer.cancel()
+                self.__current = None
+                op.set_error(e)
+                self.__next()
+                return
+            n = 0
+        self.__out = self.__out[n:]
+        if self.__out != "": return
+        self.loop.remove_writer(self.fd)
+        op, command, handler, timeout = self.__current
+        if handler is None:
+            self.__ready_at = time.time() + self.settle_time
+            self.__current = None
+            op.set_result(None)
+            self.__next()
+        else:
+            self.loop.add_reader(self.fd, self.__readable)
+
+    def __readable(self):
+        try:
+            chunk = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR): return
+            self.__fail(e) # e.g. EIO, the reader was unplugged
+            return
+        if chunk == "":
+            self.__fail(Exception("end of file on %s" % self.path))
+            return
+        if self.__response.feed(chunk):
+            self.__complete()
+        else:
+            # wait up to byte_timeout for the rest of the response
+            self.__timer.cancel()
+            self.__timer = self.loop.call_later(self.byte_timeout, self.__timeout)
+
+    def __timeout(self):
+        if self.__response.empty():
+            self.__fail(timeout("operation timed out"))
+        else:
+            self.__complete() # incomplete response, parse what we got
+
+    def __complete(self):
+        op, command, handler, timeout = self.__current
+        response = self.__response
+        self.__finish()
+        try:
+            response.close()
+            op.set_result(handler(response.status, response.result, response))
+        except Exception as e:
+            op.set_error(e)
+        self.__next()
+
+    def __fail(self, error):
+        op, command, handler, timeout = self.__current
+        self.__finish()
+        op.set_error(error)
+        self.__next()
+
+    def __finish(self):
+        self.__timer.cancel()
+        self.loop.remove_reader(self.fd)
+        self.__current = None
+
+    def __cancel(self, item):
+        if item is self.__current:
+            # abort the pending command on the device
+            self.loop.remove_writer(self.fd)
+            if item[2] is not None: self.__finish()
+            self.__current = None
+            self.__queue.appendleft((operation(self.loop), "a", None, 0))
+            self.__next()
+        elif item in self.__queue:
+            self.__queue.remove(item)
+
+    # commands
+
+    def reset(self):
+        return self.__submit("a", None)
+
+    def read_tracks(self, timeout=None):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("read error : %c" % status)
+            return response.tracks()
+        return self.__submit("r", handler, timeout)
+
+    def read_raw_tracks(self, timeout=None):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("read error : %c" % status)
+            return response.tracks()
+        return self.__submit("m", handler, timeout)
+
+    def write_tracks(self, t1="", t2="", t3="", timeout=None):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("write error : %c" % status)
+        return self.__submit("w"+encode_isodatablock(t1,t2,t3), handler, timeout)
+
+    def write_raw_tracks(self, t1, t2, t3, timeout=None):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("write error : %c" % status)
+        return self.__submit("n"+encode_rawdatablock(t1,t2,t3), handler, timeout)
+
+    def erase_tracks(self, t1=False, t2=False, t3=False, timeout=None):
+        mask = 0
+        if t1: mask |= 1
+        if t2: mask |= 2
+        if t3: mask |= 4
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("erase error : %c" % status)
+        return self.__submit("c"+chr(mask), handler, timeout)
+
+    def set_bpc(self, bpc1, bpc2, bpc3):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("set_bpc error : %c" % status)
+        return self.__submit("o"+chr(bpc1)+chr(bpc2)+chr(bpc3), handler)
+
+    def set_bpi(self, bpi1=None, bpi2=None, bpi3=None):
+        modes = []
+        if bpi1==True: modes.append("\xA1")    # 210bpi
+        elif bpi1==False: modes.append("\xA0") # 75bpi
+        if bpi2==True: modes.append("\xD2")
+        elif bpi2==False: modes.append("\x4B")
+        if bpi3==True: modes.append("\xC1")
+        elif bpi3==False: modes.append("\xC0")
+        def run():
+            for m in modes:
+                yield self.__submit("b"+m, self.__bpi_handler(m))
+        return self.loop.spawn(run())
+
+    @staticmethod
+    def __bpi_handler(m):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("set_bpi error : %c for %s" % (status,hex(ord(m))))
+        return handler
+
+    def set_coercivity(self, hico):
+        def handler(status, result, response):
+            if status != "0":
+                raise Exception("set_hico error : %c" % status)
+        return self.__submit("x" if hico else "y", handler)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python2
+#
+# File: msrbatch.py
+# Licence: GNU GPL version 3
+#
+# Batch issuance : write one card per record of a CSV or JSONL job file
+#
+# Records are read lazily, so memory use doesn't depend on the size of the
+# job. While a card is being swiped, the next records are already validated
+# and encoded by a background thread. The number of records done is kept in
+# a checkpoint file, a restarted batch goes on with the next record.
+#
+# CSV : one card per line, columns t1,t2,t3 (an optional t1,t2,t3 header is skipped)
+# JSONL : one card per line, {"t1": ..., "t2": ..., "t3": ...} or [t1, t2, t3]
+# Template : a *.template.json file, the records are generated (see msrgen.py)
+#
+
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import Queue
+import msr
+
+# longest data of each track, without sentinels and LRC
+max_length = [76, 37, 104]
+# swipes tried on a record before it is marked failed and skipped
+write_attempts = 3
+# characters allowed in the data of each track
+allowed = [msr.msr.track1_map.replace("%","").replace("?",""),
+           msr.msr.track23_map.replace(";","").replace("?",""),
+           msr.msr.track23_map.replace(";","").replace("?","")]
+
+def validate(t1, t2, t3):
+    # raises an exception if the tracks can't be written in iso mode
+    for n, t in enumerate((t1, t2, t3)):
+        if len(t) > max_length[n]:
+            raise Exception("track %d too long : %d characters, %d max" % (n+1, len(t), max_length[n]))
+        for c in t:
+            if allowed[n].find(c) == -1:
+                raise Exception("track %d : character %r not allowed" % (n+1, c))
+
+def track_string(t):
+    # value of a JSON record -> track data, strings are latin-1 as for msrd
+    if t is None: return ""
+    if isinstance(t, unicode): return t.encode("latin-1")
+    return str(t)
+
+def read_records(f, format=None):
+    # yields (t1, t2, t3) for each record of the job file f, or the exception
+    # raised by a line that can't be read, so the record is counted as invalid
+    # format : "csv" or "jsonl", guessed from the file name if None
+    if format is None:
+        format = "jsonl" if getattr(f, "name", "").endswith((".jsonl", ".json")) else "csv"
+    if format == "jsonl":
+        for line in f:
+            line = line.strip()
+            if line == "": continue
+            try:
+                r = json.loads(line)
+                if isinstance(r, dict):
+                    r = [r.get("t1", ""), r.get("t2", ""), r.get("t3", "")]
+                yield tuple(track_string(t) for t in (list(r) + ["", "", ""])[0:3])
+            except (ValueError, TypeError) as e: # bad JSON, characters out of latin-1, not a record
+                yield Exception("bad record : %s" % e)
+    else:
+        first = True
+        for row in csv.reader(f):
+            if first and [c.strip().lower() for c in row] == ["t1", "t2", "t3"]:
+                first = False
+                continue
+            first = False
+            if not row: continue
+            yield tuple((row + ["", "", ""])[0:3])
+
+class card(object):
+    # a record of the job, ready to be written
+    def __init__(self, number, tracks):
+        self.number = number   # record number in the job file, from 1
+        self.tracks = tracks
+        self.command = None    # encoded write command
+        self.error = None      # set if the record is invalid
+
+def prepare(records, skip=0, raw=False, bpc=(8,8,8)):
+    # yields a card for each record, encoded for write_prepared
+    # skip : number of records already done
+    # raw : encode with pack_raw instead of the iso datablock
+    for number, tracks in enumerate(records, 1):
+        if number <= skip: continue
+        c = card(number, tracks)
+        try:
+            if isinstance(tracks, Exception): raise tracks
+            validate(*tracks)
+            if raw:
+                t1, t2, t3 = tracks
+                c.command = msr.msr.prepare_raw_tracks(
+                    msr.msr.pack_raw(t1, msr.msr.track1_map,  6, bpc[0]) if t1 else "",
+                    msr.msr.pack_raw(t2, msr.msr.track23_map, 4, bpc[1]) if t2 else "",
+                    msr.msr.pack_raw(t3, msr.msr.track23_map, 4, bpc[2]) if t3 else "")
+            else:
+                c.command = msr.msr.prepare_tracks(*tracks)
+        except Exception as e:
+            c.error = e
+        yield c
+
+def prefetch(cards, ahead=2):
+    # runs the cards generator in a background thread, up to ahead cards in advance
+    queue = Queue.Queue(ahead)
+    end = object()
+    def run():
+        try:
+            for c in cards: queue.put(c)
+        except Exception as e:
+            queue.put(e)
+        queue.put(end)
+    t = threading.Thread(target=run, name="msrbatch prefetch")
+    t.daemon = True
+    t.start()
+    while True:
+        c = queue.get()
+        if c is end: return
+        if isinstance(c, Exception): raise c
+        yield c
+
+class checkpoint(object):
+    # number of records done, kept on disk
+    def __init__(self, path):
+        self.path = path
+        self.done = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.done = int(f.read().strip() or 0)
+
+    def save(self, done):
+        self.done = done
+        if self.path is None: return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("%d\n" % done)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+def run(dev, records, ckpt, raw=False, bpc=(8,8,8), out=sys.stdout, ahead=2, attempts=None):
+    # writes a card per record, returns (written, invalid, failed) counts
+    # a failed write is retried on the same record, up to attempts swipes
+    # (write_attempts by default), then the record is failed; ^C stops the batch
+    # ahead : records validated and encoded in advance
+    if attempts is None: attempts = write_attempts
+    written = 0
+    invalid = 0
+    failed = 0
+    started = time.time()
+    if ckpt.done:
+        print >>out, "resuming after record %d" % ckpt.done
+    for c in prefetch(prepare(records, ckpt.done, raw, bpc), ahead):
+        if c.error is not None:
+            print >>out, "record %d skipped : %s" % (c.number, c.error)
+            invalid += 1
+            ckpt.save(c.number)
+            continue
+        for attempt in range(1, attempts+1):
+            print >>out, "[b] record %d : swipe card to write, ^C to stop" % c.number
+            try:
+                dev.write_prepared(c.command)
+                break
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                if attempt < attempts:
+                    print >>out, "record %d failed : %s, swipe again" % (c.number, e)
+                else:
+                    print >>out, "record %d failed %d times : %s, skipped" % (c.number, attempts, e)
+        else:
+            failed += 1
+            ckpt.save(c.number)
+            continue
+        ckpt.save(c.number)
+        written += 1
+        print >>out, "record %d written (%.1f cards/min)" % (c.number, written * 60.0 / (time.time() - started))
+    return written, invalid, failed
+
+def open_job(path):
+    if path == "-": return sys.stdin
+    return open(path, "rU")
+
+def job_records(path, format=None):
+    # records of a job file, or generated from a template file
+    import msrgen
+    if msrgen.is_template(path): return msrgen.load(path).records()
+    return read_records(open_job(path), format)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="write a card for each record of a job file")
+    parser.add_argument('-d', '--device', required=True, help="path to serial communication device")
+    parser.add_argument('-f', '--format', choices=["csv", "jsonl"], help="job file format, guessed from the file name by default")
+    parser.add_argument('-c', '--checkpoint', help="checkpoint file, <job>.checkpoint by default")
+    parser.add_argument('-0', '--raw', action="store_true", help="do not use ISO encoding")
+    parser.add_argument('-B', '--bpc', default="888", help="(raw only) bit per caracters for each track (5 to 8)")
+    parser.add_argument('-a', '--ahead', type=int, default=16, help="records encoded in advance")
+    parser.add_argument('-n', '--attempts', type=int, default=write_attempts, help="swipes tried on a record before it is skipped as failed")
+    parser.add_argument('job', help="job file, - for stdin, or card template (*.template.json)")
+    args = parser.parse_args()
+
+    ckpt_path = args.checkpoint
+    if ckpt_path is None and args.job != "-": ckpt_path = args.job + ".checkpoint"
+    bpc = [ord(c)-48 for c in args.bpc]
+
+    try:
+        dev = msr.msr(args.device)
+        if args.raw: dev.set_bpc(*bpc)
+        written, invalid, failed = run(dev, job_records(args.job, args.format), checkpoint(ckpt_path), args.raw, bpc,
+                                       ahead=args.ahead, attempts=args.attempts)
+        print "done : %d written, %d invalid records, %d failed" % (written, invalid, failed)
+    except KeyboardInterrupt:
+        print "stopped"
+    except Exception as e:
+        print e
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+#
+# File: msrbench.py
+# Licence: GNU GPL version 3
+#
+# End to end benchmark of the driver against the simulator (msrsim)
+#
+# Reports operations per second and p50/p99 latency for each driver command,
+# cards per second for the bulk modes of msrtool.py, and the time saved by
+# pipelined commands. A capture of a recycled card is replayed to check the
+# replay of pipelined commands.
+#
+
+import os
+import sys
+import time
+import tempfile
+import msr
+import msrsim
+import msrpool
+import msrcapture
+
+# card written and read by the benchmark
+T1 = "B4000001234567899^DOE/JOHN^25121010000000000000"
+T2 = "4000001234567899=25121010000000000"
+T3 = ""
+
+class result(object):
+    def __init__(self, name, latencies, count=None):
+        # latencies : seconds per operation
+        # count : number of operations if not one per latency (e.g. bulk modes)
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.total = sum(latencies)
+        self.count = len(latencies) if count is None else count
+
+    def rate(self):
+        return self.count / self.total if self.total else float("inf")
+
+    def percentile(self, p):
+        if not self.latencies: return 0.0
+        return self.latencies[min(len(self.latencies)-1, int(len(self.latencies) * p / 100.0))]
+
+    def __str__(self):
+        return "%-26s %10.1f ops/s   p50 %8.2f ms   p99 %8.2f ms" % \
+            (self.name, self.rate(), self.percentile(50)*1000, self.percentile(99)*1000)
+
+def measure(name, fnc, count):
+    latencies = []
+    for i in range(count):
+        t = time.time()
+        fnc()
+        latencies.append(time.time() - t)
+    return result(name, latencies)
+
+def bench_commands(dev, count):
+    dev.write_tracks(T1, T2, T3)
+    dev.write_raw_tracks("\x01\x02\x03", "\x04\x05", "\x06")
+    yield measure("reset", dev.reset, count)
+    yield measure("read_tracks", dev.read_tracks, count)
+    yield measure("read_raw_tracks", dev.read_raw_tracks, count)
+    yield measure("write_tracks", lambda: dev.write_tracks(T1, T2, T3), count)
+    yield measure("write_raw_tracks", lambda: dev.write_raw_tracks("\x01\x02\x03", "\x04\x05", "\x06"), count)
+    yield measure("erase_tracks", lambda: dev.erase_tracks(True, True, True), count)
+    # the configuration cache is invalidated to measure the device round-trips
+    yield measure("set_bpc", lambda: (dev.invalidate(), dev.set_bpc(8, 8, 8)), count)
+    yield measure("set_bpi", lambda: (dev.invalidate(), dev.set_bpi(True, True, True)), count)
+    yield measure("set_coercivity", lambda: (dev.invalidate(), dev.set_coercivity(msr.msr.hico)), count)
+    yield measure("set_bpc (cached)", lambda: dev.set_bpc(8, 8, 8), count)
+
+def bench_bulk(dev, count):
+    # same device calls as the bulk modes of msrtool.py
+    dev.write_tracks(T1, T2, T3)
+    yield measure("bulk read", dev.read_tracks, count)
+    yield measure("bulk write", lambda: dev.write_tracks(T1, T2, T3), count)
+    t1, t2, t3 = dev.read_tracks()
+    def compare():
+        b1, b2, b3 = dev.read_tracks()
+        if (b1, b2, b3) != (t1, t2, t3): raise Exception("compare failed")
+    yield measure("bulk compare", compare, count)
+    def copy():
+        dev.write_tracks(t1[1:-1], t2[1:-1])
+    yield measure("bulk copy", copy, count)
+    yield measure("bulk erase", lambda: dev.erase_tracks(True, True, True), count)
+
+def bench_pipeline(dev, count):
+    # time saved by sending commands back to back, and by recycling a card in one swipe
+    def configure():
+        dev.invalidate()
+        dev.configure(msr.msr.hico, (8, 8, 8), (True, True, True))
+    try:
+        for pipelining in (False, True):
+            dev.pipelining = pipelining
+            name = "pipelined" if pipelining else "sequential"
+            yield measure("configure, %s" % name, configure, count)
+            yield measure("recycle t1, %s" % name, lambda: dev.erase_and_write(T1, "", ""), count)
+    finally:
+        dev.pipelining = msr.msr.pipelining
+    yield measure("recycle, erase+write", lambda: (dev.erase_tracks(True, True, True), dev.write_tracks(T1, T2, "0")), count)
+    yield measure("recycle, erase_and_write", lambda: dev.erase_and_write(T1, T2, "0"), count)
+
+def check_replay(dev):
+    # captures a recycled card and a configuration, both pipelined, and replays them
+    # returns the replay errors
+    path = tempfile.mktemp(".cap")
+    try:
+        dev.pipelining = True
+        dev.capture = msrcapture.recorder(path)
+        try:
+            dev.erase_and_write(T1, "", "")
+            dev.erase_and_write_raw("\x01\x02\x03", "", "")
+            dev.invalidate()
+            dev.configure(msr.msr.hico, (8, 8, 8), (True, True, True))
+            dev.read_tracks()
+        finally:
+            dev.capture.close()
+            dev.capture = None
+            dev.pipelining = msr.msr.pipelining
+        captured = len(msrcapture.load(path))
+        results = msrcapture.replay(path, speed=0).run()
+    finally:
+        if os.path.exists(path): os.unlink(path)
+    errors = []
+    for command, result, seconds in results:
+        if isinstance(result, Exception): errors.append("%r : %s" % (command[0:1], result))
+        elif isinstance(result, list) and any(status != "0" for status, _ in result): errors.append("%r : %r" % (command[0:1], result))
+    if len(results) != captured: errors.append("%d commands replayed, %d captured" % (len(results), captured))
+    return errors
+
+def bench_pool(sims, count):
+    p = msrpool.pool([s.path for s in sims])
+    t = time.time()
+    for i in range(count): p.write(T1, T2, T3)
+    p.join()
+    elapsed = time.time() - t
+    p.close()
+    latencies = [j.duration() for j in p.jobs]
+    r = result("pool write x%d" % len(sims), latencies, count)
+    r.total = elapsed
+    return r
+
+def run(count=20, swipe_delay=0.0, baud=None, devices=4, out=sys.stdout):
+    msr.msr.state_file = None # keep the configuration cache and timing profiles of real devices out of it
+    msr.msr.profile_file = None
+    sims = [msrsim.simulator(swipe_delay, baud) for i in range(devices)]
+    results = []
+    try:
+        dev = msr.msr(sims[0].path)
+        print >>out, "driver commands (%d each, swipe %.2fs, baud %s)" % (count, swipe_delay, baud or "unlimited")
+        for r in bench_commands(dev, count):
+            print >>out, "  %s" % r
+            results.append(r)
+        print >>out, "bulk modes"
+        for r in bench_bulk(dev, count):
+            print >>out, "  %s" % r
+            results.append(r)
+        print >>out, "pipelining"
+        for r in bench_pipeline(dev, count):
+            print >>out, "  %s" % r
+            results.append(r)
+        errors = check_replay(dev)
+        for e in errors: print >>out, "  REPLAY FAILED %s" % e
+        print >>out, "  replay of a recycled card : %s" % ("%d errors" % len(errors) if errors else "OK")
+        dev.close()
+        if devices > 1:
+            r = bench_pool(sims, count * devices)
+            print >>out, "  %s" % r
+            results.append(r)
+    finally:
+        for s in sims: s.close()
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark the MSR605 driver against a simulated device")
+    parser.add_argument('-n', '--count', type=int, default=20, help="operations per measure")
+    parser.add_argument('-s', '--swipe', type=float, default=0.0, help="simulated swipe delay in seconds")
+    parser.add_argument('-b', '--baud', type=int, default=0, help="simulated line speed, 9600 for the real device, 0 for unlimited")
+    parser.add_argument('-d', '--devices', type=int, default=4, help="simulated devices for the pool benchmark")
+    args = parser.parse_args()
+    run(args.count, args.swipe, args.baud, args.devices)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python2
+#
+# File: msrcalibrate.py
+# Licence: GNU GPL version 3
+#
+# Timing calibration of a reader : measures how fast it answers, and keeps
+# a profile of the shortest safe waits for it
+#
+# The device is probed directly on the serial port, without the waits of the
+# driver : commands without swipe (get and set coercivity, set to the value
+# the device has) give the response latency and the gaps between bytes, reads
+# with a card swiped (optional) give the gaps of a whole datablock, and
+# commands sent at growing delays after a reset give the time the device
+# needs to take commands again. The waits derived from them, with a margin,
+# are kept for the device in profile_file (~/.msrtool/profiles.json). The
+# byte timeout is only kept when reads were measured : the gaps of short
+# responses say nothing of a datablock, the driver keeps its default then.
+# In the same way the response timeout only holds for the commands it was
+# measured on (get and set coercivity, listed in "measured"): setting the
+# bpc or bpi would change the device, the driver keeps its default for them.
+#
+#   {"/dev/ttyUSB0": {"baud": 9600, "settle_time": 0.015, "byte_timeout": 0.02,
+#                     "response_timeout": 0.05, "measured": "dxy", "swipe_timeout": 10, ...}}
+#
+# msr.msr and msrasync.async_msr use the profile of the device they open, by
+# the path given (e.g. /dev/serial/by-id/... to follow a unit across ports)
+# or its real path.
+#
+#   ./msrcalibrate.py /dev/ttyUSB0
+#   ./msrcalibrate.py --simulate --reset-time 0.03
+#
+
+import os
+import sys
+import json
+import time
+import serial
+import msr
+import msrparser
+
+ESC = msr.msr.escape_code
+
+# probes of each command, and trials of each delay after a reset
+samples = 20
+reset_trials = 5
+reset_delays = [0.0, 0.002, 0.005, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0]
+
+# margins over what was measured
+margin = 3.0        # timeouts : times the slowest response or gap
+settle_margin = 1.5 # settle time : times the shortest delay that always worked
+min_response_timeout = 0.05
+min_byte_bytes = 20 # byte timeout : at least the time of this many bytes on the line
+
+def stats(values):
+    # count, min, p50, p99 and max of values, in seconds
+    if not values: return {"count": 0}
+    v = sorted(values)
+    return {"count": len(v), "min": v[0], "p50": v[len(v) // 2],
+            "p99": v[min(len(v)-1, int(len(v) * 0.99))], "max": v[-1]}
+
+class probe(object):
+    # the serial port of the device, with timestamps of the responses
+    def __init__(self, dev_path, baud=msr.msr.baud):
+        self.port = serial.Serial(dev_path, baud, 8, serial.PARITY_NONE, timeout=0)
+
+    def close(self):
+        self.port.close()
+
+    def send(self, command):
+        self.port.write(ESC+command)
+        self.port.flush()
+
+    def command(self, command, timeout):
+        # sends command, waits up to timeout for each byte of the response
+        # returns (status, latency of the first byte, time to the last byte,
+        # largest gap between bytes), None if nothing came
+        self.port.flushInput()
+        response = msrparser.response(command)
+        sent = time.time()
+        self.send(command)
+        first = last = None
+        gap = 0.0
+        deadline = sent + timeout
+        while not response.complete:
+            remaining = deadline - time.time()
+            if remaining <= 0: break
+            self.port.timeout = remaining
+            chunk = self.port.read(max(1, self.port.inWaiting()))
+            if chunk == "": continue
+            now = time.time()
+            if first is None: first = now
+            else: gap = max(gap, now - last)
+            last = now
+            response.feed(chunk)
+            deadline = now + timeout
+        self.port.timeout = 0
+        if first is None: return None
+        try:
+            response.close()
+        except ValueError:
+            return None # no <ESC> status in what came
+        return response.status, first - sent, last - first, gap
+
+def calibrate(dev_path, baud=msr.msr.baud, count=samples, swipes=0, swipe_timeout=msr.msr.swipe_timeout,
+              prompt=None, out=sys.stdout):
+    # returns the profile of the device
+    # swipes : reads to measure, a card is swiped for each, prompt() is called before
+    p = probe(dev_path, baud)
+    latencies = {}
+    drains = []
+    gaps = []
+    try:
+        p.send("a")
+        time.sleep(1.0)
+        r = p.command("d", 2.0)
+        if r is None or r[0] not in "HL": raise Exception("calibrate : no answer from %s" % dev_path)
+        set_current = "x" if r[0] == "H" else "y"
+
+        for command in ("d", set_current):
+            latencies[command] = []
+            for i in range(count):
+                r = p.command(command, 2.0)
+                if r is None: raise Exception("calibrate : no answer to %s" % command)
+                latencies[command].append(r[1])
+                drains.append(r[2])
+                gaps.append(r[3])
+        slowest = max(max(l) for l in latencies.values()) + max(drains)
+        response_timeout = max(min_response_timeout, slowest * margin)
+
+        latencies["r"] = []
+        for i in range(swipes):
+            if prompt is not None: prompt(i)
+            r = p.command("r", swipe_timeout)
+            if r is None: raise Exception("calibrate : no card swiped")
+            latencies["r"].append(r[1])
+            drains.append(r[2])
+            gaps.append(r[3])
+        byte_timeout = None
+        if latencies["r"]: byte_timeout = max(min_byte_bytes * 10.0 / baud, max(gaps) * margin)
+
+        # shortest delay after a reset for which every trial is answered
+        # a lost command is waited for response_timeout, the device gets time to recover after it
+        reset = []
+        settle_time = None
+        for delay in reset_delays:
+            ok = 0
+            for i in range(reset_trials):
+                p.send("a")
+                time.sleep(delay)
+                r = p.command("d", response_timeout)
+                if r is None or r[0] not in "HL":
+                    time.sleep(reset_delays[-1])
+                    break
+                ok += 1
+            reset.append((delay, ok))
+            if ok == reset_trials:
+                settle_time = delay * settle_margin
+                break
+        if settle_time is None: raise Exception("calibrate : the device doesn't answer after a reset")
+    finally:
+        p.close()
+
+    profile = {"baud": baud,
+               "settle_time": round(settle_time, 4),
+               "response_timeout": round(response_timeout, 4),
+               "measured": "dxy", # x and y are the same command, one is probed
+               "swipe_timeout": swipe_timeout,
+               "calibrated": time.time(),
+               "latency": dict((c, stats(l)) for c, l in latencies.items() if l),
+               "drain": stats(drains),
+               "gap": stats(gaps),
+               "reset": reset}
+    if byte_timeout is not None: profile["byte_timeout"] = round(byte_timeout, 4)
+    report(profile, out)
+    return profile
+
+def report(profile, out=sys.stdout):
+    def ms(s, name):
+        return "%8.2f ms" % (s[name] * 1000) if name in s else "       - ms"
+    print >>out, "%-18s %6s %11s %11s %11s" % ("", "count", "p50", "p99", "max")
+    rows = [("latency %s" % c, s) for c, s in sorted(profile["latency"].items())]
+    rows += [("drain", profile["drain"]), ("gap", profile["gap"])]
+    for name, s in rows:
+        print >>out, "%-18s %6d %s %s %s" % (name, s["count"], ms(s, "p50"), ms(s, "p99"), ms(s, "max"))
+    print >>out, "after reset        %s" % ", ".join("%gms %d/%d" % (d * 1000, ok, reset_trials) for d, ok in profile["reset"])
+    for key in msr.msr.profile_keys:
+        if key == "response_timeout" and key in profile:
+            print >>out, "%-18s %s for %s, default %s kept for the others" % (key, profile[key],
+                ", ".join(profile.get("measured", "dxy")), getattr(msr.msr, key))
+        elif key in profile:
+            print >>out, "%-18s %s (default %s)" % (key, profile[key], getattr(msr.msr, key))
+        else:
+            print >>out, "%-18s default %s kept, no read measured (--swipes)" % (key, getattr(msr.msr, key))
+
+def save(dev_path, profile):
+    # keeps profile for dev_path in profile_file
+    path = msr.msr.profile_file
+    profiles = msr.msr.load_profiles()
+    profiles[dev_path] = profile
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory): os.makedirs(directory)
+    tmp = path + ".%d" % os.getpid()
+    with open(tmp, "w") as f:
+        json.dump(profiles, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+def remove(dev_path):
+    # forgets the profile of dev_path, False if it had none
+    profiles = msr.msr.load_profiles()
+    if dev_path not in profiles: return False
+    del profiles[dev_path]
+    tmp = msr.msr.profile_file + ".%d" % os.getpid()
+    with open(tmp, "w") as f:
+        json.dump(profiles, f, indent=1, sort_keys=True)
+    os.rename(tmp, msr.msr.profile_file)
+    return True
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="measure the response times of a reader and keep its timing profile")
+    parser.add_argument('-n', '--samples', type=int, default=samples, help="probes of each command")
+    parser.add_argument('-w', '--swipes', type=int, default=0, help="cards to swipe to measure reads")
+    parser.add_argument('-t', '--swipe-timeout', type=float, default=msr.msr.swipe_timeout, help="seconds to wait for a swipe, kept in the profile")
+    parser.add_argument('-b', '--baud', type=int, default=msr.msr.baud, help="line speed")
+    parser.add_argument('-d', '--dry-run', action="store_true", help="don't save the profile")
+    parser.add_argument('-D', '--delete', action="store_true", help="forget the profile of the device")
+    parser.add_argument('-S', '--simulate', action="store_true", help="calibrate a simulated device (see msrsim.py), not saved")
+    parser.add_argument('-r', '--reset-time', type=float, default=0.02, help="reset time of the simulated device")
+    parser.add_argument('device', nargs="?", help="serial device")
+    args = parser.parse_args()
+
+    sim = None
+    if args.simulate:
+        import msrsim
+        sim = msrsim.simulator(swipe_delay=0.1, baud=args.baud, reset_time=args.reset_time,
+                               content=msrsim.card("B4000001234567899^DOE/JOHN^2512101", "4000001234567899=2512101"))
+        args.device, args.dry_run = sim.path, True
+    elif args.device is None:
+        parser.error("no device given")
+    elif args.device.find("/") == -1:
+        args.device = "/dev/" + args.device
+
+    try:
+        if args.delete:
+            print "%s : %s" % (args.device, "profile removed" if remove(args.device) else "no profile")
+            sys.exit(0)
+        def prompt(i):
+            if sim is None: print "swipe card %d/%d" % (i+1, args.swipes)
+        try:
+            profile = calibrate(args.device, args.baud, args.samples, args.swipes, args.swipe_timeout, prompt)
+        except Exception as e:
+            print >>sys.stderr, e
+            sys.exit(1)
+        if not args.dry_run:
+            save(args.device, profile)
+            print "profile of %s saved to %s" % (args.device, msr.msr.profile_file)
+    finally:
+        if sim is not None: sim.close()
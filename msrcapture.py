@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+#
+# File: msrcapture.py
+# Licence: GNU GPL version 3
+#
+# Capture of the serial traffic of the driver, and replay without hardware
+#
+# A recorder set on the driver logs every command written and every chunk
+# read back, with its time and the number of the command it belongs to:
+#
+#   dev.capture = msrcapture.recorder("session.cap")
+#
+# A replay device is a msr.msr fed by such a log instead of a serial port:
+# the commands sent by the driver are checked against the recorded ones and
+# the recorded responses come back at their original pace, or faster.
+#
+#   dev = msrcapture.replay("session.cap", speed=10)
+#   dev.read_tracks()
+#
+# Log format : "MSRCAP1\n" then records of a 17 bytes header, big endian,
+# kind ("W" written, "R" read), command number (uint32), time (double),
+# data length (uint32), followed by the data.
+#
+
+import os
+import sys
+import time
+import struct
+import threading
+import msr
+
+magic = "MSRCAP1\n"
+header = struct.Struct(">cIdI")
+
+class recorder(object):
+    def __init__(self, path):
+        # appends to path if it is already a capture log
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if new: self.file.write(magic)
+        self.commands = 0
+        self.__lock = threading.Lock()
+
+    def __record(self, kind, data):
+        with self.__lock:
+            self.file.write(header.pack(kind, self.commands, time.time(), len(data)) + data)
+
+    def written(self, data):
+        # a new command, data : bytes sent to the device
+        self.commands += 1
+        self.__record("W", data)
+
+    def received(self, data):
+        # a chunk of the response to the last command
+        self.__record("R", data)
+        self.file.flush() # the log is complete up to the last response, even after a crash
+
+    def close(self):
+        self.file.close()
+
+def read_log(path):
+    # yields (kind, command number, time, data) for each record of the log
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise Exception("%s is not a capture log" % path)
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size: return # end, or truncated by a crash
+            kind, command, t, length = header.unpack(head)
+            data = f.read(length)
+            if len(data) < length: return
+            yield kind, command, t, data
+
+class exchange(object):
+    # a recorded command and its response
+    def __init__(self, number, sent_at, data):
+        self.number = number
+        self.sent_at = sent_at
+        self.data = data
+        self.chunks = [] # (seconds after the command, data)
+
+def load(path):
+    # returns the exchanges of the log, in order
+    exchanges = []
+    for kind, number, t, data in read_log(path):
+        if kind == "W":
+            exchanges.append(exchange(number, t, data))
+        elif exchanges and exchanges[-1].number == number:
+            exchanges[-1].chunks.append((t - exchanges[-1].sent_at, data))
+    return exchanges
+
+# length of the commands after <ESC>, others are one character
+command_lengths = {"c": 2, "b": 2, "o": 4}
+
+def split_commands(data):
+    # commands (without <ESC>) of a written record, several for a pipeline
+    # (configure, erase_and_write). A write only comes last in a pipeline,
+    # it takes the rest of the record.
+    commands = []
+    pos = 0
+    while pos < len(data):
+        if data[pos] != msr.msr.escape_code or pos+1 >= len(data):
+            raise Exception("replay : bad command %r" % data)
+        c = data[pos+1]
+        end = len(data) if c in "wn" else pos+1+command_lengths.get(c, 1)
+        commands.append(data[pos+1:end])
+        pos = end
+    return commands
+
+class replay(msr.msr):
+    # the driver on top of a capture log instead of a serial port
+    timeout = 0
+    port = None
+    state_file = None # the configuration of the captured device is left alone
+    pipelining = True # a record of several commands was sent back to back
+
+    def __init__(self, path, speed=1.0):
+        # speed : 1 for the recorded pace, 10 for ten times faster, 0 for no delay at all
+        self.port = path
+        self.speed = speed
+        self.exchanges = load(path)
+        self.position = 0    # next exchange
+        self.__chunks = []   # (due time, data) of the response being replayed
+        self.config = {"coercivity": None, "bpc": [None, None, None], "bpi": [None, None, None]}
+        self._msr__ready_at = 0
+
+    # serial port interface used by msr.msr
+
+    def write(self, data):
+        if self.position >= len(self.exchanges):
+            raise Exception("replay : command %r after the end of the capture" % data)
+        e = self.exchanges[self.position]
+        if e.data != data:
+            raise Exception("replay : command %d is %r, expected %r" % (e.number, data, e.data))
+        self.position += 1
+        now = time.time()
+        if self.speed:
+            self.__chunks = [(now + delay / self.speed, chunk) for delay, chunk in e.chunks]
+        else:
+            self.__chunks = [(now, chunk) for delay, chunk in e.chunks]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def inWaiting(self):
+        now = time.time()
+        return sum(len(chunk) for due, chunk in self.__chunks if due <= now)
+
+    def read(self, size=1):
+        # recorded data as it is due, waiting up to timeout for it
+        deadline = time.time() + (self.timeout or 0)
+        data = ""
+        while len(data) < size:
+            if not self.__chunks:
+                # nothing more will come, as for the recorded device
+                if not data: time.sleep(max(0, deadline - time.time()))
+                break
+            due, chunk = self.__chunks[0]
+            now = time.time()
+            if due > now:
+                if data: break
+                if due > deadline:
+                    time.sleep(max(0, deadline - now))
+                    break
+                time.sleep(due - now)
+            take = chunk[0:size-len(data)]
+            data += take
+            if len(take) < len(chunk): self.__chunks[0] = (due, chunk[len(take):])
+            else: self.__chunks.pop(0)
+        return data
+
+    def close(self):
+        pass
+
+    # replays the capture through the public commands
+
+    def run(self, out=None):
+        # sends every remaining recorded command as the driver would
+        # returns [(command, result or exception, seconds)]
+        results = []
+        while self.position < len(self.exchanges):
+            position = self.position
+            data = self.exchanges[position].data
+            started = time.time()
+            try:
+                result = self.__replay_command(data[1:])
+            except Exception as e:
+                result = e
+                # the command didn't match the capture : skip its exchange
+                if self.position == position: self.position += 1
+            results.append((data[1:], result, time.time() - started))
+            if out is not None:
+                print >>out, "%-6r %8.1f ms  %r" % (data[1:2], results[-1][2]*1000, result)
+        return results
+
+    def __replay_command(self, command):
+        commands = split_commands(msr.msr.escape_code+command)
+        if len(commands) > 1:
+            # pipelined commands are sent back together
+            return [(status, result) for status, result, _ in self._msr__execute_pipeline(commands)]
+        if command == "a": return self.reset()
+        if command == "r": return self.read_tracks()
+        if command == "m": return self.read_raw_tracks()
+        if command[0] in "wn": return self.write_prepared(command)
+        if command[0] == "c":
+            mask = ord(command[1])
+            return self.erase_tracks(mask & 1, mask & 2, mask & 4)
+        if command[0] == "o":
+            self.config["bpc"] = [None, None, None]
+            return self.set_bpc(*[ord(c) for c in command[1:4]])
+        if command == "x" or command == "y":
+            self.config["coercivity"] = None
+            return self.set_coercivity(command == "x")
+        if command == "d": return self.get_coercivity()
+        # no public command sends it alone (e.g. set_bpi of a single track)
+        status, result, _ = self._msr__execute_waitresult(command)
+        return status, result
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="show or replay a capture log of the MSR605 traffic (see msr.py --capture)")
+    parser.add_argument('-s', '--speed', type=float, default=0, help="(replay) 1 for the recorded pace, 0 for no delay")
+    parser.add_argument('action', choices=["show", "replay"])
+    parser.add_argument('log', help="capture log")
+    args = parser.parse_args()
+
+    try:
+        if args.action == "show":
+            start = None
+            for kind, number, t, data in read_log(args.log):
+                if start is None: start = t
+                print "%10.3f %5d %s %r" % (t - start, number, kind, data)
+        else:
+            dev = replay(args.log, args.speed)
+            results = dev.run(sys.stdout)
+            errors = len([r for r in results if isinstance(r[1], Exception)])
+            print "%d commands replayed in %.1f ms, %d errors" % (len(results), sum(r[2] for r in results)*1000, errors)
+            if errors: sys.exit(1)
+    except Exception as e:
+        print e
+        sys.exit(1)
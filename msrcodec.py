@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# File: msrcodec.py
+# Licence: GNU GPL version 3
+#
+# Table driven engine behind msr.pack_raw and msr.unpack_raw
+#
+# All the per character work (mapping lookup, parity, bit reversal) is
+# precomputed once per (mapping, bcount_code, bcount_output) combination,
+# so packing and unpacking a track is a few joins and table lookups.
+# Raw data can be given as str, bytearray or memoryview.
+#
+
+import operator
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+parity_map  = [1,0,0,1,0,1,1,0,0,1,1,0,1,0,0,1,0,1,1,0,1,0,0,1,1,0,0,1,0,1,1,0, \
+               0,1,1,0,1,0,0,1,1,0,0,1,0,1,1,0,1,0,0,1,0,1,1,0,0,1,1,0,1,0,0,1]
+              # 1 = count of 1 in index is even, 0 = odd
+rev6bit_map = [0,32,16,48,8,40,24,56,4,36,20,52,12,44,28,60,2,34,18,50,10,42,26,58,6,38,22,54,14,46,30,62, \
+               1,33,17,49,9,41,25,57,5,37,21,53,13,45,29,61,3,35,19,51,11,43,27,59,7,39,23,55,15,47,31,63]
+              # give the reverse bitmap (6 bits) of a the index
+
+class codec(object):
+    # mapping : string used to convert a character to a code
+    # bcount_code : number of bits of character code (without the parity bit)
+    # bcount_output : number of bits per output characters
+    #
+    # internally a "value" is a code with its parity bit, as read on the
+    # track (msb first, parity last), stored one per character so whole
+    # tracks can be converted with str.translate
+    def __init__(self, mapping, bcount_code, bcount_output):
+        self.mapping = mapping
+        self.bcount_code = bcount_code
+        self.bcount_output = bcount_output
+        width = bcount_code+1
+        mask = (1<<bcount_output)-1
+
+        # pack : character -> code with parity bit in front, as a character
+        symbols = [chr(0 | parity_map[0] << bcount_code)]*256 # fail to first code if char is not allowed
+        codes = ["\0"]*256
+        for i in reversed(range(len(mapping))):
+            symbols[ord(mapping[i])] = chr(i | parity_map[i] << bcount_code)
+            codes[ord(mapping[i])] = chr(i)
+        self.symbol_table = "".join(symbols)
+        self.code_table = "".join(codes)
+        # code with parity -> bits, lsb first
+        self.bits_of = [bin(i)[2:].zfill(width)[::-1] for i in range(1<<width)]
+        # bits, lsb first -> output character
+        self.char_of = {}
+        for n in range(1<<bcount_output):
+            self.char_of[bin(n)[2:].zfill(bcount_output)[::-1]] = chr(n)
+        self.split_output = re.compile("[01]{%d}" % bcount_output).findall
+
+        # unpack : input character -> bits, msb first
+        self.input_bits = [bin(n & mask)[2:].zfill(bcount_output) for n in range(256)]
+        self.input_table = "".join([chr(n & mask) for n in range(256)])
+        self.split_values = re.compile("[01]{%d}" % width).findall
+        self.value_of = dict((bin(n)[2:].zfill(width), chr(n)) for n in range(1<<width))
+        # value -> character, code, parity error
+        data = ["\0"]*256
+        codes = ["\0"]*256
+        perrs = [" "]*256
+        self.unmapped = ""
+        for n in range(1<<width):
+            i = rev6bit_map[n>>1] >> (6-bcount_code) # reverse bits (assume bcount_code<=6)
+            if i < len(mapping):
+                data[n] = mapping[i]
+            else:
+                self.unmapped += chr(n)
+            codes[n] = chr(i)
+            perrs[n] = " " if parity_map[i] == n & 0x1 else "^"
+        self.data_table = "".join(data)
+        self.value_code_table = "".join(codes)
+        self.perr_table = "".join(perrs)
+
+    def pack(self, data):
+        # data : string to be encoded
+        bcount_code = self.bcount_code
+        bcount_output = self.bcount_output
+        if bcount_output < bcount_code+1:
+            # at most one output character per code : keep the historical behaviour
+            return self.__pack_loop(data)
+        if not data:
+            # no last code for the parity of the LRC : fails as it always did
+            return self.__pack_loop(data)
+        symbols = bytearray(data.translate(self.symbol_table))
+        lrc = reduce(operator.xor, bytearray(data.translate(self.code_table)), 0) # parity odd
+        lrc |= parity_map[symbols[-1]] << bcount_code
+        if bcount_output == bcount_code+1:
+            # one output character per code
+            return str(symbols) + chr(lrc)
+        bits = "".join(map(self.bits_of.__getitem__, symbols)) + self.bits_of[lrc]
+        # add remaining bits, filling with 0
+        bits += "0" * (-len(bits) % bcount_output)
+        return "".join(map(self.char_of.__getitem__, self.split_output(bits)))
+
+    def __pack_loop(self, data):
+        bcount_code = self.bcount_code
+        bcount_output = self.bcount_output
+        raw = ""
+        lrc = 0       # parity odd
+        rem_bits = 0  # remaining bits from previous loop
+        rem_count = 0 # count of remaining bits
+        for c in data:
+            i = ord(self.symbol_table[ord(c)])
+            lrc ^= ord(self.code_table[ord(c)])
+            rem_bits |= i << rem_count
+            rem_count += bcount_code+1
+            if rem_count >= bcount_output:
+                raw += chr(rem_bits & ((1<<bcount_output)-1))
+                rem_bits >>= bcount_output
+                rem_count -= bcount_output
+        lrc |= parity_map[i] << bcount_code
+        rem_bits |= lrc << rem_count
+        rem_count += bcount_code+1
+        if rem_count >= bcount_output:
+            raw += chr(rem_bits & ((1<<bcount_output)-1))
+            rem_bits >>= bcount_output
+            rem_count -= bcount_output
+        if rem_count > 0:
+            raw += chr(rem_bits)
+        return raw
+
+    def values(self, raw):
+        # raw : str, bytearray or memoryview read from the device
+        # returns : the values found in raw, one per character
+        if self.bcount_output == self.bcount_code+1:
+            # one value per input character
+            return str(bytearray(raw)).translate(self.input_table)
+        bits = "".join(map(self.input_bits.__getitem__, bytearray(raw)))
+        return "".join(map(self.value_of.__getitem__, self.split_values(bits)))
+
+    def unpack(self, raw):
+        # raw : str, bytearray or memoryview read from the device
+        # returns : data without trailing nulls, total length including trailing nulls, parity errors, lrc error
+        values = self.values(raw)
+        if self.unmapped and values.translate(None, self.unmapped) != values:
+            raise IndexError("string index out of range")
+        codes = values.translate(self.value_code_table)
+        lrc = reduce(operator.xor, bytearray(codes), 0) # check LRC (kept at the end of decoded data)
+        end = len(codes.rstrip("\0"))
+        values = values[0:end]
+        return values.translate(self.data_table), len(codes), values.translate(self.perr_table), lrc != 0
+
+    def unpack_many(self, raws, use_numpy=None):
+        # decodes several raw tracks at once, returns a list of unpack() results
+        # use_numpy : None to use numpy when it is installed
+        if use_numpy is None: use_numpy = numpy is not None
+        if not use_numpy or self.unmapped:
+            return [self.unpack(raw) for raw in raws]
+        return self.__unpack_numpy(raws)
+
+    def __unpack_numpy(self, raws):
+        width = self.bcount_code+1
+        bcount_output = self.bcount_output
+        raws = [bytearray(raw) for raw in raws]
+        if not hasattr(self, "_np_tables"):
+            byte_bits = (numpy.arange(256)[:,None] >> numpy.arange(bcount_output-1, -1, -1)) & 1
+            self._np_tables = (numpy.frombuffer(self.value_code_table, dtype=numpy.uint8),
+                               numpy.frombuffer(self.data_table, dtype=numpy.uint8),
+                               numpy.frombuffer(self.perr_table, dtype=numpy.uint8),
+                               byte_bits.astype(numpy.uint8))
+        codes_of, data_of, perrs_of, byte_bits = self._np_tables
+
+        # bits of every track one after the other, and where each value starts
+        lengths = numpy.array([len(raw) for raw in raws], dtype=numpy.int64)
+        counts = lengths*bcount_output // width
+        flat = numpy.frombuffer(bytes(bytearray().join(raws)), dtype=numpy.uint8)
+        bits = byte_bits[flat].ravel()
+        starts = numpy.repeat(numpy.cumsum(lengths)-lengths, counts)*bcount_output
+        starts += (numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts)-counts, counts))*width
+        weights = 1 << numpy.arange(width-1, -1, -1)
+        values = (bits[starts[:,None] + numpy.arange(width)] * weights).sum(axis=1)
+        codes = codes_of[values]
+        data = data_of[values].tobytes()
+        perrs = perrs_of[values].tobytes()
+
+        results = []
+        first = 0
+        for count in counts:
+            last = first+count
+            nonnull = numpy.flatnonzero(codes[first:last])
+            end = nonnull[-1]+1 if len(nonnull) else 0
+            lrc = int(numpy.bitwise_xor.reduce(codes[first:last])) if count else 0
+            results.append((data[first:first+end], int(count), perrs[first:first+end], lrc != 0))
+            first = last
+        return results
+
+_codecs = {}
+
+def get_codec(mapping, bcount_code, bcount_output):
+    # codecs are cached, tables are only built once per combination
+    key = (mapping, bcount_code, bcount_output)
+    c = _codecs.get(key)
+    if c is None:
+        c = _codecs[key] = codec(mapping, bcount_code, bcount_output)
+    return c
+
+def pack_raw(data, mapping, bcount_code, bcount_output):
+    return get_codec(mapping, bcount_code, bcount_output).pack(data)
+
+def unpack_raw(raw, mapping, bcount_code, bcount_output):
+    return get_codec(mapping, bcount_code, bcount_output).unpack(raw)
+
+def unpack_many(raws, mapping, bcount_code, bcount_output, use_numpy=None):
+    return get_codec(mapping, bcount_code, bcount_output).unpack_many(raws, use_numpy)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python2
+#
+# File: msrcodecbench.py
+# Licence: GNU GPL version 3
+#
+# Micro-benchmark and round-trip checks of the codec and the datablock framing
+#
+# pack_raw and unpack_raw are timed for both character codes (track 1 map on
+# 6 bits, track 2/3 map on 4 bits), every bpc from 5 to 8 and several
+# payload sizes; the ISO and raw datablocks are encoded and decoded for the
+# same sizes. Before timing, properties are checked on random payloads :
+# pack_raw gives the bytes it always gave, unpack_raw gives back the data
+# and LRC of a track built bit by bit as it reads them, without errors, a
+# bit flipped on the track gives a parity error on its character (and an
+# LRC error if it is a code bit), decode(encode(tracks)) gives the tracks
+# back, a batch of msrrecords gives its tracks back and refuses appends to
+# its slices. pack_raw and unpack_raw don't order the bits of a byte the
+# same way : unpack_raw(pack_raw(data)) giving data back is checked as an
+# expected failure, reported on every run (and a failure once it holds).
+#
+# Results can be saved as a baseline, and compared with it : a throughput
+# lower than the baseline by more than the threshold is a regression, and
+# the exit status is 1, as for a failed check.
+#
+#   ./msrcodecbench.py --save baseline.json
+#   ./msrcodecbench.py --baseline baseline.json --threshold 0.2
+#
+
+import sys
+import json
+import time
+import random
+import msr
+import msrcodec
+import msrparser
+import msrrecords
+
+codes = [("track1", msr.msr.track1_map, 6), ("track23", msr.msr.track23_map, 4)]
+bpcs = [5, 6, 7, 8]
+sizes = [8, 37, 76]
+
+# seconds each measure runs for, and rounds over every measure, the best is kept
+min_time = 0.05
+repeat = 5
+
+encode_iso = msr.msr._msr__encode_isodatablock
+encode_raw = msr.msr._msr__encode_rawdatablock
+decode_iso = msrparser.decode_isodatablock
+decode_raw = msrparser.decode_rawdatablock
+
+def payload(mapping, size, rnd):
+    # random data of size characters of mapping, without ISO sentinels
+    chars = mapping.replace("%", "").replace(";", "").replace("?", "")
+    return "".join(rnd.choice(chars) for i in range(size))
+
+# round-trip checks, each returns a list of failures
+
+def codes_of(data, mapping):
+    # codes of data and of its LRC, characters not in mapping fail to the first code
+    codes = [max(mapping.find(c), 0) for c in data]
+    codes.append(reduce(lambda a, b: a ^ b, codes, 0))
+    return codes
+
+def expected(data, mapping):
+    # what unpack gives for data with its LRC : data, LRC character, trailing nulls stripped
+    codes = codes_of(data, mapping)
+    while codes and codes[-1] == 0: codes.pop()
+    return "".join(mapping[i] for i in codes)
+
+def track(data, mapping, bcount_code, bpc):
+    # raw track as unpack_raw reads it : bits of each code lsb first, then its
+    # parity bit (odd parity), cut in characters of bpc bits, msb first
+    bits = ""
+    for i in codes_of(data, mapping):
+        bits += bin(i)[2:].zfill(bcount_code)[::-1] + str(msrcodec.parity_map[i])
+    bits += "0" * (-len(bits) % bpc)
+    return "".join(chr(int(bits[j:j+bpc], 2)) for j in range(0, len(bits), bpc))
+
+def historical_pack(data, mapping, bcount_code, bpc):
+    # pack_raw as written bit by bit in msr.py before the codec tables, errors
+    # included : the parity of the LRC is looked up for the last code with its
+    # parity bit (an IndexError past the table), and there is none for empty
+    # data (a NameError)
+    raw = ""
+    lrc = 0
+    rem_bits = 0
+    rem_count = 0
+    for c in data:
+        i = mapping.find(c)
+        if i == -1: i = 0
+        lrc ^= i
+        i |= msrcodec.parity_map[i] << bcount_code
+        rem_bits |= i << rem_count
+        rem_count += bcount_code+1
+        if rem_count >= bpc:
+            raw += chr(rem_bits & ((1<<bpc)-1))
+            rem_bits >>= bpc
+            rem_count -= bpc
+    lrc |= msrcodec.parity_map[i] << bcount_code
+    rem_bits |= lrc << rem_count
+    rem_count += bcount_code+1
+    if rem_count >= bpc:
+        raw += chr(rem_bits & ((1<<bpc)-1))
+        rem_bits >>= bpc
+        rem_count -= bpc
+    if rem_count > 0: raw += chr(rem_bits)
+    return raw
+
+def outcome(fnc, *args):
+    # result of fnc, or the class of the exception it raised
+    try:
+        return fnc(*args)
+    except Exception as e:
+        return e.__class__
+
+def check_codec(rnd, count=50):
+    failures = []
+    def unpack(raw, mapping, bcount_code, bpc):
+        try:
+            return msrcodec.unpack_raw(raw, mapping, bcount_code, bpc)
+        except Exception as e:
+            return (e, 0, "", True)
+    for name, mapping, bcount_code in codes:
+        width = bcount_code+1
+        for bpc in bpcs:
+            for i in range(count):
+                data = payload(mapping, rnd.randint(0 if i == 0 else 1, 40), rnd)
+                got = outcome(msrcodec.pack_raw, data, mapping, bcount_code, bpc)
+                historical = outcome(historical_pack, data, mapping, bcount_code, bpc)
+                if got != historical:
+                    failures.append("%s %d bpc : pack(%r) = %r, expected %r" % (name, bpc, data, got, historical))
+                if not data: continue
+                raw = track(data, mapping, bcount_code, bpc)
+                result, length, perr, lrc_error = unpack(raw, mapping, bcount_code, bpc)
+                if result != expected(data, mapping) or perr.find("^") != -1 or lrc_error:
+                    failures.append("%s %d bpc : unpack(%r) = %r" % (name, bpc, data, (result, length, perr, lrc_error)))
+                    continue
+                # flip a bit of a character of data
+                bits = "".join(bin(ord(c) & ((1<<bpc)-1))[2:].zfill(bpc) for c in raw)
+                k = rnd.randrange(len(data) * width)
+                bits = bits[0:k] + "10"[int(bits[k])] + bits[k+1:]
+                damaged = "".join(chr(int(bits[j:j+bpc], 2)) for j in range(0, len(bits), bpc))
+                result, length, perr, lrc_error = unpack(damaged, mapping, bcount_code, bpc)
+                parity_bit = k % width == bcount_code
+                tail = codes_of(data, mapping)[k // width:]
+                if not parity_bit: tail[0] ^= 1 << (k % width) # code bits are lsb first on the track
+                if not any(tail): continue # the character is now a trailing null, stripped as blank
+                if k // width >= len(perr) or perr[k // width] != "^" or lrc_error == parity_bit:
+                    failures.append("%s %d bpc : bit %d of %r flipped, got %r" % (name, bpc, k, data, (result, length, perr, lrc_error)))
+    return failures
+
+def check_identity(rnd, count=50):
+    # unpack_raw(pack_raw(data)) gives data and its LRC back : an expected
+    # failure, pack_raw puts the bits of a character lsb first in the bytes
+    # and unpack_raw reads them msb first
+    # returns (payloads for which it holds, payloads packed)
+    held = packed = 0
+    for name, mapping, bcount_code in codes:
+        for bpc in bpcs:
+            if bpc < bcount_code+1: continue # pack_raw can't pack long tracks on fewer bits
+            for i in range(count):
+                data = payload(mapping, rnd.randint(1, 40), rnd)
+                raw = outcome(msrcodec.pack_raw, data, mapping, bcount_code, bpc)
+                if isinstance(raw, type): continue # the LRC parity error of pack_raw
+                packed += 1
+                if outcome(msrcodec.unpack_raw, raw, mapping, bcount_code, bpc)[0] == expected(data, mapping): held += 1
+    return held, packed
+
+def check_framing(rnd, count=50):
+    failures = []
+    # the device answers <ESC>+ for a blank track, a write leaves it empty, so
+    # tracks aren't blank here; blank tracks are left out of raw datablocks
+    def roundtrip(name, encode, decode, tracks):
+        try:
+            got = decode(encode(*tracks))
+        except Exception as e:
+            got = e
+        if got != tuple(tracks):
+            failures.append("%s datablock : decode(encode(%r)) = %r" % (name, tracks, got))
+    for i in range(count):
+        roundtrip("iso", encode_iso, decode_iso,
+                  [payload(m, rnd.randint(1, 40), rnd) for m in (msr.msr.track1_map, msr.msr.track23_map, msr.msr.track23_map)])
+        roundtrip("raw", encode_raw, decode_raw,
+                  ["".join(chr(rnd.randrange(256)) for j in range(rnd.randint(1, 100))) for n in range(3)])
+    return failures
+
+def check_records(rnd, count=20):
+    # a batch of msrrecords gives back the tracks appended to it, and its
+    # slices share its buffers : appending to one must fail, not extend them
+    failures = []
+    tracks = [None if i % 7 == 3 else msrcodec.unpack_raw(track(payload(msr.msr.track1_map, rnd.randint(1, 40), rnd),
+              msr.msr.track1_map, 6, 7), msr.msr.track1_map, 6, 7) for i in range(count)]
+    b = msrrecords.batch(tracks)
+    if list(b.tuples()) != tracks: failures.append("batch : tuples differ from the tracks appended")
+    for view in (b[5:], b[0:], b[2:4]):
+        try:
+            view.append(tracks[0])
+            failures.append("batch : append to the slice [%d:%d] didn't fail" % (view.start, view.stop))
+        except Exception:
+            pass
+    try:
+        b.append(tracks[1])
+    except Exception as e:
+        failures.append("batch : append after a slice failed : %s" % e)
+    if list(b.tuples()) != tracks + [tracks[1]]: failures.append("batch : tuples differ after appending to slices")
+    return failures
+
+def check(seed=0):
+    rnd = random.Random(seed)
+    return check_codec(rnd) + check_framing(rnd) + check_records(rnd)
+
+# benchmarks
+
+def measure(fnc, args):
+    # operations per second over min_time
+    count = 0
+    started = time.time()
+    while True:
+        for i in range(10): fnc(*args)
+        count += 10
+        elapsed = time.time() - started
+        if elapsed >= min_time: return count / elapsed
+
+def cases(rnd):
+    # (name, function, args) of each measure
+    for size in sizes:
+        for name, mapping, bcount_code in codes:
+            data = payload(mapping, size, rnd)
+            for bpc in bpcs:
+                raw = track(data, mapping, bcount_code, bpc)
+                if bpc >= bcount_code+1: # pack_raw can't pack long tracks on fewer bits
+                    yield ("pack_raw %s %dbpc %d" % (name, bpc, size), msrcodec.pack_raw, (data, mapping, bcount_code, bpc))
+                yield ("unpack_raw %s %dbpc %d" % (name, bpc, size), msrcodec.unpack_raw, (raw, mapping, bcount_code, bpc))
+        tracks = [payload(m, size, rnd) for m in (msr.msr.track1_map, msr.msr.track23_map, msr.msr.track23_map)]
+        block = encode_iso(*tracks)
+        yield ("encode_isodatablock %d" % size, encode_iso, tracks)
+        yield ("decode_isodatablock %d" % size, decode_iso, (block,))
+        raws = ["".join(chr(rnd.randrange(256)) for j in range(size)) for n in range(3)]
+        block = encode_raw(*raws)
+        yield ("encode_rawdatablock %d" % size, encode_raw, raws)
+        yield ("decode_rawdatablock %d" % size, decode_raw, (block,))
+
+def run(out=sys.stdout, seed=0):
+    # returns {measure name: operations per second}, the best of repeat rounds
+    # over every measure, so that a slow moment of the machine doesn't hit
+    # every run of the same measure
+    measures = list(cases(random.Random(seed)))
+    results = dict((name, 0.0) for name, fnc, args in measures)
+    for r in range(repeat):
+        for name, fnc, args in measures:
+            results[name] = max(results[name], measure(fnc, args))
+    for name, fnc, args in measures:
+        print >>out, "%-36s %12.0f ops/s" % (name, results[name])
+    return results
+
+def compare(results, baseline, threshold=0.2):
+    # returns (name, baseline, result) of each measure slower than baseline by more than threshold
+    return [(name, baseline[name], results[name]) for name in sorted(results)
+            if name in baseline and results[name] < baseline[name] * (1 - threshold)]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="check and benchmark pack_raw, unpack_raw and the datablock framing")
+    parser.add_argument('-b', '--baseline', help="compare with the results saved in this file")
+    parser.add_argument('-s', '--save', help="save the results to this file, as a new baseline")
+    parser.add_argument('-t', '--threshold', type=float, default=0.2, help="slowdown against the baseline seen as a regression (0.2 : 20%%)")
+    parser.add_argument('-m', '--min-time', type=float, default=min_time, help="seconds per measure")
+    parser.add_argument('-c', '--check-only', action="store_true", help="only run the round-trip checks")
+    args = parser.parse_args()
+    min_time = args.min_time
+
+    failures = check()
+    held, packed = check_identity(random.Random(0))
+    if held == packed:
+        failures.append("pack/unpack identity holds on every payload, it isn't an expected failure any more")
+    else:
+        print "EXPECTED FAILURE unpack_raw(pack_raw(data)) gives data back for %d of %d payloads (bit order)" % (held, packed)
+    for f in failures: print "FAILED %s" % f
+    print "round-trip checks : %s" % ("%d failures" % len(failures) if failures else "OK")
+    status = 1 if failures else 0
+    if not args.check_only:
+        results = run()
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, args.threshold)
+            for name, before, after in regressions:
+                print "REGRESSION %-36s %12.0f -> %12.0f ops/s (%+.0f%%)" % (name, before, after, (after / before - 1) * 100)
+            print "%d measures compared with %s : %s" % (len([n for n in results if n in baseline]), args.baseline,
+                "%d regressions" % len(regressions) if regressions else "OK")
+            if regressions: status = 1
+    sys.exit(status)
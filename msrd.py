@@ -0,0 +1,201 @@
+#!/usr/bin/env python2
+#
+# File: msrd.py
+# Licence: GNU GPL version 3
+#
+# Daemon keeping MSR605 devices open, served over a local unix socket
+#
+# Clients don't pay for opening and resetting the port on every run, and
+# several processes can share a reader : requests for a device are queued
+# and run one at a time.
+#
+# Protocol : each message is a 4 bytes big endian length followed by a JSON
+# object. Requests are {"device": path or null for the first one,
+# "op": msr method name, "args": [...]}, responses are {"result": ...,
+# "error": message or null, "latency": seconds running, "queued": seconds
+# waiting}. Strings are sent as latin-1 so binary raw tracks go through.
+#
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+import threading
+import collections
+import SocketServer
+import msr
+import msrpool
+
+default_socket = os.path.join(os.path.expanduser("~"), ".msrtool", "msrd.sock")
+
+# msr methods clients may call
+operations = ["read_tracks", "read_raw_tracks", "write_tracks", "write_raw_tracks",
+              "erase_tracks", "set_bpc", "set_bpi", "set_coercivity", "get_coercivity",
+              "reset", "invalidate", "resync", "write_and_verify", "write_raw_and_verify",
+              "configure", "erase_and_write", "erase_and_write_raw"]
+
+def to_json(obj):
+    if isinstance(obj, str): return obj.decode("latin-1")
+    if isinstance(obj, (list, tuple)): return [to_json(o) for o in obj]
+    if isinstance(obj, dict): return dict((k, to_json(v)) for k, v in obj.items())
+    return obj
+
+def from_json(obj):
+    if isinstance(obj, unicode): return obj.encode("latin-1")
+    if isinstance(obj, list): return [from_json(o) for o in obj]
+    if isinstance(obj, dict): return dict((str(k), from_json(v)) for k, v in obj.items())
+    return obj
+
+def send_message(sock, obj):
+    data = json.dumps(to_json(obj), separators=(",", ":"))
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def recv_message(sock):
+    # returns None when the connection is closed
+    head = recv_exactly(sock, 4)
+    if head is None: return None
+    data = recv_exactly(sock, struct.unpack(">I", head)[0])
+    if data is None: return None
+    return from_json(json.loads(data))
+
+def recv_exactly(sock, n):
+    data = ""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if chunk == "": return None
+        data += chunk
+    return data
+
+def device_path(dev_path):
+    if dev_path is not None and dev_path.find("/") == -1: dev_path = "/dev/" + dev_path
+    return dev_path
+
+class daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, dev_paths, factory=msr.msr, log=sys.stdout):
+        self.log = log
+        self.devices = {}
+        if os.path.exists(socket_path):
+            # left by a previous daemon, unless one still answers on it
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(socket_path)
+                raise Exception("msrd is already running on %s" % socket_path)
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED: raise
+            finally:
+                s.close()
+            os.remove(socket_path)
+        self.default = device_path(dev_paths[0])
+        for path in dev_paths:
+            path = device_path(path)
+            p = msrpool.pool([path], factory) # one worker thread, requests run in order
+            if p.stats[path].error is not None:
+                raise Exception("%s : %s" % (path, p.stats[path].error))
+            p.jobs = collections.deque(maxlen=1000) # the daemon runs for long, keep recent jobs only
+            self.devices[path] = p
+        directory = os.path.dirname(socket_path)
+        if directory and not os.path.isdir(directory): os.makedirs(directory)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, handler)
+        self.__lock = threading.Lock()
+
+    def execute(self, request):
+        path = device_path(request.get("device")) or self.default
+        op = request.get("op")
+        if op == "devices":
+            return {"result": sorted(self.devices), "error": None, "latency": 0, "queued": 0}
+        if path not in self.devices:
+            return {"result": None, "error": "unknown device %s" % path}
+        if op not in operations:
+            return {"result": None, "error": "unknown operation %s" % op}
+        j = self.devices[path].submit(op, *request.get("args", []))
+        j.wait()
+        response = {"result": j.result, "error": None if j.error is None else str(j.error),
+                    "latency": j.duration(), "queued": j.started - j.submitted}
+        with self.__lock:
+            print >>self.log, "%s %s : %.1f ms (queued %.1f ms)%s" % (path, op,
+                response["latency"]*1000, response["queued"]*1000,
+                "" if j.error is None else " error : %s" % j.error)
+            self.log.flush()
+        return response
+
+    def shutdown_devices(self):
+        for p in self.devices.values(): p.close()
+        if os.path.exists(self.server_address): os.remove(self.server_address)
+
+class handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except ValueError:
+                break # not our protocol
+            if request is None: break
+            send_message(self.request, self.server.execute(request))
+
+class client(object):
+    # same commands as msr.msr, run by the daemon
+    hico = msr.msr.hico
+    loco = msr.msr.loco
+
+    def __init__(self, dev_path=None, socket_path=default_socket):
+        self.device = device_path(dev_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.latency = None # of the last request, as measured by the daemon
+        self.queued = None
+
+    def call(self, op, *args):
+        send_message(self.sock, {"device": self.device, "op": op, "args": list(args)})
+        response = recv_message(self.sock)
+        if response is None: raise Exception("msrd closed the connection")
+        self.latency = response.get("latency")
+        self.queued = response.get("queued")
+        if response["error"] is not None: raise Exception(response["error"])
+        result = response["result"]
+        return tuple(result) if isinstance(result, list) else result
+
+    def devices(self):
+        return self.call("devices")
+
+    def __getattr__(self, name):
+        if name not in operations: raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+    def close(self):
+        self.sock.close()
+
+def connect(dev_path, socket_path=default_socket):
+    # returns a client if a running daemon serves the device, a msr.msr otherwise
+    if os.path.exists(socket_path):
+        try:
+            c = client(dev_path, socket_path)
+            if c.device is None or c.device in c.devices(): return c
+            c.close()
+        except socket.error:
+            pass # stale socket
+    return msr.msr(dev_path)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="keep MSR605 devices open and serve them over a unix socket")
+    parser.add_argument('-s', '--socket', default=default_socket, help="unix socket path, %s by default" % default_socket)
+    parser.add_argument('devices', nargs="+", help="paths to serial communication devices")
+    args = parser.parse_args()
+
+    try:
+        d = daemon(args.socket, args.devices)
+    except Exception as e:
+        print e
+        sys.exit(1)
+    print "msrd serving %s on %s" % (", ".join(sorted(d.devices)), args.socket)
+    sys.stdout.flush()
+    try:
+        d.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        d.shutdown_devices()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python2
+#
+# File: msrdecode.py
+# Licence: GNU GPL version 3
+#
+# Offline decoding of archived raw reads, spread over a process pool
+#
+# A dump file is a sequence of raw datablocks, as returned by the device for
+# read_raw_tracks : <ESC>s<ESC>[01]<len>data<ESC>[02]<len>data<ESC>[03]<len>data?<FS>
+# The files are memory-mapped and cut into chunks of records; the workers
+# map the same files and decode their chunks with unpack_raw. Results are
+# written as JSON lines, in the order of the records:
+#
+#   {"file": ..., "record": n, "tracks": [[data, length, parity errors, lrc error], ...]}
+#   {"file": ..., "record": n, "error": message}
+#
+
+import os
+import sys
+import mmap
+import json
+import collections
+import multiprocessing
+import msr
+import msrcodec
+import msrrecords
+import msrparser
+
+ESC = msrparser.escape_code
+FS = msrparser.end_code
+
+# track mappings, selected by their number
+mappings = {"1": (msr.msr.track1_map, 6), "2": (msr.msr.track23_map, 4)}
+
+def dump(f, t1, t2, t3):
+    # appends a raw read to the dump file f
+    block = ESC+"s"
+    for n, t in enumerate((t1 or "", t2 or "", t3 or "")):
+        block += ESC+chr(n+1)+chr(len(t))+t
+    f.write(block+"?"+FS)
+
+def open_dump(path):
+    # returns a read-only map of the file, None if it is empty
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def records(data, path="dump"):
+    # yields (start, end) of each datablock of data (str or mmap), walking
+    # the track lengths. A truncated or corrupted datablock doesn't stop the
+    # walk : it goes up to the next ?<FS><ESC>s (data that isn't a datablock
+    # up to the next <ESC>s), or the end of data, and is reported as an error
+    # record by the worker decoding it
+    size = len(data)
+    pos = 0
+    while pos < size:
+        start = pos
+        pos += 2
+        if data[start:pos] == ESC+"s":
+            for n in range(3):
+                if data[pos:pos+2] != ESC+chr(n+1) or pos+2 >= size: break
+                pos += 3 + ord(data[pos+2])
+            else:
+                if data[pos:pos+2] == "?"+FS and pos+2 <= size:
+                    pos += 2
+                    yield start, pos
+                    continue
+        if data[start:start+2] == ESC+"s":
+            end = data.find("?"+FS+ESC+"s", start)
+            if end != -1: end += 2
+        else:
+            end = data.find(ESC+"s", start) # data between datablocks
+        pos = end if end != -1 else size
+        yield start, pos
+
+def split_block(data, start, size):
+    # raw tracks of the datablock at data[start:], raises if it is malformed
+    # size : where the datablock has to end by, the length of data at most
+    if data[start:start+2] != ESC+"s":
+        raise Exception("no datablock at offset %d" % start)
+    pos = start + 2
+    raws = []
+    for n in range(3):
+        if data[pos:pos+2] != ESC+chr(n+1) or pos+2 >= size:
+            raise Exception("missing track %d at offset %d" % (n+1, pos))
+        length = ord(data[pos+2])
+        raws.append(data[pos+3:pos+3+length])
+        pos += 3 + length
+    if pos+2 > size or data[pos:pos+2] != "?"+FS:
+        raise Exception("missing ?<FS> at offset %d" % pos)
+    return raws
+
+def chunks(paths, size=1000):
+    # yields (path, first record number, [(start, end), ...]) with up to size records each
+    for path in paths:
+        data = open_dump(path)
+        if data is None: continue
+        try:
+            number = 0
+            chunk = []
+            for r in records(data, path):
+                chunk.append(r)
+                if len(chunk) == size:
+                    yield path, number, chunk
+                    number += len(chunk)
+                    chunk = []
+            if chunk: yield path, number, chunk
+        finally:
+            data.close()
+
+# worker side : decoding options and maps of the files, set once per process
+
+_options = None
+_maps = {}
+
+def _init(options):
+    global _options
+    _options = options
+
+def _decode(task):
+    # decodes a chunk, returns its JSON lines
+    path, number, chunk = task
+    data = _maps.get(path)
+    if data is None:
+        for m in _maps.values(): m.close() # files are done in order
+        _maps.clear()
+        data = _maps[path] = open_dump(path)
+    return decode_chunk(data, path, number, chunk, *_options)
+
+def decode_chunk(data, path, number, chunk, tracks_maps, bpc):
+    # tracks_maps : (mapping, bcount_code) of each track
+    # bpc : bits per character of each track
+    # a malformed datablock gives an error line, the others are decoded
+    raws = [[], [], []]
+    bad = {}
+    for i, (start, end) in enumerate(chunk):
+        try:
+            block = split_block(data, start, end)
+        except Exception as e:
+            bad[i] = "bad dump file %s : %s" % (path, e)
+            block = ["", "", ""]
+        for n in range(3): raws[n].append(block[n])
+    decoded = []
+    for n in range(3):
+        mapping, bcount_code = tracks_maps[n]
+        try:
+            decoded.append(msrcodec.unpack_many(raws[n], mapping, bcount_code, bpc[n]))
+        except Exception:
+            decoded.append(None) # one of them can't be decoded, see which below
+    lines = []
+    for i in range(len(chunk)):
+        if i in bad:
+            lines.append(json.dumps({"file": path, "record": number+i, "error": bad[i]}, separators=(",", ":")))
+            continue
+        try:
+            tracks = [list(decoded[n][i] if decoded[n] is not None else
+                           msrcodec.unpack_raw(raws[n][i], tracks_maps[n][0], tracks_maps[n][1], bpc[n]))
+                      for n in range(3)]
+            r = {"file": path, "record": number+i, "tracks": tracks}
+        except Exception as e:
+            r = {"file": path, "record": number+i, "error": str(e)}
+        lines.append(json.dumps(r, separators=(",", ":")))
+    return lines
+
+def decode(paths, tracks_maps=None, bpc=(8,8,8), workers=None, chunk_size=1000):
+    # yields the JSON line of every record of the dump files, in order
+    # tracks_maps : (mapping, bcount_code) of each track, track1/track23 maps by default
+    # workers : number of processes, one per cpu by default, 1 to decode in this process
+    if tracks_maps is None: tracks_maps = [mappings["1"], mappings["2"], mappings["2"]]
+    options = (tracks_maps, bpc)
+    if workers is None: workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        _init(options)
+        for task in chunks(paths, chunk_size):
+            for line in _decode(task): yield line
+        return
+    p = multiprocessing.Pool(workers, _init, (options,))
+    try:
+        # a few chunks per worker in flight, results taken in submission order
+        pending = collections.deque()
+        for task in chunks(paths, chunk_size):
+            pending.append(p.apply_async(_decode, (task,)))
+            if len(pending) >= workers * 4:
+                for line in pending.popleft().get(): yield line
+        while pending:
+            for line in pending.popleft().get(): yield line
+        p.close()
+    finally:
+        p.terminate()
+        p.join()
+
+def load(paths, tracks_maps=None, bpc=(8,8,8), workers=None, chunk_size=1000):
+    # decodes the dump files into a msrrecords.cards, for analysis in memory
+    # returns (cards, records that couldn't be decoded), those are kept as blank cards
+    c = msrrecords.cards()
+    errors = 0
+    for line in decode(paths, tracks_maps, bpc, workers, chunk_size):
+        r = json.loads(line)
+        if "error" in r:
+            errors += 1
+            c.append((None, None, None))
+        else:
+            c.append([(str(t[0]), t[1], str(t[2]), t[3]) for t in r["tracks"]])
+    return c, errors
+
+def run(paths, out=sys.stdout, tracks_maps=None, bpc=(8,8,8), workers=None, chunk_size=1000):
+    # returns the number of records written to out
+    count = 0
+    for line in decode(paths, tracks_maps, bpc, workers, chunk_size):
+        out.write(line+"\n")
+        count += 1
+    return count
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="decode archived raw reads (see msr.py --dump) to JSON lines")
+    parser.add_argument('-B', '--bpc', default="888", help="bit per caracters for each track (5 to 8)")
+    parser.add_argument('-m', '--mapping', default="122", help="mapping of each track : 1 for the track 1 map (6 bits), 2 for the track 2/3 map (4 bits)")
+    parser.add_argument('-j', '--jobs', type=int, help="worker processes, one per cpu by default")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, help="records per chunk")
+    parser.add_argument('-o', '--output', help="output file, stdout by default")
+    parser.add_argument('dumps', nargs="+", help="dump files")
+    args = parser.parse_args()
+
+    if len(args.bpc) != 3 or any(c not in "5678" for c in args.bpc):
+        parser.error("--bpc : 3 digits from 5 to 8, one per track")
+    if len(args.mapping) != 3 or any(c not in mappings for c in args.mapping):
+        parser.error("--mapping : 3 digits, 1 or 2, one per track")
+    bpc = [ord(c)-48 for c in args.bpc]
+    tracks_maps = [mappings[c] for c in args.mapping]
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        started = time.time()
+        count = run(args.dumps, out, tracks_maps, bpc, args.jobs, args.chunk)
+        elapsed = time.time() - started
+        print >>sys.stderr, "%d records in %.1fs (%.0f records/s)" % (count, elapsed, count / elapsed if elapsed else 0)
+    except Exception as e:
+        print >>sys.stderr, e
+        sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+#
+# File: msrdetect.py
+# Licence: GNU GPL version 3
+#
+# Guesses how a raw track was encoded, to decode it without knowing the bpc
+#
+# Every combination of character code (track 1 map on 6 bits, track 2/3 map
+# on 4 bits), bits per character of the read (5 to 8) and direction of the
+# swipe is tried. A bpc is skipped if some byte of the read has more bits,
+# and the smallest bpc holding every byte is tried first, since a larger one
+# would leave the top bit of every byte blank. The bit stream of each bpc is
+# built once with tables, the start sentinel is looked for in it, and
+# combinations without one are rejected before decoding. The others are
+# decoded from the sentinel and scored on the end sentinel, the LRC, the
+# parity errors and the share of the 1 bits of the track they account for
+# (the rest should be blank).
+#
+
+import operator
+import msr
+import msrcodec
+
+# candidate character codes : name, mapping, bcount_code, start sentinel, end sentinel
+codes = [("track1", msr.msr.track1_map, 6, "%", "?"),
+         ("track23", msr.msr.track23_map, 4, ";", "?")]
+bpcs = [5, 6, 7, 8]
+
+# weights of the score, their sum is 1
+end_weight = 0.15       # end sentinel found
+lrc_weight = 0.25       # LRC matches
+parity_weight = 0.25    # share of characters without parity error
+coverage_weight = 0.35  # share of the 1 bits between the start sentinel and the LRC
+
+# start sentinel occurrences tried per combination (noise before the data)
+max_starts = 2
+# larger bpcs are not tried once a detection scores this much
+accept = 0.6
+
+class detection(object):
+    def __init__(self, code, bcount_code, bcount_output, reverse, offset, data, perr, lrc_error, end_found, score):
+        self.code = code                    # "track1" or "track23"
+        self.mapping = dict((c[0], c[1]) for c in codes)[code]
+        self.bcount_code = bcount_code
+        self.bcount_output = bcount_output  # bits per character of the read
+        self.reverse = reverse              # True if the card was swiped backwards
+        self.offset = offset                # bits before the start sentinel
+        self.data = data                    # from the start sentinel to the end sentinel
+        self.perr = perr                    # parity errors, "^" under the bad characters
+        self.lrc_error = lrc_error
+        self.end_found = end_found
+        self.confidence = score             # 0 to 1
+
+    def __str__(self):
+        return "%s map, %d bpc, offset %d%s, confidence %.2f" % (self.code, self.bcount_output,
+            self.offset, ", reversed" if self.reverse else "", self.confidence)
+
+# tables, built once
+
+_bits = {}      # bpc -> input character to bits, msb first
+_patterns = []  # (name, codec width, start sentinel bits, end sentinel value) for each code
+
+def _setup():
+    for bpc in bpcs:
+        mask = (1<<bpc)-1
+        _bits[bpc] = [bin(n & mask)[2:].zfill(bpc) for n in range(256)]
+    for name, mapping, bcount_code, start, end in codes:
+        i = mapping.find(start)
+        # as read by unpack : code lsb first, then the parity bit
+        start_bits = bin(i)[2:].zfill(bcount_code)[::-1] + str(msrcodec.parity_map[i])
+        _patterns.append((name, mapping, bcount_code, start_bits, mapping.find(end)))
+_setup()
+
+def detect(raw, bpc=None):
+    # raw : raw track as returned by read_raw_tracks
+    # bpc : bits per character of the read if known, all are tried otherwise
+    # returns the best detection, None if the track is blank or no start sentinel was found
+    raw = bytearray(raw)
+    if not raw or max(raw) == 0: return None # blank track
+    used = len(bin(max(raw)))-2 # bits used by the largest byte
+    best = None
+    for output in ([bpc] if bpc else bpcs):
+        if output < used: continue # early rejection : bits would be lost
+        if best is not None and best.confidence >= accept: break
+        forward = "".join(map(_bits[output].__getitem__, raw))
+        ones = forward.count("1")
+        for reverse, bits in ((False, forward), (True, forward[::-1])):
+            for name, mapping, bcount_code, start_bits, end_code in _patterns:
+                offset = -1
+                for attempt in range(max_starts):
+                    offset = bits.find(start_bits, offset+1)
+                    if offset == -1: break # early rejection : no start sentinel
+                    d = _score(bits, ones, offset, name, mapping, bcount_code, end_code, output, reverse)
+                    if best is None or d.confidence > best.confidence: best = d
+                    if best.confidence == 1.0: return best
+    return best
+
+def _score(bits, ones, offset, name, mapping, bcount_code, end_code, output, reverse):
+    c = msrcodec.get_codec(mapping, bcount_code, output)
+    width = bcount_code+1
+    usable = (len(bits) - offset) // width * width
+    values = "".join(map(c.value_of.__getitem__, c.split_values(bits[offset:offset+usable])))
+    codes = bytearray(values.translate(c.value_code_table))
+    end = codes.find(chr(end_code), 1)
+    end_found = end != -1
+    if end_found:
+        last = min(end+2, len(codes)) # end sentinel and LRC
+    else:
+        last = len(str(codes).rstrip("\0"))
+        end = last-1
+    lrc_error = reduce(operator.xor, codes[0:last], 0) != 0 or not end_found or last != end+2
+    perr = values[0:end+1].translate(c.perr_table)
+    good = perr.count(" ") / float(len(perr)) if perr else 0.0
+    coverage = bits.count("1", offset, offset + last*width) / float(ones)
+    score = end_weight * end_found + lrc_weight * (not lrc_error) + parity_weight * good + coverage_weight * coverage
+    return detection(name, bcount_code, output, reverse, offset, values[0:end+1].translate(c.data_table),
+                     perr, lrc_error, end_found, round(score, 6))
+
+def detect_tracks(raws, bpc=None):
+    # detections of the three raw tracks of a read, None for blank ones
+    return [detect(raw, bpc) if raw else None for raw in raws]
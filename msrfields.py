@@ -0,0 +1,293 @@
+#!/usr/bin/env python2
+#
+# File: msrfields.py
+# Licence: GNU GPL version 3
+#
+# ISO 7813 fields of financial cards : track 1 format B and track 2
+#
+#   track 1 : %B<PAN>^<NAME>^<YYMM><service code><discretionary data>?
+#   track 2 : ;<PAN>=<YYMM><service code><discretionary data>?
+#
+# A read (the tracks of read_tracks, with their sentinels, or unpack_raw
+# results of a raw read, with their LRC character) is split into the PAN,
+# name, expiry, service code and discretionary data of each track. The PAN
+# is checked with its Luhn digit, the expiry month, the PAN and expiry of
+# track 1 against track 2, and the parity and LRC errors of raw tracks are
+# kept. Each check that fails sets a flag of the card. A column set keeps
+# the fields of many cards in one list per field, for thousands of reads,
+# and writes them as CSV or as JSON columns. It parses reads by chunks : the
+# tracks of a chunk are joined by newlines and split into fields by a single
+# pass of a multiline expression, without a card object per read.
+#
+#   ./msrfields.py cards.db                 (card store of msrtool.py)
+#   ./msrfields.py -f json cards.dump       (raw reads, see msr.py --dump)
+#
+
+import re
+import sys
+import json
+import itertools
+import msrgen
+import msrbatch
+
+# flags of a card
+TRACK1 = 1          # track 1 is format B
+TRACK2 = 2          # track 2 has a PAN and separator
+LUHN_ERROR = 4      # the last digit of the PAN isn't its Luhn digit
+BAD_EXPIRY = 8      # expiry month not in 01..12
+MISMATCH = 16       # PAN or expiry of track 1 and track 2 differ
+LRC_ERROR = 32      # a raw track has an LRC error
+PARITY_ERROR = 64   # a raw track has a parity error
+
+flag_names = [(TRACK1, "track1"), (TRACK2, "track2"), (LUHN_ERROR, "luhn"), (BAD_EXPIRY, "expiry"),
+              (MISMATCH, "mismatch"), (LRC_ERROR, "lrc"), (PARITY_ERROR, "parity")]
+# a card is valid with one of the tracks and none of the errors
+ERRORS = LUHN_ERROR | BAD_EXPIRY | MISMATCH | LRC_ERROR | PARITY_ERROR
+
+# expiry and service code are replaced by a separator when absent
+_track1 = re.compile(r"B(\d{1,19})\^([^^]{0,26})\^(?:(\d{4})|\^)(?:(\d{3})|\^)?(.*)$").match
+_track2 = re.compile(r"(\d{1,19})=(?:(\d{4})|=)(?:(\d{3})|=)?(.*)$").match
+# the same over many tracks joined by newlines : a tuple of fields per line,
+# empty fields for a line that doesn't match
+_tracks1 = re.compile(r"^(?:B(\d{1,19})\^([^^\n]{0,26})\^(?:(\d{4})|\^)(?:(\d{3})|\^)?(.*)|.*)$", re.M).findall
+_tracks2 = re.compile(r"^(?:(\d{1,19})=(?:(\d{4})|=)(?:(\d{3})|=)?(.*)|.*)$", re.M).findall
+_start = re.compile(r"[%;]").search
+
+# reads parsed together by columns.extend
+chunk_size = 4096
+
+columns_names = ("pan", "name", "expiry", "service", "discretionary1", "discretionary2", "flags")
+
+def strip(t):
+    # data of a track, without its start sentinel and what comes before it
+    # (leading zero codes of a raw track), its end sentinel and what follows
+    # it (the LRC character of a raw track), "" for a blank track
+    if not t: return ""
+    m = _start(t)
+    start = m.end() if m is not None else 0
+    end = t.find("?", start)
+    return t[start:end] if end != -1 else t[start:]
+
+def flag_string(flags):
+    # "track1,track2,luhn"...
+    return ",".join(name for flag, name in flag_names if flags & flag)
+
+class card(object):
+    # fields of a read, "" when absent
+    __slots__ = ("pan", "name", "expiry", "service", "discretionary1", "discretionary2", "flags")
+
+    def __init__(self, pan="", name="", expiry="", service="", discretionary1="", discretionary2="", flags=0):
+        self.pan = pan
+        self.name = name                        # "SURNAME/FIRST NAME.TITLE", without trailing spaces
+        self.expiry = expiry                    # YYMM
+        self.service = service                  # service code, 3 digits
+        self.discretionary1 = discretionary1    # of track 1
+        self.discretionary2 = discretionary2    # of track 2
+        self.flags = flags
+
+    def valid(self):
+        return bool(self.flags & (TRACK1 | TRACK2)) and not self.flags & ERRORS
+
+    def to_tuple(self):
+        return (self.pan, self.name, self.expiry, self.service, self.discretionary1, self.discretionary2, self.flags)
+
+    def __eq__(self, other):
+        return isinstance(other, card) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "card(%r, %r, %r, %r, %r, %r, %s)" % (self.to_tuple()[0:6] + (flag_string(self.flags) or "0",))
+
+def _data(t):
+    # track data and error flags of a read_tracks string or unpack_raw result
+    if t is None: return "", 0
+    if isinstance(t, tuple):
+        flags = LRC_ERROR if t[3] else 0
+        if "^" in t[2]: flags |= PARITY_ERROR
+        return strip(t[0]), flags
+    return strip(t), 0
+
+def parse(t1, t2=None):
+    # t1, t2 : tracks as returned by read_tracks, unpack_raw results, or None
+    c = card()
+    d1, flags = _data(t1)
+    d2, f = _data(t2)
+    flags |= f
+    m = _track1(d1)
+    if m is not None:
+        c.pan, name, c.expiry, c.service, c.discretionary1 = m.groups("")
+        c.name = name.rstrip()
+        flags |= TRACK1
+    m = _track2(d2)
+    if m is not None:
+        pan, expiry, service, c.discretionary2 = m.groups("")
+        if flags & TRACK1:
+            if pan != c.pan or expiry != c.expiry: flags |= MISMATCH
+        else:
+            c.pan, c.expiry, c.service = pan, expiry, service
+        flags |= TRACK2
+    if flags & (TRACK1 | TRACK2):
+        if not msrgen.luhn_valid(c.pan): flags |= LUHN_ERROR
+        if c.expiry and not "01" <= c.expiry[2:4] <= "12": flags |= BAD_EXPIRY
+    c.flags = flags
+    return c
+
+class columns(object):
+    # fields of many reads, one list per field
+    __slots__ = ("pan", "name", "expiry", "service", "discretionary1", "discretionary2", "flags")
+
+    def __init__(self, reads=()):
+        # reads : (t1, t2, ...) of each card, as given to parse
+        for name in columns_names[0:6]: setattr(self, name, [])
+        self.flags = bytearray()
+        self.extend(reads)
+
+    def __len__(self):
+        return len(self.flags)
+
+    def append(self, c):
+        # c : a card
+        self.pan.append(c.pan)
+        self.name.append(c.name)
+        self.expiry.append(c.expiry)
+        self.service.append(c.service)
+        self.discretionary1.append(c.discretionary1)
+        self.discretionary2.append(c.discretionary2)
+        self.flags.append(c.flags)
+
+    def extend(self, reads):
+        # parses and appends the reads, chunk_size at a time : the tracks of a
+        # chunk are joined and matched in one pass of the expressions
+        reads = iter(reads)
+        while True:
+            chunk = list(itertools.islice(reads, chunk_size))
+            if not chunk: return
+            self.__extend(chunk)
+
+    def __extend(self, reads):
+        d1, d2, errors = [], [], []
+        for read in reads:
+            data1, f1 = _data(read[0])
+            data2, f2 = _data(read[1])
+            d1.append(data1)
+            d2.append(data2)
+            errors.append(f1 | f2)
+        m1 = _tracks1("\n".join(d1))
+        m2 = _tracks2("\n".join(d2))
+        if len(m1) != len(reads) or len(m2) != len(reads):
+            # a newline in some data : one track at a time
+            for read in reads: self.append(parse(read[0], read[1]))
+            return
+        luhn_valid = msrgen.luhn_valid
+        for i in xrange(len(reads)):
+            flags = errors[i]
+            pan, name, expiry, service, discretionary1 = m1[i]
+            if pan: flags |= TRACK1
+            pan2, expiry2, service2, discretionary2 = m2[i]
+            if pan2:
+                if flags & TRACK1:
+                    if pan2 != pan or expiry2 != expiry: flags |= MISMATCH
+                else:
+                    pan, expiry, service = pan2, expiry2, service2
+                flags |= TRACK2
+            if flags & (TRACK1 | TRACK2):
+                if not luhn_valid(pan): flags |= LUHN_ERROR
+                if expiry and not "01" <= expiry[2:4] <= "12": flags |= BAD_EXPIRY
+            self.pan.append(pan)
+            self.name.append(name.rstrip())
+            self.expiry.append(expiry)
+            self.service.append(service)
+            self.discretionary1.append(discretionary1)
+            self.discretionary2.append(discretionary2)
+            self.flags.append(flags)
+
+    def __getitem__(self, i):
+        return card(self.pan[i], self.name[i], self.expiry[i], self.service[i],
+                    self.discretionary1[i], self.discretionary2[i], self.flags[i])
+
+    def __iter__(self):
+        for i in xrange(len(self)): yield self[i]
+
+    def count(self, flag):
+        # cards with flag set
+        return sum(1 for f in self.flags if f & flag)
+
+    def valid(self):
+        # cards with a track and no error
+        return sum(1 for f in self.flags if f & (TRACK1 | TRACK2) and not f & ERRORS)
+
+    def summary(self):
+        return "%d cards, %d valid, %d without track 1/2, %s" % (len(self), self.valid(),
+            sum(1 for f in self.flags if not f & (TRACK1 | TRACK2)),
+            ", ".join("%d %s" % (self.count(flag), name) for flag, name in flag_names if flag & ERRORS))
+
+    def write(self, out=sys.stdout, format="csv"):
+        # csv : a row per card, json : an object of columns
+        if format == "json":
+            cols = dict((name, getattr(self, name)) for name in columns_names[0:6])
+            cols["flags"] = list(self.flags)
+            json.dump(cols, out, separators=(",", ":"), sort_keys=True)
+            out.write("\n")
+            return
+        import csv
+        w = csv.writer(out)
+        w.writerow(columns_names)
+        flags = map(flag_string, self.flags)
+        w.writerows(zip(self.pan, self.name, self.expiry, self.service, self.discretionary1, self.discretionary2, flags))
+
+def reads(path, bpc=(8,8,8)):
+    # yields the (t1, t2) of every card of a card store (.db), dump file
+    # (.dump, decoded at bpc bits per character) or JSON lines file (rows
+    # of msrstore.py --export, msrdecode.py output or job files)
+    if path.endswith(".db"):
+        import msrstore
+        s = msrstore.store(path)
+        try:
+            for row in s.rows(): yield row[3], row[4]
+        finally:
+            s.close()
+        return
+    if path.endswith(".dump"):
+        import msrdecode
+        lines = msrdecode.decode([path], bpc=bpc)
+    else:
+        lines = open(path)
+    for line in lines:
+        if line.strip() == "": continue
+        r = json.loads(line)
+        if isinstance(r, list):
+            # job file record, as read by msrbatch : [t1, t2, t3]
+            yield tuple(msrbatch.track_string(t) or None for t in (r + [None, None])[0:2])
+        elif "tracks" in r:
+            yield tuple(tuple([str(t[0]), t[1], str(t[2]), t[3]]) if t else None for t in r["tracks"][0:2])
+        elif "error" in r:
+            yield None, None
+        else:
+            yield tuple(msrbatch.track_string(r.get(t)) or None for t in ("t1", "t2"))
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="split the ISO 7813 fields of archived reads into columns")
+    parser.add_argument('-f', '--format', choices=["csv", "json"], default="csv", help="output format, json : an object of columns")
+    parser.add_argument('-B', '--bpc', default="888", help="bit per caracters for each track of dump files (5 to 8)")
+    parser.add_argument('-o', '--output', help="output file, stdout by default")
+    parser.add_argument('inputs', nargs="+", help="card stores (.db), dump files (.dump) or JSON lines files")
+    args = parser.parse_args()
+
+    bpc = [ord(ch)-48 for ch in args.bpc]
+    started = time.time()
+    c = columns()
+    try:
+        for path in args.inputs: c.extend(reads(path, bpc))
+    except Exception as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        c.write(out, args.format)
+    finally:
+        if out is not sys.stdout: out.close()
+    print >>sys.stderr, "%s (%.1fs)" % (c.summary(), time.time() - started)
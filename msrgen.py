@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+#
+# File: msrgen.py
+# Licence: GNU GPL version 3
+#
+# Card data generator : expands a template into a stream of tracks
+#
+# A template is a JSON file giving the tracks as format strings, and the
+# fields they use:
+#
+#   {"count": 1000,
+#    "t1": "B{pan}^{name}^{exp}{svc}0000000",
+#    "t2": "{pan}={exp}{svc}0000000",
+#    "fields": {"pan": {"type": "luhn", "prefix": "400000", "length": 16, "start": 1},
+#               "name": {"type": "list", "values": ["DOE/JOHN", "DOE/JANE"]},
+#               "exp": "2512", "svc": "101"}}
+#
+# Field types : sequence (start, step, width), luhn (prefix, length, start,
+# step : sequential account numbers with their check digit), list (values,
+# used in turn), and constants. Records are generated lazily, the n-th one
+# can be generated without the previous ones, and are validated and encoded
+# by msrbatch, ahead of the device.
+#
+
+import sys
+import json
+import msrbatch
+
+# sum of the digits of 2*d, for the doubled digits of the Luhn algorithm
+_doubled = [0, 2, 4, 6, 8, 1, 3, 5, 7, 9]
+
+def luhn_digit(number):
+    # check digit to append to number (a string of digits)
+    total = 0
+    double = True # from the right, the digit before the check digit is doubled
+    for c in reversed(number):
+        d = ord(c) - 48
+        total += _doubled[d] if double else d
+        double = not double
+    return chr(48 + (10 - total % 10) % 10)
+
+def luhn_valid(number):
+    # True if the last digit of number is its Luhn check digit
+    return len(number) > 1 and number.isdigit() and luhn_digit(number[:-1]) == number[-1]
+
+class field(object):
+    # value of a template field for the n-th record
+    def __init__(self, name, spec):
+        self.name = name
+        if not isinstance(spec, dict): spec = {"type": "constant", "value": spec}
+        self.type = spec.get("type", "constant")
+        self.start = int(spec.get("start", 0))
+        self.step = int(spec.get("step", 1))
+        if self.type == "constant":
+            self.constant = str(spec.get("value", ""))
+        elif self.type == "sequence":
+            self.width = int(spec.get("width", 0))
+        elif self.type == "luhn":
+            self.prefix = str(spec.get("prefix", ""))
+            self.width = int(spec["length"]) - len(self.prefix) - 1
+            if self.width <= 0: raise Exception("field %s : length too short for the prefix" % name)
+        elif self.type == "list":
+            self.values = [str(v) for v in spec["values"]]
+            if not self.values: raise Exception("field %s : empty list" % name)
+        else:
+            raise Exception("field %s : unknown type %s" % (name, self.type))
+
+    def value(self, n):
+        if self.type == "constant":
+            return self.constant
+        if self.type == "list":
+            return self.values[n % len(self.values)]
+        number = str(self.start + n * self.step).zfill(self.width)
+        if self.type == "sequence":
+            return number
+        if len(number) > self.width:
+            raise Exception("field %s : account number %s doesn't fit in %d digits" % (self.name, number, self.width))
+        number = self.prefix + number
+        return number + luhn_digit(number)
+
+class template(object):
+    def __init__(self, spec):
+        # spec : dict, as loaded from a template file
+        self.tracks = [str(spec.get(t) or "") for t in ("t1", "t2", "t3")]
+        self.fields = dict((str(name), field(name, s)) for name, s in spec.get("fields", {}).items())
+        self.count = spec.get("count")
+        for t in self.tracks:
+            try:
+                t.format(**dict((name, "") for name in self.fields))
+            except KeyError as e:
+                raise Exception("template : unknown field %s" % e)
+
+    def record(self, n):
+        # tracks of the n-th record, from 0
+        values = dict((name, f.value(n)) for name, f in self.fields.items())
+        return tuple(t.format(**values) for t in self.tracks)
+
+    def records(self, count=None, start=0):
+        # yields the tracks of count records (the template count by default,
+        # forever if none), from the start-th one
+        if count is None: count = self.count
+        n = start
+        while count is None or n < count:
+            yield self.record(n)
+            n += 1
+
+def load(path):
+    with open(path) as f:
+        return template(json.load(f))
+
+def is_template(path):
+    return path.endswith(".template.json")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="expand a card template (see msrgen.py) into a job file for msrbatch.py")
+    parser.add_argument('-n', '--count', type=int, help="number of records, the template count by default")
+    parser.add_argument('-s', '--start', type=int, default=0, help="first record")
+    parser.add_argument('-f', '--format', choices=["csv", "jsonl"], default="jsonl", help="output format")
+    parser.add_argument('template', help="template file")
+    args = parser.parse_args()
+
+    n = None
+    try:
+        t = load(args.template)
+        if args.count is None and t.count is None: raise Exception("no count given")
+        count = None if args.count is None else args.start + args.count
+        if args.format == "csv":
+            import csv
+            w = csv.writer(sys.stdout)
+        for n, tracks in enumerate(t.records(count, args.start), args.start):
+            msrbatch.validate(*tracks)
+            if args.format == "csv":
+                w.writerow(tracks)
+            else:
+                sys.stdout.write(json.dumps({"t1": tracks[0], "t2": tracks[1], "t3": tracks[2]}) + "\n")
+    except Exception as e:
+        print >>sys.stderr, e if n is None else "record %d : %s" % (n, e)
+        sys.exit(1)
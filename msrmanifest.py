@@ -0,0 +1,195 @@
+#!/usr/bin/env python2
+#
+# File: msrmanifest.py
+# Licence: GNU GPL version 3
+#
+# Bulk compare of swiped cards against the manifest of a production batch
+#
+# The manifest is a job file of msrbatch.py (CSV or JSONL, one card per
+# line), read once to build a compact index : only digests of the tracks
+# are kept, in flat arrays and an open addressing hash table, so a card
+# takes about a hundred bytes of memory. Each swipe is looked up by
+# the digest of each of its tracks, which finds the card even when a track
+# is bad. At the end, a reconciliation report lists the mismatched,
+# unexpected, duplicate and missing cards, by record number in the manifest.
+#
+
+import sys
+import time
+import array
+import struct
+import hashlib
+import msrbatch
+import msrfields
+
+# digests are machine integers (64 bits on 64 bits systems), kept in arrays
+digest_type = "l"
+digest_size = array.array(digest_type).itemsize
+digest_format = {4: ">i", 8: ">q"}[digest_size]
+
+def digest(n, t):
+    # digest of the data of track n, 0 for a blank track
+    if not t: return 0
+    return struct.unpack(digest_format, hashlib.sha1("%d:%s" % (n, t)).digest()[0:digest_size])[0] or 1
+
+class hashindex(object):
+    # multimap of digests (not 0) to row numbers, open addressing with linear probing
+    def __init__(self, size):
+        capacity = 16
+        while capacity * 3 < size * 4: capacity *= 2 # at most 75% full
+        self.mask = capacity - 1
+        self.keys = array.array(digest_type, [0]) * capacity
+        self.rows = array.array("i", [0]) * capacity
+
+    def add(self, key, row):
+        slot = key & self.mask
+        while self.keys[slot] != 0: slot = (slot + 1) & self.mask
+        self.keys[slot] = key
+        self.rows[slot] = row
+
+    def get(self, key):
+        # every row added with key
+        result = []
+        slot = key & self.mask
+        while self.keys[slot] != 0:
+            if self.keys[slot] == key: result.append(self.rows[slot])
+            slot = (slot + 1) & self.mask
+        return result
+
+class manifest(object):
+    def __init__(self, records):
+        # records : (t1, t2, t3) of each card, as yielded by msrbatch.read_records
+        self.digests = [array.array(digest_type), array.array(digest_type), array.array(digest_type)]
+        for row, tracks in enumerate(records, 1):
+            if isinstance(tracks, Exception): raise Exception("manifest record %d : %s" % (row, tracks))
+            for n in range(3):
+                self.digests[n].append(digest(n+1, tracks[n]))
+        self.size = len(self.digests[0])
+        self.index = hashindex(self.size * 3)
+        for n in range(3):
+            for row, d in enumerate(self.digests[n]):
+                if d != 0: self.index.add(d, row)
+        self.seen = array.array("l", [0]) * self.size # swipes matched to each card
+
+    def match(self, t1, t2, t3):
+        # tracks without sentinels
+        # returns (row, tracks that differ) of the closest card, (None, None) if no track matches
+        swiped = [digest(n+1, t) for n, t in enumerate((t1, t2, t3))]
+        best = None
+        best_score = 0
+        for d in swiped:
+            if d == 0: continue
+            for row in self.index.get(d):
+                score = sum(1 for n in range(3) if self.digests[n][row] == swiped[n])
+                if score > best_score: best, best_score = row, score
+        if best is None: return None, None
+        return best, [n+1 for n in range(3) if self.digests[n][best] != swiped[n]]
+
+    def missing(self):
+        # rows of the cards never swiped
+        return [row for row in xrange(self.size) if self.seen[row] == 0]
+
+def strip(t):
+    # track as read, without its sentinels
+    return msrfields.strip(t)
+
+class reconciliation(object):
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.swipes = 0
+        self.ok = 0
+        self.mismatches = []   # (row, tracks that differ)
+        self.unexpected = 0    # cards not in the manifest
+        self.duplicates = []   # rows swiped more than once
+        self.errors = 0        # failed reads
+        self.track_mismatches = [0, 0, 0]
+        self.started = time.time()
+
+    def check(self, t1, t2, t3):
+        # tracks as read, returns a line describing the result
+        self.swipes += 1
+        row, bad = self.manifest.match(strip(t1), strip(t2), strip(t3))
+        if row is None:
+            self.unexpected += 1
+            return "UNEXPECTED card, not in the manifest"
+        self.manifest.seen[row] += 1
+        line = "record %d" % (row+1)
+        if self.manifest.seen[row] > 1:
+            self.duplicates.append(row)
+            line += " DUPLICATE (swiped %d times)" % self.manifest.seen[row]
+        if bad:
+            self.mismatches.append((row, bad))
+            for n in bad: self.track_mismatches[n-1] += 1
+            return line + " MISMATCH on track %s" % ", ".join(str(n) for n in bad)
+        self.ok += 1
+        return line + " OK"
+
+    def report(self, out=sys.stdout, limit=20):
+        # limit : rows listed per category, None for all of them
+        missing = self.manifest.missing()
+        elapsed = time.time() - self.started
+        print >>out, "Reconciliation : %d cards in the manifest, %d swipes in %.0fs (%.1f cards/min)" % (
+            self.manifest.size, self.swipes, elapsed, self.swipes * 60.0 / elapsed if elapsed else 0)
+        print >>out, "  ok          : %d" % self.ok
+        print >>out, "  mismatched  : %d (track 1: %d, track 2: %d, track 3: %d)" % ((len(self.mismatches),) + tuple(self.track_mismatches))
+        print >>out, "  unexpected  : %d" % self.unexpected
+        print >>out, "  duplicates  : %d" % len(self.duplicates)
+        print >>out, "  read errors : %d" % self.errors
+        print >>out, "  missing     : %d" % len(missing)
+        def rows(name, items):
+            if not items: return
+            shown = items if limit is None else items[0:limit]
+            more = "" if len(shown) == len(items) else " ... (%d more)" % (len(items) - len(shown))
+            print >>out, "  %s records : %s%s" % (name, " ".join(shown), more)
+        rows("mismatched", ["%d(%s)" % (row+1, ",".join(str(n) for n in bad)) for row, bad in self.mismatches])
+        rows("duplicate", [str(row+1) for row in sorted(set(self.duplicates))])
+        rows("missing", [str(row+1) for row in missing])
+
+def load(path, format=None):
+    f = msrbatch.open_job(path)
+    try:
+        return manifest(msrbatch.read_records(f, format))
+    finally:
+        if f is not sys.stdin: f.close()
+
+def run(dev, m, out=sys.stdout, swiped=None):
+    # compares swiped cards against manifest m until ^C, returns the reconciliation
+    # swiped : called with True/False after each read, for metrics
+    r = reconciliation(m)
+    while True:
+        print >>out, "[M] swipe card to compare, ^C to stop"
+        try:
+            t1, t2, t3 = dev.read_tracks()
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            r.errors += 1
+            if swiped is not None: swiped(False)
+            print >>out, "Failed. Error:", e
+            continue
+        if swiped is not None: swiped(True)
+        print >>out, r.check(t1, t2, t3)
+    return r
+
+if __name__ == "__main__":
+    import argparse
+    import msr
+    parser = argparse.ArgumentParser(description="compare swiped cards against a manifest of the cards issued")
+    parser.add_argument('-d', '--device', required=True, help="path to serial communication device")
+    parser.add_argument('-f', '--format', choices=["csv", "jsonl"], help="manifest format, guessed from the file name by default")
+    parser.add_argument('-r', '--report', help="also write the full report (every record number) to this file")
+    parser.add_argument('manifest', help="manifest file, CSV or JSONL as for msrbatch.py")
+    args = parser.parse_args()
+
+    try:
+        started = time.time()
+        m = load(args.manifest, args.format)
+        print "%d cards loaded in %.1fs" % (m.size, time.time() - started)
+        r = run(msr.msr(args.device), m)
+        r.report()
+        if args.report:
+            with open(args.report, "w") as f:
+                r.report(f, None)
+    except Exception as e:
+        print e
+        sys.exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+#
+# File: msrmetrics.py
+# Licence: GNU GPL version 3
+#
+# Metrics of the driver : latency histograms and counters
+#
+# Instrumentation is off unless a registry is set on the driver, either for
+# every device or for one:
+#
+#   msr.msr.metrics = msrmetrics.registry()
+#   dev.metrics = msrmetrics.registry()
+#
+# When off, the driver only checks that metrics is None on each command.
+# Metrics are exported as Prometheus text, or as a JSON snapshot when the
+# file name ends with .json, once or periodically with an exporter.
+#
+
+import os
+import json
+import time
+import bisect
+import threading
+
+# upper bounds of the histogram buckets, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+descriptions = {
+    "msr_command_seconds": ("histogram", "time spent in each public command of the driver"),
+    "msr_phase_seconds": ("histogram", "time spent in each phase of a device command : write, swipe (waiting for the first byte), drain (rest of the response), encode, decode"),
+    "msr_codec_seconds": ("histogram", "time spent in pack_raw and unpack_raw"),
+    "msr_status_total": ("counter", "responses by device command and status code, 0 is success"),
+    "msrtool_swipes_total": ("counter", "swipes in the bulk modes of msrtool.py"),
+    "msrtool_swipes_per_minute": ("gauge", "swipe rate of the bulk modes of msrtool.py, since their first swipe"),
+}
+
+class histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations below it) for each bucket, as in Prometheus
+        total = 0
+        result = []
+        for bound, n in zip(list(buckets) + [float("inf")], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+class registry(object):
+    def __init__(self):
+        self.histograms = {} # (name, labels) -> histogram, labels : tuple of (key, value)
+        self.counters = {}   # (name, labels) -> count
+        self.swipes = {}     # bulk mode -> (first swipe time, swipes)
+        self.__lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self.__lock:
+            h = self.histograms.get(key)
+            if h is None: h = self.histograms[key] = histogram()
+            h.observe(seconds)
+
+    def count(self, name, labels, n=1):
+        key = (name, labels)
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def swipe(self, mode, ok=True):
+        # a card went through a bulk mode, ok is False if the operation failed
+        self.count("msrtool_swipes_total", (("mode", mode), ("result", "ok" if ok else "failed")))
+        with self.__lock:
+            first, n = self.swipes.get(mode, (time.time(), 0))
+            self.swipes[mode] = (first, n+1)
+
+    def swipe_rates(self):
+        # swipes per minute of each bulk mode
+        now = time.time()
+        with self.__lock:
+            return dict((mode, n * 60.0 / (now - first) if now > first else 0.0)
+                        for mode, (first, n) in self.swipes.items())
+
+    # export
+
+    def snapshot(self):
+        # everything as a dict, for JSON
+        with self.__lock:
+            histograms = [{"name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                           "buckets": [[b if b != float("inf") else "+Inf", n] for b, n in h.cumulative()]}
+                          for (name, labels), h in sorted(self.histograms.items())]
+            counters = [{"name": name, "labels": dict(labels), "value": n}
+                        for (name, labels), n in sorted(self.counters.items())]
+        return {"time": time.time(), "histograms": histograms, "counters": counters,
+                "swipes_per_minute": self.swipe_rates()}
+
+    def prometheus(self):
+        # everything in the Prometheus text exposition format
+        lines = []
+        def header(name):
+            kind, text = descriptions.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+        def format_labels(labels):
+            if not labels: return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+        with self.__lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        name = None
+        for (n, labels), h in histograms:
+            if n != name:
+                name = n
+                header(name)
+            for bound, count in h.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", le),)), count))
+            lines.append("%s_sum%s %r" % (name, format_labels(labels), h.sum))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), h.count))
+        for (n, labels), count in counters:
+            if n != name:
+                name = n
+                header(name)
+            lines.append("%s%s %d" % (name, format_labels(labels), count))
+        rates = sorted(self.swipe_rates().items())
+        if rates:
+            header("msrtool_swipes_per_minute")
+            for mode, rate in rates:
+                lines.append("msrtool_swipes_per_minute%s %r" % (format_labels((("mode", mode),)), rate))
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        # written atomically, as JSON if path ends with .json, as Prometheus text otherwise
+        data = json.dumps(self.snapshot()) + "\n" if path.endswith(".json") else self.prometheus()
+        tmp = path + ".%d" % os.getpid()
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+class exporter(object):
+    # saves the registry to path every interval seconds, and when stopped
+    def __init__(self, registry, path, interval=10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.__stop = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name="msrmetrics exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.registry.save(self.path)
+
+    def stop(self):
+        self.__stop.set()
+        self.thread.join()
+        self.registry.save(self.path)
+
+def start(path, interval=10.0):
+    # instruments every device and exports to path, returns the exporter
+    import msr
+    msr.msr.metrics = registry()
+    return exporter(msr.msr.metrics, path, interval)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# File: msrparser.py
+# Licence: GNU GPL version 3
+#
+# Incremental parser for the responses of the MSR605
+#
+# A response is [datablock]<ESC><status>[result]. Chunks are fed as they
+# come off the serial port, and the parser tells as soon as the response is
+# complete. Data is accumulated once in a bytearray and only scanned from
+# where the previous chunk stopped; the tracks are extracted when asked for.
+#
+
+escape_code = "\x1B"
+end_code = "\x1C"
+
+ESC = ord(escape_code)
+FS = ord(end_code)
+QMARK = ord("?")
+
+class response(object):
+    def __init__(self, command, block_only=False):
+        # command : the command sent, its first character tells the response format
+        # block_only : parse a datablock alone, without the <ESC><status> that follows
+        self.command = command[0]
+        self.block_only = block_only
+        self.buf = bytearray()
+        self.status = None
+        self.result = ""
+        self.complete = False
+        self.error = None       # malformed datablock, raised by tracks()
+        self.block = None       # True if a datablock came, False if not, None until known
+        self.block_done = False # True once the whole datablock is there
+        self.end = None         # length of the response in buf once complete, what follows belongs to the next one
+        self.__pos = 0          # where parsing goes on
+        self.__track = 0        # track being parsed, 0 to 2
+        self.__strips = [None, None, None] # (start, end) of each track
+        self.__state = self.__start if not block_only else self.__header
+
+    def feed(self, chunk):
+        # chunk : str, bytearray or memoryview
+        # returns True once the whole response is there
+        self.buf += chunk
+        while self.__state is not None and self.__state():
+            pass
+        return self.complete
+
+    def empty(self):
+        return len(self.buf) == 0
+
+    def close(self):
+        # no more data will come : an incomplete response gets its status from
+        # its last <ESC> as far as possible
+        if self.complete: return
+        self.__state = None
+        buf = self.buf
+        pos = str(buf).rindex(escape_code)
+        self.status = chr(buf[pos+1])
+        self.result = str(buf[pos+2:])
+
+    def tracks(self):
+        # returns the three tracks of the datablock, None for the blank ones
+        if self.error is not None: raise self.error
+        if not self.block:
+            raise Exception("bad datablock : don't start with <ESC>s<ESC>[01]", str(self.buf))
+        if not self.block_done: raise self.__truncated()
+        view = memoryview(self.buf)
+        return tuple(None if s is None else view[s[0]:s[1]].tobytes() for s in self.__strips)
+
+    def __fail(self, message, *args):
+        self.error = Exception(message, str(self.buf), *args)
+        self.__state = None
+        return False
+
+    def __truncated(self):
+        if self.command == "r":
+            return Exception("bad datablock : don't end with ?<FS>", str(self.buf))
+        return Exception("bad datablock : missing ?<FS> at position %d" % len(self.buf), str(self.buf))
+
+    # states : return True when they moved on, False when more data is needed
+
+    def __start(self):
+        if len(self.buf) < 2: return False
+        if self.command in "rm" and self.buf[0] == ESC and self.buf[1] == ord("s"):
+            self.__state = self.__header
+        else:
+            self.block = False
+            self.__state = self.__status
+        return True
+
+    def __header(self):
+        if len(self.buf) < 4 and not self.block_only: return False
+        if self.buf[0:4] != escape_code+"s"+escape_code+"\x01":
+            return self.__fail("bad datablock : don't start with <ESC>s<ESC>[01]")
+        if self.command == "r" and self.block_only and self.buf[-2:] != "?"+end_code:
+            return self.__fail("bad datablock : don't end with ?<FS>")
+        self.block = True
+        self.__pos = 4
+        self.__state = self.__iso_strip if self.command == "r" else self.__raw_strip
+        return True
+
+    def __next_strip(self, end):
+        # <ESC>[02] or <ESC>[03] after a track
+        if len(self.buf) < end+2 and not self.block_only: return False
+        if self.buf[end:end+2] != escape_code+chr(self.__track+2):
+            return self.__fail("bad datablock : missing <ESC>[%02d] at position %d" % (self.__track+2, end))
+        self.__pos = end+2
+        self.__track += 1
+        return True
+
+    def __missing(self, error):
+        # more data is needed : wait for it, unless the datablock is all there
+        if not self.block_only: return False
+        self.error = error
+        self.__state = None
+        return False
+
+    def __iso_strip(self):
+        if self.__track == 2: return self.__iso_strip3()
+        start = self.__pos
+        end = self.buf.find(escape_code, start)
+        if end == -1: return self.__missing(ValueError("substring not found"))
+        if end == start:
+            end += 2 # blank track
+        else:
+            self.__strips[self.__track] = (start, end)
+        return self.__next_strip(end)
+
+    def __iso_strip3(self):
+        start = self.__pos
+        if len(self.buf) <= start: return self.__missing(IndexError("string index out of range"))
+        if self.block_only:
+            end = len(self.buf)-1
+        else:
+            end = self.buf.find(end_code, start)
+            if end == -1: return False
+            if self.buf[end-1] != QMARK:
+                return self.__fail("bad datablock : don't end with ?<FS>")
+        if self.buf[start] != ESC:
+            self.__strips[2] = (start, end-1)
+        return self.__block_end(end+1)
+
+    def __raw_strip(self):
+        start = self.__pos
+        if len(self.buf) <= start: return self.__missing(IndexError("string index out of range"))
+        end = start + 1 + self.buf[start] # first byte is length
+        if len(self.buf) < end and not self.block_only: return False
+        self.__strips[self.__track] = (start+1, min(end, len(self.buf)))
+        if self.__track < 2: return self.__next_strip(end)
+        # trailer
+        if len(self.buf) < end+2 and not self.block_only: return False
+        trailer = self.buf[end:] if self.block_only else self.buf[end:end+2]
+        if trailer != "?"+end_code:
+            return self.__fail("bad datablock : missing ?<FS> at position %d" % end)
+        return self.__block_end(end+2)
+
+    def __block_end(self, end):
+        self.__pos = end
+        self.block_done = True
+        if self.block_only:
+            # the datablock is all there
+            self.complete = True
+            self.__state = None
+            return False
+        self.__state = self.__status
+        return True
+
+    def __status(self):
+        pos = self.__pos
+        if len(self.buf) < pos+2: return False
+        if self.buf[pos] != ESC:
+            # unexpected data : wait for the end of the response and use its last <ESC>
+            self.__state = None
+            return False
+        status = chr(self.buf[pos+1])
+        end = pos+2
+        if self.command == "o" and status == "0":
+            end += 3 # selected bpc of each track
+            if len(self.buf) < end: return False
+        self.status = status
+        self.result = str(self.buf[pos+2:end])
+        self.end = end
+        self.complete = True
+        self.__state = None
+        return False
+
+def decode_isodatablock(data):
+    p = response("r", block_only=True)
+    p.feed(data)
+    return p.tracks()
+
+def decode_rawdatablock(data):
+    p = response("m", block_only=True)
+    p.feed(data)
+    return p.tracks()
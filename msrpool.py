@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+#
+# File: msrpool.py
+# Licence: GNU GPL version 3
+#
+# Pool of MSR605 devices sharing one job queue
+#
+# Each device is driven by its own worker thread. Jobs (read, write, erase,
+# or any other msr method) are taken from a shared queue by whichever
+# device is free, and their result or error is kept on the job.
+#
+
+import sys
+import time
+import threading
+import Queue
+import msr
+
+class job(object):
+    def __init__(self, operation, *args, **kwargs):
+        # operation : name of the msr method to call, e.g. "write_tracks"
+        self.operation = operation
+        self.args = args
+        self.kwargs = kwargs
+        self.device = None   # path of the device that ran the job
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.__done = threading.Event()
+
+    def wait(self, timeout=None):
+        # returns True when the job is done
+        self.__done.wait(timeout)
+        return self.__done.is_set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def duration(self):
+        if self.finished is None: return None
+        return self.finished - self.started
+
+    def _finish(self):
+        self.finished = time.time()
+        self.__done.set()
+
+class device_stats(object):
+    def __init__(self, path):
+        self.path = path
+        self.jobs = 0
+        self.errors = 0
+        self.busy = 0.0   # seconds spent running jobs
+        self.error = None # set when the device could not be opened
+
+class pool(object):
+    def __init__(self, dev_paths, factory=msr.msr):
+        # dev_paths : serial devices to drive, one worker thread each
+        # factory : called with a device path to open it, msr.msr by default
+        self.factory = factory
+        self.queue = Queue.Queue()
+        self.jobs = []
+        self.stats = {}
+        self.started = time.time()
+        self.__lock = threading.Lock()
+        self.__workers = []
+        self.__ready = threading.Semaphore(0)
+        for path in dev_paths:
+            self.stats[path] = device_stats(path)
+            t = threading.Thread(target=self.__worker, args=(path,), name="msr "+path)
+            t.daemon = True
+            t.start()
+            self.__workers.append(t)
+        for t in self.__workers:
+            self.__ready.acquire() # every device is open (or failed to)
+
+    def __worker(self, path):
+        stats = self.stats[path]
+        try:
+            dev = self.factory(path)
+        except Exception as e:
+            stats.error = e
+            self.__ready.release()
+            return
+        self.__ready.release()
+        try:
+            while True:
+                j = self.queue.get()
+                if j is None:
+                    self.queue.task_done()
+                    break
+                j.device = path
+                j.started = time.time()
+                try:
+                    j.result = getattr(dev, j.operation)(*j.args, **j.kwargs)
+                except Exception as e:
+                    j.error = e
+                j._finish()
+                with self.__lock:
+                    stats.jobs += 1
+                    stats.busy += j.duration()
+                    if j.error is not None: stats.errors += 1
+                self.queue.task_done()
+        finally:
+            dev.close()
+
+    def devices(self):
+        # paths of the devices that are open and taking jobs
+        return [path for path, s in self.stats.items() if s.error is None]
+
+    def submit(self, operation, *args, **kwargs):
+        if not self.devices():
+            raise Exception("no device available")
+        j = job(operation, *args, **kwargs)
+        self.jobs.append(j)
+        self.queue.put(j)
+        return j
+
+    def read(self):
+        return self.submit("read_tracks")
+
+    def read_raw(self):
+        return self.submit("read_raw_tracks")
+
+    def write(self, t1="", t2="", t3=""):
+        return self.submit("write_tracks", t1, t2, t3)
+
+    def write_raw(self, t1, t2, t3):
+        return self.submit("write_raw_tracks", t1, t2, t3)
+
+    def erase(self, t1=False, t2=False, t3=False):
+        return self.submit("erase_tracks", t1, t2, t3)
+
+    def join(self):
+        # wait for all submitted jobs
+        self.queue.join()
+
+    def close(self):
+        # finish the pending jobs, then stop the workers and close the devices
+        for t in self.__workers:
+            self.queue.put(None)
+        for t in self.__workers:
+            t.join()
+
+    def throughput(self):
+        # returns jobs per second : total, and per device path
+        elapsed = max(time.time() - self.started, 1e-6)
+        with self.__lock:
+            per_device = dict((path, s.jobs / elapsed) for path, s in self.stats.items())
+        return sum(per_device.values()), per_device
+
+    def report(self, out=sys.stdout):
+        total, per_device = self.throughput()
+        for path in sorted(self.stats):
+            s = self.stats[path]
+            if s.error is not None:
+                print >>out, "%s: not available (%s)" % (path, s.error)
+                continue
+            print >>out, "%s: %d jobs, %d errors, %.2f jobs/s, %.0f%% busy" % \
+                (path, s.jobs, s.errors, per_device[path], 100.0 * s.busy / max(time.time() - self.started, 1e-6))
+        print >>out, "total: %d jobs, %.2f jobs/s" % (sum(s.jobs for s in self.stats.values()), total)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="run the same operation on many cards across several devices")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument ('-r', '--read', action="store_true", help="read magnetic tracks")
+    group.add_argument ('-w', '--write', nargs=3, metavar=("T1", "T2", "T3"), help="write magnetic tracks (\"\" to skip a track)")
+    group.add_argument ('-e', '--erase', action="store_true", help="erase all magnetic tracks")
+    parser.add_argument('-n', '--count', type=int, default=1, help="number of cards")
+    parser.add_argument('devices', nargs="+", help="paths to serial communication devices")
+    args = parser.parse_args()
+
+    p = pool(args.devices)
+    try:
+        for i in range(args.count):
+            if args.read:
+                p.read()
+            elif args.write:
+                p.write(*args.write)
+            else:
+                p.erase(True, True, True)
+        for n, j in enumerate(p.jobs):
+            j.wait()
+            if j.error is not None:
+                print "card %d on %s: error: %s" % (n+1, j.device, j.error)
+            elif args.read:
+                print "card %d on %s: 1=%s 2=%s 3=%s" % ((n+1, j.device) + j.result)
+            else:
+                print "card %d on %s: done" % (n+1, j.device)
+        p.close()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print e
+    p.report()
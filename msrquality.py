@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+#
+# File: msrquality.py
+# Licence: GNU GPL version 3
+#
+# Swipe quality of each reader, to replace worn heads before they fail
+#
+# Each swipe adds a sample per track : characters read, parity errors,
+# trailing nulls and LRC error of a raw read, retries of a track written by
+# write_and_verify, or a failed swipe of the card. Samples go into a rolling
+# window of the last swipes of each device and track, kept with running sums
+# so a sample costs a few additions. The rates of the window are checked
+# against absolute limits, and against the baseline of the device (the rates
+# of its first full window) to catch a slow drift. Windows, baselines,
+# totals and active alerts are kept in a JSON file, across runs.
+#
+# Parity errors, trailing nulls and LRC errors only come from raw reads
+# (msr.py --raw, write_raw_and_verify) : an ISO read gives the characters
+# decoded by the device, or an error status. The bulk modes of msrtool.py
+# read in ISO mode, they only give failed swipes and rewrites.
+#
+# Quality is off unless a monitor is set on the driver:
+#
+#   msr.msr.quality = msrquality.monitor("quality.json")
+#
+
+import os
+import sys
+import json
+import time
+import collections
+
+# fields of a sample
+fields = ("reads", "chars", "perr", "nulls", "lrc", "writes", "retries", "swipes", "failed")
+READS, CHARS, PERR, NULLS, LRC, WRITES, RETRIES, SWIPES, FAILED = range(len(fields))
+
+# samples in a window, and before its rates are checked
+window_size = 200
+min_samples = 50
+# rates of a window are checked every check_every samples
+check_every = 10
+
+# rate -> highest acceptable value
+limits = {"parity": 0.02,   # characters with a parity error
+          "lrc": 0.05,      # tracks with an LRC error
+          "retries": 0.10,  # rewrites per track written
+          "failures": 0.05} # failed swipes
+# a rate drifting above drift times its baseline (plus a quarter of its limit) raises an alert too
+drift = 3.0
+# an alert is cleared when its rate is back under this share of the threshold
+clear = 0.8
+
+class window(object):
+    # last samples of a device and track, with their sums
+    __slots__ = ("samples", "sums", "count")
+
+    def __init__(self, samples=()):
+        self.samples = collections.deque()
+        self.sums = [0] * len(fields)
+        self.count = 0 # samples ever added
+        for s in samples: self.add(s)
+
+    def add(self, sample):
+        self.count += 1
+        self.samples.append(sample)
+        sums = self.sums
+        for i, v in enumerate(sample): sums[i] += v
+        if len(self.samples) > window_size:
+            for i, v in enumerate(self.samples.popleft()): sums[i] -= v
+
+    def rates(self):
+        s = self.sums
+        rates = {}
+        if s[READS]:
+            rates["lrc"] = s[LRC] / float(s[READS])
+            rates["nulls"] = s[NULLS] / float(s[READS])
+        if s[CHARS]: rates["parity"] = s[PERR] / float(s[CHARS])
+        if s[WRITES]: rates["retries"] = s[RETRIES] / float(s[WRITES])
+        if s[SWIPES]: rates["failures"] = s[FAILED] / float(s[SWIPES])
+        return rates
+
+def default_alert(device, track, rate, value, threshold):
+    print >>sys.stderr, "quality alert : %s %s : %s %.1f%% (threshold %.1f%%)" % (
+        device, "track %d" % track if track else "card", rate, value * 100, threshold * 100)
+
+class monitor(object):
+    def __init__(self, path=None, alert=default_alert, save_every=100):
+        # path : JSON file where the state is kept, None to keep it in memory
+        # alert : called with (device, track, rate, value, threshold) when a rate goes over its threshold
+        # save_every : samples between two saves
+        self.path = path
+        self.alert = alert
+        self.save_every = save_every
+        self.windows = {}    # (device, track) -> window, track 0 for the card
+        self.totals = {}     # (device, track) -> sums of every sample
+        self.baselines = {}  # (device, track) -> rates of the first full window
+        self.active = {}     # (device, track, rate) -> value, alerts not cleared yet
+        self.alerts = []     # (time, device, track, rate, value, threshold) of every alert
+        self.__unsaved = 0
+        self.__paths = {}    # device -> real path
+        if path is not None and os.path.exists(path): self.load()
+
+    def __key(self, device, track):
+        path = self.__paths.get(device)
+        if path is None: path = self.__paths[device] = os.path.realpath(device) if "/" in device else device
+        return (path, track)
+
+    def __add(self, key, sample):
+        w = self.windows.get(key)
+        if w is None: w = self.windows[key] = window()
+        w.add(sample)
+        totals = self.totals.get(key)
+        if totals is None: totals = self.totals[key] = [0] * len(fields)
+        for i, v in enumerate(sample): totals[i] += v
+        if w.count % check_every == 0 and len(w.samples) >= min_samples: self.__check(key, w)
+        self.__unsaved += 1
+        if self.path is not None and self.__unsaved >= self.save_every: self.save()
+
+    def __check(self, key, w):
+        rates = w.rates()
+        baseline = self.baselines.get(key)
+        if baseline is None and len(w.samples) >= window_size:
+            self.baselines[key] = baseline = rates
+        for rate, limit in limits.items():
+            value = rates.get(rate)
+            if value is None: continue
+            threshold = limit
+            if baseline is not None and rate in baseline:
+                threshold = min(limit, baseline[rate] * drift + limit / 4)
+            active = (key[0], key[1], rate)
+            if value > threshold:
+                if active in self.active: continue
+                self.active[active] = value
+                self.alerts.append((time.time(), key[0], key[1], rate, value, threshold))
+                if self.alert is not None: self.alert(key[0], key[1], rate, value, threshold)
+            elif value < threshold * clear:
+                self.active.pop(active, None)
+
+    # samples
+
+    def observe(self, device, track, result):
+        # result : (data, length, parity errors, lrc error) as returned by unpack_raw, None for a blank track
+        if result is None: return
+        data, length, perr, lrc_error = result
+        self.__add(self.__key(device, track), (1, len(data), perr.count("^"), length - len(data), 1 if lrc_error else 0, 0, 0, 0, 0))
+
+    def observe_tracks(self, device, results):
+        # results : unpack_raw results of the three tracks of a read
+        for n, result in enumerate(results): self.observe(device, n+1, result)
+
+    def written(self, device, track, retries):
+        # track was written and verified, after retries rewrites
+        self.__add(self.__key(device, track), (0, 0, 0, 0, 0, 1, retries, 0, 0))
+
+    def swipe(self, device, ok=True):
+        # a swipe of a card, failed if the device returned an error
+        self.__add(self.__key(device, 0), (0, 0, 0, 0, 0, 0, 0, 1, 0 if ok else 1))
+
+    # results
+
+    def rates(self, device, track):
+        w = self.windows.get(self.__key(device, track))
+        return w.rates() if w is not None else {}
+
+    def report(self, out=sys.stdout):
+        print >>out, "%-24s %-6s %7s %8s %8s %8s %8s %8s  %s" % ("device", "track", "samples", "parity", "lrc", "retries", "failures", "nulls", "baseline parity/lrc")
+        for key in sorted(self.windows):
+            device, track = key
+            r = self.windows[key].rates()
+            b = self.baselines.get(key)
+            def pct(rates, name):
+                return "%7.2f%%" % (rates[name] * 100) if name in rates else "       -"
+            print >>out, "%-24s %-6s %7d %s %s %s %s %8.1f  %s" % (device[-24:], track or "card",
+                len(self.windows[key].samples),
+                pct(r, "parity"), pct(r, "lrc"), pct(r, "retries"), pct(r, "failures"), r.get("nulls", 0),
+                "%s %s" % (pct(b, "parity").strip(), pct(b, "lrc").strip()) if b else "-")
+        for device, track, rate in sorted(self.active):
+            print >>out, "ALERT %s %s : %s" % (device, "track %d" % track if track else "card", rate)
+
+    # state
+
+    def load(self):
+        with open(self.path) as f:
+            state = json.load(f)
+        for entry in state.get("devices", []):
+            key = (str(entry["device"]), entry["track"])
+            self.windows[key] = window(tuple(s) for s in entry["window"])
+            self.totals[key] = entry["totals"]
+            if entry.get("baseline") is not None: self.baselines[key] = entry["baseline"]
+        for a in state.get("active", []):
+            # [device, track, rate, value], without the value in older files
+            self.active[(str(a[0]), a[1], str(a[2]))] = a[3] if len(a) > 3 else None
+
+    def save(self):
+        self.__unsaved = 0
+        if self.path is None: return
+        state = {"devices": [{"device": key[0], "track": key[1], "window": list(w.samples),
+                              "totals": self.totals[key], "baseline": self.baselines.get(key)}
+                             for key, w in self.windows.items()],
+                 "active": [list(a) + [value] for a, value in self.active.items()]}
+        tmp = self.path + ".%d" % os.getpid()
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp, self.path)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="report the swipe quality kept by msr.py --quality or MSRTOOL_QUALITY")
+    parser.add_argument('state', help="quality file")
+    args = parser.parse_args()
+    if not os.path.exists(args.state):
+        print "%s : no such file" % args.state
+        sys.exit(1)
+    monitor(args.state).report()
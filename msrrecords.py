@@ -0,0 +1,221 @@
+#!/usr/bin/env python2
+#
+# File: msrrecords.py
+# Licence: GNU GPL version 3
+#
+# Compact storage of decoded tracks, for analysis of large batches
+#
+# unpack_raw returns (data, total length, parity errors, lrc error), with
+# the parity errors as a string as long as the data. A track record keeps
+# them as a bitset (an int, bit n set if character n has a parity error) in
+# a __slots__ object. A batch keeps many tracks in columns : the data of
+# every track one after the other in a bytearray, with their offsets, and
+# the parity errors as one bitset over the same positions. Slicing a batch
+# gives a view of the same buffers, nothing is copied; only the batch
+# owning the buffers can be appended to.
+#
+
+import array
+import string
+
+_to_bits = string.maketrans(" ^", "01")
+_to_perr = string.maketrans("01", " ^")
+# number of 1 bits of each byte
+_popcount = [bin(n).count("1") for n in range(256)]
+
+LRC_ERROR = 1
+BLANK = 2
+
+def perr_mask(perr):
+    # parity error string ("^" under the bad characters) -> bitset
+    bits = perr.translate(_to_bits)[::-1]
+    return int(bits, 2) if bits else 0
+
+def perr_string(mask, length):
+    # bitset -> parity error string of length characters
+    return bin(mask)[2:].zfill(length)[::-1][0:length].translate(_to_perr)
+
+class track(object):
+    # a decoded track
+    __slots__ = ("data", "length", "perr", "lrc_error")
+
+    def __init__(self, data, length, perr=0, lrc_error=False):
+        self.data = data            # data without trailing nulls
+        self.length = length        # total length including trailing nulls
+        self.perr = perr            # parity errors, bitset
+        self.lrc_error = lrc_error
+
+    @staticmethod
+    def from_tuple(t):
+        # t : (data, length, parity errors, lrc error) as returned by unpack_raw
+        return track(t[0], t[1], perr_mask(t[2]), bool(t[3]))
+
+    def to_tuple(self):
+        return (self.data, self.length, perr_string(self.perr, len(self.data)), self.lrc_error)
+
+    def parity_errors(self):
+        return bin(self.perr).count("1")
+
+    def __eq__(self, other):
+        return isinstance(other, track) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "track(%r, %d, %s, %r)" % (self.data, self.length, bin(self.perr), self.lrc_error)
+
+class batch(object):
+    # decoded tracks (or None for blank ones) in columns
+    __slots__ = ("data", "perr", "offsets", "lengths", "flags", "start", "stop", "owner")
+
+    def __init__(self, tracks=()):
+        # tracks : unpack_raw tuples, track records or None
+        self.data = bytearray()             # data of every track
+        self.perr = bytearray()             # parity errors, bit n for data[n]
+        self.offsets = array.array("l", [0]) # track i is data[offsets[i]:offsets[i+1]]
+        self.lengths = array.array("l")     # total length of each track
+        self.flags = bytearray()            # LRC_ERROR, BLANK
+        self.start = 0                      # tracks of this view
+        self.stop = 0
+        self.owner = True                   # False for a slice, sharing the buffers
+        self.extend(tracks)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def append(self, t):
+        # t : unpack_raw tuple, track record or None
+        if not self.owner: raise Exception("batch : can't append to a slice")
+        if isinstance(t, track): t = t.to_tuple()
+        offset = len(self.data)
+        if t is None:
+            self.lengths.append(0)
+            self.flags.append(BLANK)
+        else:
+            data, length, perr, lrc_error = t
+            self.data.extend(data)
+            self.lengths.append(length)
+            self.flags.append(LRC_ERROR if lrc_error else 0)
+            end = offset + len(data)
+            if len(self.perr) * 8 < end: self.perr.extend("\0" * ((end+7) // 8 - len(self.perr)))
+            i = perr.find("^")
+            while i != -1:
+                bit = offset + i
+                self.perr[bit >> 3] |= 1 << (bit & 7)
+                i = perr.find("^", i+1)
+        self.offsets.append(len(self.data))
+        self.stop += 1
+
+    def extend(self, tracks):
+        for t in tracks: self.append(t)
+
+    def __index(self, i):
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError("batch index out of range")
+        return self.start + i
+
+    def __getitem__(self, i):
+        # a track record (None for a blank track), or a view for a slice
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1: raise Exception("batch : slices can't have a step")
+            view = batch.__new__(batch)
+            view.data, view.perr, view.offsets, view.lengths, view.flags = self.data, self.perr, self.offsets, self.lengths, self.flags
+            view.start = self.start + start
+            view.stop = self.start + max(start, stop)
+            view.owner = False
+            return view
+        i = self.__index(i)
+        if self.flags[i] & BLANK: return None
+        first, last = self.offsets[i], self.offsets[i+1]
+        return track(str(self.data[first:last]), self.lengths[i], self.__mask(first, last), bool(self.flags[i] & LRC_ERROR))
+
+    def __iter__(self):
+        for i in xrange(len(self)): yield self[i]
+
+    def __mask(self, first, last):
+        # parity errors of data[first:last], as an int
+        if first == last: return 0
+        chunk = self.perr[first >> 3:(last+7) >> 3]
+        mask = int(str(chunk[::-1]).encode("hex"), 16) >> (first & 7)
+        return mask & ((1 << (last-first)) - 1)
+
+    def tuple(self, i):
+        # unpack_raw tuple of track i, None for a blank track
+        t = self[i]
+        return None if t is None else t.to_tuple()
+
+    def tuples(self):
+        for i in xrange(len(self)): yield self.tuple(i)
+
+    def view(self, i):
+        # data of track i, as a memoryview of the buffer (None for a blank track)
+        # the batch can't be appended to while the view is alive
+        i = self.__index(i)
+        if self.flags[i] & BLANK: return None
+        return memoryview(self.data)[self.offsets[i]:self.offsets[i+1]]
+
+    # analysis of the whole view, without building the tracks
+
+    def blanks(self):
+        return sum(1 for f in self.flags[self.start:self.stop] if f & BLANK)
+
+    def lrc_errors(self):
+        return sum(1 for f in self.flags[self.start:self.stop] if f & LRC_ERROR)
+
+    def characters(self):
+        return self.offsets[self.stop] - self.offsets[self.start]
+
+    def parity_errors(self):
+        # characters with a parity error
+        first, last = self.offsets[self.start], self.offsets[self.stop]
+        if first == last: return 0
+        whole_first, whole_last = (first+7) >> 3, last >> 3
+        if whole_first > whole_last: # within one byte
+            return bin(self.__mask(first, last)).count("1")
+        count = sum(map(_popcount.__getitem__, self.perr[whole_first:whole_last]))
+        count += bin(self.__mask(first, whole_first << 3)).count("1")
+        count += bin(self.__mask(whole_last << 3, last)).count("1")
+        return count
+
+    def nbytes(self):
+        # memory used by the buffers
+        return (len(self.data) + len(self.perr) + len(self.flags) +
+                (len(self.offsets) + len(self.lengths)) * self.offsets.itemsize)
+
+class cards(object):
+    # decoded reads : one batch per track
+    __slots__ = ("tracks",)
+
+    def __init__(self, reads=()):
+        # reads : three unpack_raw tuples (or None) per card
+        self.tracks = (batch(), batch(), batch())
+        self.extend(reads)
+
+    def __len__(self):
+        return len(self.tracks[0])
+
+    def append(self, read):
+        for n in range(3): self.tracks[n].append(read[n])
+
+    def extend(self, reads):
+        for read in reads: self.append(read)
+
+    def __getitem__(self, i):
+        # the three track records of a card, or a view for a slice
+        if isinstance(i, slice):
+            view = cards.__new__(cards)
+            view.tracks = tuple(b[i] for b in self.tracks)
+            return view
+        return tuple(b[i] for b in self.tracks)
+
+    def __iter__(self):
+        for i in xrange(len(self)): yield self[i]
+
+    def tuples(self):
+        # the unpack_raw tuples of every card
+        for i in xrange(len(self)): yield tuple(b.tuple(i) for b in self.tracks)
+
+    def nbytes(self):
+        return sum(b.nbytes() for b in self.tracks)
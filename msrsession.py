@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+#
+# File: msrsession.py
+# Licence: GNU GPL version 3
+#
+# Scripted sessions : run a stream of commands over one connection
+#
+# Each line of the script is a command, either words (quoted as in a shell,
+# raw data with \x escapes) or a JSON object:
+#
+#   configure hico 777 hhh
+#   write "B1234^DOE/JOHN^" 1234=5678 ""
+#   read
+#   {"command": "read_raw_decoded", "args": ["777"], "id": "card 1"}
+#
+# Commands are the methods of the driver (read_tracks, write_tracks, ...),
+# a few short names (read, write, erase, hico, loco, bpc, bpi), sleep, and
+# read_raw_decoded. Empty lines and lines starting with # are skipped. Each
+# command gives a JSON line with its result or error and its duration;
+# strings are latin-1 as for msrd.py. The session stops at the first error
+# unless told to keep going.
+#
+
+import sys
+import json
+import time
+import shlex
+import msr
+import msrd
+
+def flag(value):
+    # "1", "true", "yes", True...
+    if isinstance(value, basestring): return value.lower() in ("1", "true", "yes", "y", "h", "hico")
+    return bool(value)
+
+def bpc(args):
+    # "777" or 7, 7, 7
+    if len(args) == 1 and isinstance(args[0], basestring): return [ord(c)-48 for c in args[0]]
+    return [int(a) for a in args]
+
+def tracks(args):
+    # "123", "13"... or three flags, every track by default
+    if not args: return [True, True, True]
+    if len(args) == 1 and isinstance(args[0], basestring): return [str(n) in args[0] for n in (1, 2, 3)]
+    return [flag(a) for a in args]
+
+def bpi(args):
+    # "hlh" or three flags
+    if len(args) == 1 and isinstance(args[0], basestring): return [c != "l" for c in args[0]]
+    return [flag(a) for a in args]
+
+def configure(dev, args):
+    # coercivity (hico/loco), bpc ("777") and bpi ("hlh"), - to leave one alone
+    args = (list(args) + ["-", "-", "-"])[0:3]
+    return dev.configure(None if args[0] == "-" else flag(args[0]),
+                         None if args[1] == "-" else bpc([args[1]]),
+                         None if args[2] == "-" else bpi([args[2]]))
+
+def read_raw_decoded(dev, args):
+    # raw read, decoded with the bpc given ("888" by default) : an unpack_raw result per track
+    b = bpc(args) if args else [8, 8, 8]
+    raws = dev.read_raw_tracks()
+    maps = [(msr.msr.track1_map, 6), (msr.msr.track23_map, 4), (msr.msr.track23_map, 4)]
+    return [msr.msr.unpack_raw(raws[n], maps[n][0], maps[n][1], b[n]) if raws[n] else None for n in range(3)]
+
+# command -> function(dev, args) returning the result
+commands = {
+    "read_tracks":          lambda dev, args: dev.read_tracks(),
+    "read_raw_tracks":      lambda dev, args: dev.read_raw_tracks(),
+    "read_raw_decoded":     read_raw_decoded,
+    "write_tracks":         lambda dev, args: dev.write_tracks(*args),
+    "write_raw_tracks":     lambda dev, args: dev.write_raw_tracks(*args),
+    "write_and_verify":     lambda dev, args: dev.write_and_verify(*args),
+    "write_raw_and_verify": lambda dev, args: dev.write_raw_and_verify(*args),
+    "erase_tracks":         lambda dev, args: dev.erase_tracks(*tracks(args)),
+    "erase_and_write":      lambda dev, args: dev.erase_and_write(*args),
+    "erase_and_write_raw":  lambda dev, args: dev.erase_and_write_raw(*args),
+    "configure":            configure,
+    "set_bpc":              lambda dev, args: dev.set_bpc(*bpc(args)),
+    "set_bpi":              lambda dev, args: dev.set_bpi(*bpi(args)),
+    "set_coercivity":       lambda dev, args: dev.set_coercivity(flag(args[0])),
+    "get_coercivity":       lambda dev, args: "hico" if dev.get_coercivity() else "loco",
+    "reset":                lambda dev, args: dev.reset(),
+    "invalidate":           lambda dev, args: dev.invalidate(),
+    "resync":               lambda dev, args: dev.resync(),
+    "hico":                 lambda dev, args: dev.set_coercivity(msr.msr.hico),
+    "loco":                 lambda dev, args: dev.set_coercivity(msr.msr.loco),
+    "sleep":                lambda dev, args: time.sleep(float(args[0])),
+}
+aliases = {"read": "read_tracks", "read_raw": "read_raw_tracks", "write": "write_tracks",
+           "write_raw": "write_raw_tracks", "erase": "erase_tracks", "bpc": "set_bpc", "bpi": "set_bpi"}
+
+def parse(line):
+    # returns (command, args, id), None for an empty line or a comment
+    line = line.strip()
+    if line == "" or line.startswith("#"): return None
+    if line.startswith("{"):
+        c = msrd.from_json(json.loads(line))
+        command, args, id = c.get("command"), c.get("args", []), c.get("id")
+        if not isinstance(args, list): args = [args]
+    else:
+        words = shlex.split(line)
+        command, args, id = words[0], [w.decode("string_escape") for w in words[1:]], None
+    command = aliases.get(command, command)
+    if command not in commands: raise Exception("unknown command %s" % command)
+    return command, args, id
+
+def run(dev, lines, out=sys.stdout, keep_going=False):
+    # runs the commands of lines on dev, writes a JSON line per command to out
+    # returns the number of failed commands
+    failed = 0
+    for number, line in enumerate(lines, 1):
+        result = {"line": number}
+        started = time.time()
+        try:
+            c = parse(line)
+            if c is None: continue
+            command, args, id = c
+            result["command"] = command
+            if id is not None: result["id"] = id
+            result["result"] = msrd.to_json(commands[command](dev, args))
+            result["ok"] = True
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            result["ok"] = False
+            result["error"] = str(e)
+            failed += 1
+        result["seconds"] = round(time.time() - started, 6)
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        if not result["ok"] and not keep_going: break
+    return failed
@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+#
+# File: msrsim.py
+# Licence: GNU GPL version 3
+#
+# MSR605 simulator on a pseudo-terminal
+#
+# Emulates the serial protocol of the MSR605 (<ESC> commands, <ESC>s ... ?<FS>
+# datablocks, <ESC><status> responses) on a pty, so msr.py and msrtool.py can
+# be run and measured without hardware:
+#
+#   sim = msrsim.simulator(swipe_delay=0.5)
+#   dev = msr.msr(sim.path)
+#
+# Supported commands : a (reset), r/m (iso/raw read), w/n (iso/raw write),
+# c (erase), o (set bpc), b (set bpi), x/y (set hico/loco), d (get hico/loco).
+# A reset received while waiting for a swipe aborts the pending command, and
+# the device can be deaf for a while after a reset.
+# Failures can be injected : error statuses, silence, or damaged writes.
+#
+
+import os
+import sys
+import tty
+import time
+import random
+import select
+import threading
+
+ESC = "\x1B"
+FS = "\x1C"
+
+class card(object):
+    # content of the simulated card : iso tracks (without sentinels) and raw tracks
+    def __init__(self, t1="", t2="", t3=""):
+        self.tracks = [t1, t2, t3]
+        self.raw_tracks = ["", "", ""]
+
+class simulator(object):
+    def __init__(self, swipe_delay=0.0, baud=None, error_rate=0.0, content=None, reset_time=0.0):
+        # swipe_delay : seconds before a read/write/erase is answered (time to swipe the card)
+        # baud : if set, responses are sent at this line speed, 9600 for the real device
+        # error_rate : probability for a swipe to fail with status "1"
+        # content : card initially in the reader
+        # reset_time : seconds after a reset during which commands are dropped
+        self.swipe_delay = swipe_delay
+        self.baud = baud
+        self.error_rate = error_rate
+        self.reset_time = reset_time
+        self.card = content or card()
+        self.coercivity = "H"
+        self.bpc = [8, 8, 8]
+        self.bpi = [None, None, None]
+        self.commands = []     # every command received, in order
+        self.__injected = []   # statuses to return for the next commands, None to stay silent
+        self.__damaged = [0, 0, 0] # next writes of each track stored wrong
+        self.__lock = threading.Lock()
+        self.__buf = ""
+        self.__running = True
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self.__run, name="msrsim "+self.path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def inject(self, status, count=1):
+        # answer the next count commands with status (e.g. "1", "4"),
+        # or not at all if status is None
+        with self.__lock:
+            self.__injected.extend([status] * count)
+
+    def damage(self, track, count=1):
+        # the next count writes of track (1 to 3) succeed, but store altered data
+        with self.__lock:
+            self.__damaged[track-1] += count
+
+    def __stored(self, n, data):
+        with self.__lock:
+            if not self.__damaged[n] or data == "": return data
+            self.__damaged[n] -= 1
+        return chr(ord(data[0]) ^ 1) + data[1:]
+
+    def close(self):
+        self.__running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # low level i/o
+
+    def __fill(self, timeout=None):
+        # wait up to timeout for input, False if nothing came
+        deadline = None if timeout is None else time.time() + timeout
+        while self.__running:
+            wait = 0.1 if deadline is None else min(deadline - time.time(), 0.1)
+            r, _, _ = select.select([self.master], [], [], max(wait, 0))
+            if r:
+                self.__buf += os.read(self.master, 4096)
+                return True
+            if deadline is not None and time.time() >= deadline: return False
+        raise EOFError()
+
+    def __take(self, n):
+        while len(self.__buf) < n: self.__fill()
+        data = self.__buf[0:n]
+        self.__buf = self.__buf[n:]
+        return data
+
+    def __take_until(self, end):
+        while self.__buf.find(end) == -1: self.__fill()
+        pos = self.__buf.index(end) + len(end)
+        data = self.__buf[0:pos]
+        self.__buf = self.__buf[pos:]
+        return data
+
+    def __send(self, data):
+        if self.baud:
+            time.sleep(len(data) * 10.0 / self.baud) # 8 bits + start + stop
+        os.write(self.master, data)
+
+    def __command_length(self, buf, pos):
+        # length of the command at buf[pos:], None if it isn't all there yet
+        # a byte other than <ESC> is skipped alone, as by __run
+        if buf[pos] != ESC: return 1
+        if pos+2 > len(buf): return None
+        command = buf[pos+1]
+        if command == "w":
+            end = buf.find("?"+FS, pos+2)
+            return end + 2 - pos if end != -1 else None
+        if command == "n":
+            i = pos + 4 # <ESC>n<ESC>s
+            while True:
+                if i+2 > len(buf): return None
+                if buf[i:i+2] == "?"+FS: return i + 2 - pos
+                if i+3 > len(buf): return None
+                i += 3 + ord(buf[i+2])
+        length = {"c": 3, "b": 3, "o": 5}.get(command, 2)
+        return length if pos+length <= len(buf) else None
+
+    def __reset_pos(self):
+        # position of a reset command in the buffer, -1 if none
+        # only <ESC>a at the start of a command counts, not the same bytes in
+        # the data of a command sent behind the one waiting for the swipe
+        pos = 0
+        while pos < len(self.__buf):
+            if self.__buf[pos:pos+2] == ESC+"a": return pos
+            length = self.__command_length(self.__buf, pos)
+            if length is None: return -1
+            pos += length
+        return -1
+
+    def __swipe(self):
+        # wait for the card to be swiped, False if a reset came in meanwhile
+        deadline = time.time() + self.swipe_delay
+        while True:
+            pos = self.__reset_pos()
+            if pos != -1:
+                self.__buf = self.__buf[pos+2:]
+                self.commands.append("a")
+                self.__cmd_a()
+                return False
+            remaining = deadline - time.time()
+            if remaining <= 0: return True
+            self.__fill(remaining)
+
+    def __status(self):
+        with self.__lock:
+            if self.__injected: return self.__injected.pop(0)
+        if self.error_rate and random.random() < self.error_rate: return "1"
+        return "0"
+
+    # protocol
+
+    def __run(self):
+        try:
+            while True:
+                if self.__take(1) != ESC: continue
+                command = self.__take(1)
+                self.commands.append(command)
+                handler = getattr(self, "_simulator__cmd_"+command, None)
+                if handler is not None: handler()
+        except (EOFError, OSError):
+            pass
+
+    def __cmd_a(self):
+        # what comes in during the reset time is lost
+        if not self.reset_time: return
+        deadline = time.time() + self.reset_time
+        while True:
+            self.__buf = ""
+            remaining = deadline - time.time()
+            if remaining <= 0: return
+            self.__fill(remaining)
+
+    def __reply(self, status, data="", result=""):
+        if status is None: return
+        self.__send(data + ESC + status + result)
+
+    def __cmd_r(self):
+        if not self.__swipe(): return
+        status = self.__status()
+        block = ESC+"s"
+        sentinels = ["%", ";", ";"]
+        for n in range(3):
+            block += ESC + chr(n+1)
+            t = self.card.tracks[n]
+            if t and status == "0": block += sentinels[n] + t + "?"
+            else: block += ESC + "+" # blank track
+        block += "?"+FS
+        self.__reply(status, block)
+
+    def __cmd_m(self):
+        if not self.__swipe(): return
+        status = self.__status()
+        block = ESC+"s"
+        for n in range(3):
+            t = self.card.raw_tracks[n] if status == "0" else ""
+            block += ESC + chr(n+1) + chr(len(t)) + t
+        block += "?"+FS
+        self.__reply(status, block)
+
+    def __cmd_w(self):
+        block = self.__take_until("?"+FS)
+        if not self.__swipe(): return
+        status = self.__status()
+        if status == "0":
+            # <ESC>s<ESC>[01]t1<ESC>[02]t2<ESC>[03]t3?<FS>
+            parts = block[2:-2].split(ESC)
+            for part in parts[1:]:
+                n = ord(part[0])-1
+                if part[1:] != "": self.card.tracks[n] = self.__stored(n, part[1:])
+        self.__reply(status)
+
+    def __cmd_n(self):
+        self.__take(2) # <ESC>s
+        written = {}
+        while True:
+            head = self.__take(2)
+            if head == "?"+FS: break
+            length = ord(self.__take(1))
+            written[ord(head[1])-1] = self.__take(length)
+        if not self.__swipe(): return
+        status = self.__status()
+        if status == "0":
+            for n, t in written.items(): self.card.raw_tracks[n] = self.__stored(n, t)
+        self.__reply(status)
+
+    def __cmd_c(self):
+        mask = ord(self.__take(1))
+        if not self.__swipe(): return
+        status = self.__status()
+        if status == "0":
+            for n in range(3):
+                if mask & (1<<n):
+                    self.card.tracks[n] = ""
+                    self.card.raw_tracks[n] = ""
+        self.__reply(status)
+
+    def __cmd_o(self):
+        bpc = self.__take(3)
+        status = self.__status()
+        if status == "0":
+            self.bpc = [ord(c) for c in bpc]
+            self.__reply(status, result=bpc)
+        else:
+            self.__reply(status)
+
+    def __cmd_b(self):
+        mode = ord(self.__take(1))
+        status = self.__status()
+        modes = {0xA1: (0, 210), 0xA0: (0, 75), 0xD2: (1, 210), 0x4B: (1, 75), 0xC1: (2, 210), 0xC0: (2, 75)}
+        if mode not in modes: status = "A"
+        if status == "0":
+            track, bpi = modes[mode]
+            self.bpi[track] = bpi
+        self.__reply(status)
+
+    def __cmd_x(self):
+        status = self.__status()
+        if status == "0": self.coercivity = "H"
+        self.__reply(status)
+
+    def __cmd_d(self):
+        self.__reply(self.coercivity)
+
+    def __cmd_y(self):
+        status = self.__status()
+        if status == "0": self.coercivity = "L"
+        self.__reply(status)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="simulate a MSR605 on a pseudo-terminal")
+    parser.add_argument('-s', '--swipe', type=float, default=1.0, help="seconds to wait for a swipe")
+    parser.add_argument('-b', '--baud', type=int, default=9600, help="line speed of responses, 0 for unlimited")
+    parser.add_argument('-r', '--reset-time', type=float, default=0.0, help="seconds during which commands are dropped after a reset")
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0, help="probability for a swipe to fail")
+    parser.add_argument('data', nargs="*", help="initial content of tracks 1, 2 and 3")
+    args = parser.parse_args()
+
+    sim = simulator(args.swipe, args.baud, args.error_rate, card(*args.data), args.reset_time)
+    print "simulated MSR605 on %s, ^C to stop" % sim.path
+    sys.stdout.flush()
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,175 @@
+#!/usr/bin/env python2
+#
+# File: msrstore.py
+# Licence: GNU GPL version 3
+#
+# Card store : reads kept in a SQLite database, with duplicate detection
+#
+# Each read is appended with its time and device. Rows are buffered and
+# committed in batches, so a swipe doesn't wait for the disk. A 64 bits
+# digest of the three tracks is kept in memory for every card stored, so
+# "seen this card before ?" is a dict lookup, whatever the size of the store.
+# Each track also has an indexed digest column, for lookups by track content.
+#
+
+import sys
+import time
+import json
+import struct
+import hashlib
+import sqlite3
+
+schema = """
+create table if not exists cards (
+    id integer primary key,
+    time real not null,
+    device text,
+    t1 text, t2 text, t3 text,
+    digest integer not null,
+    h1 integer, h2 integer, h3 integer
+);
+create index if not exists cards_digest on cards (digest);
+create index if not exists cards_h1 on cards (h1);
+create index if not exists cards_h2 on cards (h2);
+create index if not exists cards_h3 on cards (h3);
+"""
+
+def digest(data):
+    # signed 64 bits integer, as stored by SQLite
+    return struct.unpack(">q", hashlib.sha1(data).digest()[0:8])[0]
+
+def track_digest(t):
+    return None if t is None else digest(t)
+
+def card_digest(t1, t2, t3):
+    # blank tracks (None) and empty ones are told apart
+    return digest("\x1c".join("\x1d" if t is None else t for t in (t1, t2, t3)))
+
+class store(object):
+    def __init__(self, path, batch=100, interval=2.0):
+        # batch : rows buffered before a commit
+        # interval : seconds after which buffered rows are committed anyway, on the next add
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(schema)
+        self.__pending = []
+        self.__flushed = time.time()
+        # digest -> id of the first card stored with it
+        self.__seen = {}
+        self.next_id = 1
+        for id, d in self.db.execute("select id, digest from cards order by id"):
+            self.__seen.setdefault(d, id)
+            self.next_id = id+1
+
+    def __len__(self):
+        return self.next_id - 1
+
+    def seen(self, t1, t2, t3):
+        # id of the card stored with the same tracks, None if there is none
+        id = self.__seen.get(card_digest(t1, t2, t3))
+        if id is None: return None
+        # 64 bits digests hardly collide, but make sure
+        row = self.get(id)
+        return id if row is not None and row[3:6] == (t1, t2, t3) else None
+
+    def add(self, t1, t2, t3, device=None):
+        # stores a read, returns (its id, id of the card it duplicates or None)
+        d = card_digest(t1, t2, t3)
+        first = self.seen(t1, t2, t3) if d in self.__seen else None
+        id = self.next_id
+        self.next_id += 1
+        self.__pending.append((id, time.time(), device, t1, t2, t3, d,
+                               track_digest(t1), track_digest(t2), track_digest(t3)))
+        self.__seen.setdefault(d, id)
+        if len(self.__pending) >= self.batch or time.time() - self.__flushed >= self.interval:
+            self.flush()
+        return id, first
+
+    def flush(self):
+        if self.__pending:
+            self.db.executemany("insert into cards values (?,?,?,?,?,?,?,?,?,?)", self.__pending)
+            self.db.commit()
+            self.__pending = []
+        self.__flushed = time.time()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    # queries, on committed and buffered rows
+
+    def get(self, id):
+        # (id, time, device, t1, t2, t3) of a card, None if there is none
+        for row in self.__pending:
+            if row[0] == id: return row[0:6]
+        return self.db.execute("select id, time, device, t1, t2, t3 from cards where id = ?", (id,)).fetchone()
+
+    def lookup(self, t1=None, t2=None, t3=None):
+        # (id, time, device, t1, t2, t3) of every card with the given tracks, others ignored
+        self.flush()
+        where = []
+        args = []
+        for n, t in enumerate((t1, t2, t3)):
+            if t is None: continue
+            where.append("h%d = ? and t%d = ?" % (n+1, n+1))
+            args.extend([digest(t), t])
+        if not where: raise Exception("lookup : no track given")
+        return self.db.execute("select id, time, device, t1, t2, t3 from cards where %s order by id"
+                               % " and ".join(where), args).fetchall()
+
+    def duplicates(self):
+        # (digest, count, first id) of every card stored more than once
+        self.flush()
+        return self.db.execute("select digest, count(*), min(id) from cards group by digest having count(*) > 1").fetchall()
+
+    def rows(self):
+        # (id, time, device, t1, t2, t3) of every card, by id
+        self.flush()
+        return self.db.execute("select id, time, device, t1, t2, t3 from cards order by id")
+
+    def export(self, out=sys.stdout, format="jsonl"):
+        # writes every card to out, returns the number of cards
+        rows = self.rows()
+        count = 0
+        if format == "csv":
+            import csv
+            w = csv.writer(out)
+            w.writerow(["id", "time", "device", "t1", "t2", "t3"])
+            for row in rows:
+                w.writerow(["" if v is None else v for v in row])
+                count += 1
+        else:
+            for id, t, device, t1, t2, t3 in rows:
+                out.write(json.dumps({"id": id, "time": t, "device": device, "t1": t1, "t2": t2, "t3": t3}) + "\n")
+                count += 1
+        return count
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="query a card store filled by the bulk read of msrtool.py")
+    parser.add_argument('store', help="card store (SQLite database)")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-x', '--export', choices=["csv", "jsonl"], help="write every card to stdout")
+    group.add_argument('-l', '--lookup', nargs=3, metavar=("T1", "T2", "T3"), help="cards with these tracks, - to ignore a track")
+    group.add_argument('-D', '--duplicates', action="store_true", help="cards stored more than once")
+    args = parser.parse_args()
+
+    s = store(args.store)
+    try:
+        if args.export:
+            s.export(sys.stdout, args.export)
+        elif args.lookup:
+            for row in s.lookup(*[None if t == "-" else t for t in args.lookup]):
+                print "%d %s %s %r %r %r" % ((row[0], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[1])), row[2]) + tuple(row[3:6]))
+        else:
+            for d, count, first in s.duplicates():
+                row = s.get(first)
+                print "%d times, first #%d : %r %r %r" % ((count, first) + tuple(row[3:6]))
+    except Exception as e:
+        print e
+        sys.exit(1)
+    finally:
+        s.close()
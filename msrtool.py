@@ -1,22 +1,98 @@
 #!/usr/bin/env python2
+import os
 import sys
+import time
 import msr
+import msrbatch
+import msrfields
+import msrmetrics
+import msrquality
+import msrstore
+import msrmanifest
 import tty
 import termios
 
 if len(sys.argv) < 2:
     print "USAGE: ./msrtool.py <SERIALDEVICE>"
+    print "       ./msrtool.py --tui <SERIALDEVICE> [<SERIALDEVICE> ...]"
     sys.exit()
 
+if sys.argv[1] == "--tui":
+    # event driven UI, several readers, keys work while a swipe is pending
+    if os.environ.get("MSRTOOL_METRICS") or os.environ.get("MSRTOOL_QUALITY"):
+        # the event driven driver has neither
+        print "MSRTOOL_METRICS and MSRTOOL_QUALITY don't work with --tui"
+        sys.exit(1)
+    import msrtui
+    try:
+        msrtui.tui(sys.argv[2:]).run()
+    except KeyboardInterrupt:
+        pass
+    sys.exit()
+
+# MSRTOOL_METRICS=<file> : export metrics to file every 10s (Prometheus text, or JSON if it ends with .json)
+exporter = None
+if os.environ.get("MSRTOOL_METRICS"):
+    exporter = msrmetrics.start(os.environ["MSRTOOL_METRICS"])
+
+# MSRTOOL_QUALITY=<file> : keep the swipe quality of the device in file, alerts are printed (see msrquality.py)
+# the modes read in ISO mode : failed swipes and rewrites only, no parity or LRC errors
+if os.environ.get("MSRTOOL_QUALITY"):
+    msr.msr.quality = msrquality.monitor(os.environ["MSRTOOL_QUALITY"])
+
 dev = msr.msr(sys.argv[1])
 
 
+def swiped(mode, ok=True):
+    # counts a card of a bulk mode
+    if msr.msr.metrics is not None: msr.msr.metrics.swipe(mode, ok)
+
+
+def print_fields(t1, t2):
+    # ISO 7813 fields of a financial card, nothing for other cards
+    c = msrfields.parse(t1, t2)
+    if not c.flags & (msrfields.TRACK1 | msrfields.TRACK2): return
+    print "Card: %s %s exp %s svc %s%s" % (c.pan, c.name, c.expiry or "-", c.service or "-",
+        "" if c.valid() else " *** %s ***" % msrfields.flag_string(c.flags & msrfields.ERRORS).upper())
+
+
 def mode_read(dev):
     print "[r] swipe card to read, ^C to cancel"
     t1, t2, t3 = dev.read_tracks()
     print "Track 1:", t1
     print "Track 2:", t2
     print "Track 3:", t3
+    print_fields(t1, t2)
+
+
+def bulk_read(dev):
+    print "[R] Card store (default cards.db):",
+    path = raw_input().strip() or "cards.db"
+    store = msrstore.store(path)
+    print "%d cards already stored." % len(store)
+    try:
+        while True:
+            print "[R] swipe card to read, ^C to stop"
+            try:
+                t1, t2, t3 = dev.read_tracks()
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                swiped("bulk_read", False)
+                print "Failed. Error:", e
+                continue
+            swiped("bulk_read")
+            print "Track 1:", t1
+            print "Track 2:", t2
+            print "Track 3:", t3
+            print_fields(t1, t2)
+            id, first = store.add(t1, t2, t3, dev.port)
+            if first is None:
+                print "Stored as card #%d." % id
+            else:
+                print "\a*** DUPLICATE *** card #%d is the same as card #%d" % (id, first)
+    finally:
+        store.close()
 
 
 def mode_compare(dev):
@@ -27,7 +103,7 @@ def mode_compare(dev):
     print "Track 3:", t3
     print "[r] swipe card to compare, ^C to cancel"
     b1, b2, b3 = dev.read_tracks()
-    if b1 == t1 and b2 == t2 and t3 == t3:
+    if b1 == t1 and b2 == t2 and b3 == t3:
         print "Compare OK"
     else:
         print "Track 1:", b1
@@ -37,6 +113,13 @@ def mode_compare(dev):
 
 
 def bulk_compare(dev):
+    print "[M] Manifest file (CSV or JSONL, Enter to compare against a swiped card):",
+    path = raw_input().strip()
+    if path != "":
+        m = msrmanifest.load(path)
+        print "%d cards in the manifest." % m.size
+        msrmanifest.run(dev, m, swiped=lambda ok: swiped("bulk_compare", ok)).report()
+        return
     print "[r] swipe card to read, ^C to cancel"
     t1, t2, t3 = dev.read_tracks()
     print "Track 1:", t1
@@ -48,7 +131,8 @@ def bulk_compare(dev):
             b1, b2, b3 = dev.read_tracks()
         except KeyboardInterrupt:
             break
-        if b1 == t1 and b2 == t2 and t3 == t3:
+        swiped("bulk_compare")
+        if b1 == t1 and b2 == t2 and b3 == t3:
             print "Compare OK"
         else:
             print "Track 1:", b1
@@ -71,11 +155,11 @@ def mode_copy(dev):
     print "Track 3:", t3
     kwargs = {}
     if t1 is not None:
-        kwargs['t1'] = t1[1:-1]
+        kwargs['t1'] = msrfields.strip(t1)
     if t2 is not None:
-        kwargs['t2'] = t2[1:-1]
+        kwargs['t2'] = msrfields.strip(t2)
     if t3 is not None:
-        kwargs['t3'] = t3[1:-1]
+        kwargs['t3'] = msrfields.strip(t3)
     print "[c] swipe card to write, ^C to cancel"
     dev.write_tracks(**kwargs)
     print "Written."
@@ -89,19 +173,21 @@ def bulk_copy(dev):
     print "Track 3:", t3
     kwargs = {}
     if t1 is not None:
-        kwargs['t1'] = t1[1:-1]
+        kwargs['t1'] = msrfields.strip(t1)
     if t2 is not None:
-        kwargs['t2'] = t2[1:-1]
+        kwargs['t2'] = msrfields.strip(t2)
     if t3 is not None:
-        kwargs['t3'] = t3[1:-1]
+        kwargs['t3'] = msrfields.strip(t3)
     while True:
         try:
             print "[c] swipe card to write, ^C to cancel"
             dev.write_tracks(**kwargs)
+            swiped("bulk_copy")
             print "Written."
         except KeyboardInterrupt:
             break
         except Exception as e:
+            swiped("bulk_copy", False)
             print "Failed. Error:", e
             break
 
@@ -147,9 +233,116 @@ def bulk_write(dev):
             dev.write_tracks(**kwargs)
         except KeyboardInterrupt:
             break
+        except Exception:
+            swiped("bulk_write", False)
+            raise
+        swiped("bulk_write")
         print "Written."
 
 
+def bulk_erase(dev):
+    print "[E] Data to write on each erased card (recycle). Enter for erasing a track."
+    print "Track 1:",
+    t1 = raw_input().strip()
+    print "Track 2:",
+    t2 = raw_input().strip()
+    print "Track 3:",
+    t3 = raw_input().strip()
+    if t1 == t2 == t3 == "" or (t1 and t2 and t3):
+        prompt = "[E] swipe card to %s, ^C to stop" % ("erase" if t1 == "" else "write")
+    else:
+        prompt = "[E] swipe card twice (erase, then write), ^C to stop"
+    cards = 0
+    started = time.time()
+    while True:
+        print prompt
+        try:
+            dev.erase_and_write(t1, t2, t3)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            swiped("bulk_erase", False)
+            print "Failed. Error:", e
+            continue
+        swiped("bulk_erase")
+        cards += 1
+        print "Done (%d cards, %.1f cards/min)." % (cards, cards * 60.0 / (time.time() - started))
+
+
+def verify_prompt(step, tracks):
+    if step == "write":
+        print "[V] swipe card to write track %s, ^C to stop" % ", ".join(str(n) for n in tracks)
+    else:
+        print "[V] swipe card again to verify, ^C to stop"
+
+
+def verify_loop(dev, mode, kwargs):
+    # writes and verifies cards until ^C, with the rate of swipes per good card
+    cards = 0
+    failed = 0
+    swipes = 0
+    while True:
+        try:
+            swipes += dev.write_and_verify(prompt=verify_prompt, **kwargs)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            swipes += getattr(e, "swipes", 0)
+            failed += 1
+            swiped(mode, False)
+            print "Failed. Error:", e
+            continue
+        cards += 1
+        swiped(mode)
+        print "Verified. (%d good cards, %d failed, %.2f swipes per good card)" % (cards, failed, swipes / float(cards))
+
+
+def mode_write_verify(dev):
+    print "[v] Input your data. Enter for not writing to a track."
+    print "Track 1:",
+    t1 = raw_input().strip()
+    print "Track 2:",
+    t2 = raw_input().strip()
+    print "Track 3:",
+    t3 = raw_input().strip()
+    swipes = dev.write_and_verify(t1, t2, t3, prompt=verify_prompt)
+    print "Verified. (%d swipes)" % swipes
+
+
+def bulk_write_verify(dev):
+    print "[V] Input your data. Enter for not writing to a track."
+    print "Track 1:",
+    t1 = raw_input().strip()
+    print "Track 2:",
+    t2 = raw_input().strip()
+    print "Track 3:",
+    t3 = raw_input().strip()
+    verify_loop(dev, "bulk_write_verify", {'t1': t1, 't2': t2, 't3': t3})
+
+
+def bulk_copy_verify(dev):
+    print "[Y] swipe card to read, ^C to cancel"
+    t1, t2, t3 = dev.read_tracks()
+    print "Track 1:", t1
+    print "Track 2:", t2
+    print "Track 3:", t3
+    kwargs = {}
+    if t1 is not None:
+        kwargs['t1'] = msrfields.strip(t1)
+    if t2 is not None:
+        kwargs['t2'] = msrfields.strip(t2)
+    if t3 is not None:
+        kwargs['t3'] = msrfields.strip(t3)
+    verify_loop(dev, "bulk_copy_verify", kwargs)
+
+
+def batch_write(dev):
+    print "[b] Job file (CSV or JSONL, one card per line, or a *.template.json card template):",
+    path = raw_input().strip()
+    written, invalid, failed = msrbatch.run(dev, msrbatch.job_records(path), msrbatch.checkpoint(path + ".checkpoint"), ahead=16)
+    print "Done. %d written, %d invalid records, %d failed." % (written, invalid, failed)
+
+
 def settings(dev):
     print """
 Settings
@@ -175,6 +368,8 @@ Settings
 
 def quit(dev):
     print "[q] bye."
+    if exporter is not None: exporter.stop()
+    if msr.msr.quality is not None: msr.msr.quality.save()
     sys.exit(0)
 
 
@@ -185,6 +380,8 @@ What do you want to do?
 (R) bulk read    (W) bulk write   (C) bulk copy
 (m) compare      (e) erase        (s) settings
 (M) bulk compare (E) bulk erase   (q) quit
+(v) write+verify (V) bulk write+verify (Y) bulk copy+verify
+(b) batch write
     """
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
@@ -200,6 +397,12 @@ What do you want to do?
         'e': mode_erase,
         'w': mode_write,
         'W': bulk_write,
+        'E': bulk_erase,
+        'b': batch_write,
+        'v': mode_write_verify,
+        'V': bulk_write_verify,
+        'Y': bulk_copy_verify,
+        'R': bulk_read,
         'm': mode_compare,
         'M': bulk_compare,
         's': settings,
@@ -213,13 +416,16 @@ What do you want to do?
         except Exception as e:
             print "Failed. Error:", e
             continue
-    elif ch.lower() in fnc:
+    elif ch.lower() in fnc and ch != 'B': # a batch write already runs the whole job file
+        mode = "bulk_" + fnc[ch.lower()].__name__.split("_")[-1]
         while True:
             try:
                 fnc[ch.lower()](dev)
+                swiped(mode)
             except KeyboardInterrupt:
                 break
             except Exception as e:
+                swiped(mode, False)
                 print "Failed. Error:", e
                 break
     else:
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2
+#
+# File: msrtui.py
+# Licence: GNU GPL version 3
+#
+# Event driven terminal UI for several readers at once
+#
+# The keyboard and every reader are watched by the same select() loop
+# (msrasync), so keys are handled while swipes are pending : a pending
+# command is cancelled cleanly (the device is reset) to skip a card, pause,
+# change the settings or switch the mode of a reader. The screen shows live
+# throughput and error counts of each reader.
+#
+# Keys : 1-9 select a reader, a selects all of them
+#        r read, w write, c copy, m compare, e erase (bulk modes, per reader)
+#        p pause/resume, s skip the pending swipe, h/l hico/loco, q quit
+#
+
+import os
+import sys
+import time
+import tty
+import termios
+import msrasync
+import msrfields
+
+# seconds a reader waits for a swipe before the command is sent again
+swipe_timeout = 600
+# seconds between two refreshes of the screen
+refresh = 0.5
+
+modes = {"r": "read", "w": "write", "c": "copy", "m": "compare", "e": "erase"}
+
+def strip(t):
+    return msrfields.strip(t)
+
+class station(object):
+    # a reader, the bulk mode it runs and its counters
+    def __init__(self, ui, number, dev):
+        self.ui = ui
+        self.number = number
+        self.dev = dev
+        self.mode = "paused"
+        self.data = None      # tracks to write, or the reference card of copy/compare
+        self.task = None
+        self.ok = 0
+        self.errors = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.state = "idle"
+        self.last = ""
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.ok * 60.0 / elapsed if elapsed > 0 else 0.0
+
+    def start(self, mode, data=None):
+        # switches to mode, cancelling the pending swipe if any
+        self.stop()
+        self.mode = mode
+        self.data = data
+        self.ok = self.errors = self.skipped = 0
+        self.started = time.time()
+        if mode != "paused": self.task = self.ui.loop.spawn(self.__run())
+
+    def stop(self):
+        if self.task is not None: self.task.cancel()
+        self.task = None
+        self.state = "idle"
+
+    def pause(self):
+        if self.mode == "paused":
+            if self.paused_mode is not None: self.start(self.paused_mode, self.paused_data)
+        else:
+            self.paused_mode, self.paused_data = self.mode, self.data
+            self.stop()
+            self.mode = "paused"
+    paused_mode = None
+    paused_data = None
+
+    def skip(self):
+        # cancels the pending swipe, the mode goes on with the next card
+        if self.task is not None and self.task.waiting is not None:
+            self.task.waiting.cancel()
+
+    def configure(self, hico):
+        # sets the coercivity between two swipes
+        mode = self.mode
+        self.stop()
+        def run():
+            try:
+                self.state = "setting %s" % ("hico" if hico else "loco")
+                yield self.dev.set_coercivity(hico)
+                self.last = "%s set" % ("hico" if hico else "loco")
+            except Exception as e:
+                self.last = "setting failed : %s" % e
+            self.ui.redraw()
+            if mode != "paused": self.task = self.ui.loop.spawn(self.__run())
+        self.task = self.ui.loop.spawn(run())
+
+    def __run(self):
+        dev = self.dev
+        while True:
+            try:
+                if self.mode == "read":
+                    self.state = "swipe card to read"
+                    tracks = yield dev.read_tracks(swipe_timeout)
+                    self.last = " ".join(str(t) for t in tracks)
+                elif self.mode == "erase":
+                    self.state = "swipe card to erase"
+                    yield dev.erase_tracks(True, True, True, swipe_timeout)
+                    self.last = "erased"
+                elif self.mode == "write" or (self.mode == "copy" and self.data is not None):
+                    self.state = "swipe card to write"
+                    yield dev.write_tracks(*(list(self.data) + [swipe_timeout]))
+                    self.last = "written"
+                elif self.data is None: # copy and compare : reference card first
+                    self.state = "swipe the reference card"
+                    tracks = yield dev.read_tracks(swipe_timeout)
+                    self.data = [strip(t) for t in tracks] if self.mode == "copy" else tracks
+                    self.last = "reference : " + " ".join(str(t) for t in tracks)
+                    self.ui.redraw()
+                    continue
+                else: # compare
+                    self.state = "swipe card to compare"
+                    tracks = yield dev.read_tracks(swipe_timeout)
+                    bad = [n+1 for n in range(3) if tracks[n] != self.data[n]]
+                    if bad: raise Exception("compare failed on track %s" % ", ".join(str(n) for n in bad))
+                    self.last = "compare OK"
+                self.ok += 1
+            except msrasync.cancelled:
+                self.skipped += 1
+                self.last = "skipped"
+            except msrasync.timeout:
+                continue # nobody swiped, wait again
+            except Exception as e:
+                self.errors += 1
+                self.last = "error : %s" % e
+            self.ui.redraw()
+
+class tui(object):
+    def __init__(self, paths, out=sys.stdout):
+        self.out = out
+        self.loop = msrasync.loop()
+        self.stations = [station(self, n+1, msrasync.async_msr(path, self.loop)) for n, path in enumerate(paths)]
+        self.selected = None  # station number, None for all of them
+        self.input = None     # (prompt, text, callback) while a line is typed
+        self.message = ""
+        self.__dirty = True
+
+    def targets(self):
+        if self.selected is None: return self.stations
+        return [self.stations[self.selected-1]]
+
+    # screen
+
+    def redraw(self):
+        # the screen is refreshed by the next timer tick, so bursts of events cost one draw
+        self.__dirty = True
+
+    def __tick(self):
+        if self.__dirty: self.draw()
+        self.__timer = self.loop.call_later(refresh, self.__tick)
+
+    def draw(self):
+        self.__dirty = False
+        lines = ["\x1b[H\x1b[2J",
+                 "MSR605 readers  (selected: %s)" % ("all" if self.selected is None else self.selected),
+                 "%-3s %-16s %-8s %6s %6s %6s %8s  %s" % ("#", "device", "mode", "ok", "errors", "skip", "cards/min", "state"),
+                 ]
+        for s in self.stations:
+            lines.append("%-3d %-16s %-8s %6d %6d %6d %8.1f  %s" % (s.number, s.dev.path[-16:], s.mode,
+                s.ok, s.errors, s.skipped, s.rate(), s.state))
+            if s.last: lines.append("      last : %s" % s.last[0:100])
+        lines.append("")
+        lines.append("1-9/a select  r read  w write  c copy  m compare  e erase  p pause  s skip  h/l hico/loco  q quit")
+        if self.message: lines.append(self.message)
+        if self.input is not None: lines.append("%s%s" % (self.input[0], self.input[1]))
+        self.out.write("\r\n".join(lines))
+        self.out.flush()
+
+    # keyboard
+
+    def __readable(self):
+        for c in os.read(self.fd, 1024):
+            if self.input is not None:
+                self.__line(c)
+            else:
+                self.key(c)
+        self.redraw()
+
+    def __line(self, c):
+        prompt, text, callback = self.input
+        if c in "\r\n":
+            self.input = None
+            callback(text)
+        elif c == "\x1b":
+            self.input = None
+        elif c in "\x7f\b":
+            self.input = (prompt, text[0:-1], callback)
+        elif c >= " ":
+            self.input = (prompt, text + c, callback)
+
+    def ask(self, prompt, callback):
+        # reads a line without blocking the readers
+        self.input = (prompt, "", callback)
+
+    def key(self, c):
+        self.message = ""
+        if c == "q":
+            self.loop.stop()
+        elif c.isdigit() and 1 <= int(c) <= len(self.stations):
+            self.selected = int(c)
+        elif c == "a":
+            self.selected = None
+        elif c == "w":
+            def write(text):
+                tracks = (text.split("|") + ["", "", ""])[0:3]
+                for s in self.targets(): s.start("write", tracks)
+            self.ask("tracks to write, t1|t2|t3 : ", write)
+        elif c in modes:
+            for s in self.targets(): s.start(modes[c])
+        elif c == "p":
+            for s in self.targets(): s.pause()
+        elif c == "s":
+            for s in self.targets(): s.skip()
+        elif c in "hl":
+            for s in self.targets(): s.configure(c == "h")
+        else:
+            self.message = "unknown key %r" % c
+
+    def run(self):
+        self.fd = sys.stdin.fileno()
+        old_settings = termios.tcgetattr(self.fd)
+        try:
+            tty.setcbreak(self.fd)
+            self.loop.add_reader(self.fd, self.__readable)
+            self.__tick()
+            self.loop.run()
+        finally:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, old_settings)
+            for s in self.stations:
+                s.stop()
+                s.dev.close()
+            self.out.write("\r\n")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="drive several MSR605 readers from one terminal")
+    parser.add_argument('devices', nargs="+", help="paths to serial communication devices")
+    args = parser.parse_args()
+    try:
+        tui(args.devices).run()
+    except KeyboardInterrupt:
+        pass